@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест рассылок без реальных пользователей.
+
+Настоящий код бота (подтверждение рассылки, follow-up, периодическая
+рассылка) работает против поддельной сессии Telegram, которая имитирует
+задержку ответа, 429 и 403, на синтетической аудитории во временной базе
+tenders.db. Для каждого
+размера аудитории выводятся сообщений/с, число коммитов БД, p50/p99
+задержки отправки и пиковый RSS процесса.
+
+Пример: python benchmark_mailing.py --sizes 1000,10000,100000 --latency-ms 30
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aiogram import types
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.methods import SendMediaGroup
+
+# Синтетические пользователи и администратор
+BENCH_USER_BASE = 10_000_000
+BENCH_ADMIN_ID = 1
+
+
+class FakeSession(BaseSession):
+    """Сессия aiogram без сети.
+    
+    Каждый запрос отвечает через latency_ms ± jitter_ms; с вероятностью p429
+    возвращает flood control (retry_after сек), с вероятностью p403 - блокировку
+    бота, после которой чат недоступен навсегда.
+    """
+    
+    def __init__(self, latency_ms: float, jitter_ms: float, p429: float, p403: float, retry_after: int):
+        super().__init__()
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.p429 = p429
+        self.p403 = p403
+        self.retry_after = retry_after
+        self.blocked = set()
+        self.requests = 0
+        self.delivered = 0
+        self.flood_errors = 0
+        self.forbidden_errors = 0
+        self._message_ids = itertools.count(1)
+    
+    def reset(self):
+        """Сброс счетчиков перед сценарием"""
+        self.blocked.clear()
+        self.requests = self.delivered = self.flood_errors = self.forbidden_errors = 0
+    
+    async def make_request(self, bot, method, timeout=None):
+        self.requests += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        
+        chat_id = getattr(method, "chat_id", None)
+        roll = random.random()
+        if roll < self.p429:
+            self.flood_errors += 1
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=self.retry_after)
+        if chat_id in self.blocked or roll < self.p429 + self.p403:
+            self.blocked.add(chat_id)
+            self.forbidden_errors += 1
+            raise TelegramForbiddenError(method=method, message="Forbidden: bot was blocked by the user")
+        
+        self.delivered += 1
+        message = types.Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(),
+            chat=types.Chat(id=chat_id or 0, type="private")
+        )
+        return [message] if isinstance(method, SendMediaGroup) else message
+    
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        raise NotImplementedError("FakeSession не скачивает файлы")
+        yield b""
+    
+    async def close(self):
+        pass
+
+
+def timed_engine(engine_class, latencies: list):
+    """BroadcastEngine, записывающий длительность каждого вызова API (лимиты + запрос + повторы)"""
+    class TimedEngine(engine_class):
+        async def call(self, chat_id, request):
+            started = time.perf_counter()
+            try:
+                return await super().call(chat_id, request)
+            finally:
+                latencies.append(time.perf_counter() - started)
+    
+    return TimedEngine
+
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль q (0..1) по отсортированной выборке"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * (len(values) - 1)))]
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS процесса (МБ); на Linux ru_maxrss - в килобайтах"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def seed_audience(database, size: int):
+    """Синтетическая аудитория из size подписанных пользователей вместо прежней"""
+    with database.transaction() as conn:
+        for table in ("mailing_recipients", "sent_messages", "tender_exports", "users"):
+            conn.execute(f"DELETE FROM {table}")
+        conn.executemany(
+            "INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+            ((BENCH_USER_BASE + i, f"bench{i}", "Bench") for i in range(size))
+        )
+
+
+async def bench_mailing(bot_main, size: int):
+    """Сценарий: администратор подтверждает рассылку на всю аудиторию"""
+    message = types.Message(
+        message_id=1,
+        date=datetime.now(),
+        chat=types.Chat(id=BENCH_ADMIN_ID, type="private"),
+        from_user=types.User(id=BENCH_ADMIN_ID, is_bot=False, first_name="Admin"),
+        text="✅ Да, отправить"
+    ).as_(bot_main.bot)
+    state = FSMContext(bot_main.storage, StorageKey(bot_id=bot_main.bot.id, chat_id=BENCH_ADMIN_ID, user_id=BENCH_ADMIN_ID))
+    await state.set_data({"mailing_text": "📨 Нагрузочный тест рассылки", "filter_type": "all"})
+    
+    await bot_main.process_mailing_confirmation(message, state)
+    await asyncio.gather(*bot_main.mailing_tasks.values())
+
+
+async def bench_followups(bot_main, size: int):
+    """Сценарий: follow-up по выгрузкам, отправленным больше часа назад"""
+    sent_at = int(time.time()) - 7200
+    with bot_main.db.sync.transaction() as conn:
+        conn.executemany(
+            '''INSERT INTO tender_exports (user_id, file_name, status, follow_up_scheduled, sent_at)
+               VALUES (?, 'bench.xlsx', 'completed', 1, ?)''',
+            ((BENCH_USER_BASE + i, sent_at) for i in range(size))
+        )
+    
+    await bot_main.send_follow_up_messages()
+
+
+async def bench_scheduler(bot_main, size: int):
+    """Сценарий: периодическая рассылка информации о компании (scheduler_job.py)"""
+    mailing_id, user_count = await bot_main.start_company_broadcast()
+    if user_count:
+        await bot_main.mailing_tasks[mailing_id]
+
+
+SCENARIOS = {
+    "mailing": bench_mailing,
+    "followup": bench_followups,
+    "scheduler": bench_scheduler,
+}
+
+
+async def run_benchmark(bot_main, session: FakeSession, scenarios: list, sizes: list):
+    """Прогон сценариев по всем размерам аудитории и вывод таблицы результатов"""
+    latencies = []
+    bot_main.BroadcastEngine = timed_engine(bot_main.BroadcastEngine, latencies)
+    bot_main.bot.session = session
+    await bot_main.db.open()
+    
+    header = (f"{'Сценарий':<10} {'Аудитория':>10} {'Время, с':>9} {'Сообщ./с':>9} {'Запросов':>9} "
+              f"{'429':>5} {'403':>6} {'Коммитов':>9} {'p50, мс':>8} {'p99, мс':>8} {'RSS, МБ':>8}")
+    print(header)
+    print("-" * len(header))
+    
+    try:
+        for name in scenarios:
+            for size in sizes:
+                seed_audience(bot_main.db.sync, size)
+                session.reset()
+                latencies.clear()
+                bucket = bot_main.broadcast_bucket
+                bucket.rate = bucket.max_rate
+                commits = bot_main.db.sync.pool.commits
+                
+                started = time.perf_counter()
+                await SCENARIOS[name](bot_main, size)
+                await bot_main.db.writes.flush()
+                elapsed = time.perf_counter() - started
+                
+                latencies.sort()
+                print(f"{name:<10} {size:>10} {elapsed:>9.2f} {session.delivered / elapsed:>9.1f} "
+                      f"{session.requests:>9} {session.flood_errors:>5} {session.forbidden_errors:>6} "
+                      f"{bot_main.db.sync.pool.commits - commits:>9} "
+                      f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f} "
+                      f"{peak_rss_mb():>8.1f}")
+    finally:
+        await bot_main.db.writes.flush()
+        await bot_main.db.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест рассылок с поддельной сессией Telegram")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="размеры аудитории через запятую")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="сценарии через запятую")
+    parser.add_argument("--latency-ms", type=float, default=30, help="средняя задержка ответа Telegram")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="разброс задержки")
+    parser.add_argument("--p429", type=float, default=0.0005, help="доля ответов 429 (flood control)")
+    parser.add_argument("--p403", type=float, default=0.01, help="доля пользователей, заблокировавших бота")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, сек")
+    parser.add_argument("--rate", type=float, default=1_000_000,
+                        help="BROADCAST_RATE; по умолчанию лимит снят, чтобы мерить сам код")
+    parser.add_argument("--concurrency", type=int, default=25, help="BROADCAST_CONCURRENCY")
+    parser.add_argument("--seed", type=int, default=1, help="зерно генератора ошибок")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    scenarios = [name.strip() for name in args.scenarios.split(",")]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"❌ Неизвестные сценарии: {', '.join(sorted(unknown))}")
+    
+    random.seed(args.seed)
+    workdir = tempfile.TemporaryDirectory(prefix="mailing_bench_")
+    
+    # Настройки бота читаются при импорте: окружение задается до него
+    os.environ.update({
+        "DB_BACKEND": "sqlite",
+        "DB_PATH": os.path.join(workdir.name, "tenders.db"),
+        "BOT_TOKEN": "123456:BENCHMARK",
+        "ADMIN_ID": str(BENCH_ADMIN_ID),
+        "BROADCAST_RATE": str(args.rate),
+        "BROADCAST_BURST": str(max(1, args.concurrency)),
+        "BROADCAST_CHAT_INTERVAL": "0",
+        "BROADCAST_CONCURRENCY": str(args.concurrency),
+        "BROADCAST_WORKERS": "1",
+    })
+    os.chdir(workdir.name)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as bot_main
+    
+    if not args.verbose:
+        logging.disable(logging.ERROR)
+    
+    session = FakeSession(args.latency_ms, args.jitter_ms, args.p429, args.p403, args.retry_after)
+    try:
+        asyncio.run(run_benchmark(bot_main, session, scenarios, sizes))
+    finally:
+        workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Движок массовых рассылок: общий лимит Telegram (token bucket) с адаптацией
+к flood control, лимит сообщений в один чат и ограниченный пул
+параллельных отправителей
+"""
+
+import asyncio
+import logging
+import time
+from typing import AsyncIterable, Awaitable, Callable, Tuple
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Тексты ошибок BadRequest, после которых писать в чат бессмысленно
+UNREACHABLE_BAD_REQUESTS = ("chat not found", "user not found", "user is deactivated")
+
+
+def is_unreachable(error: Exception) -> bool:
+    """Получатель недоступен навсегда: бот заблокирован, чат не найден, аккаунт удален"""
+    if isinstance(error, TelegramForbiddenError):
+        return True
+    return isinstance(error, TelegramBadRequest) and any(
+        text in str(error).lower() for text in UNREACHABLE_BAD_REQUESTS
+    )
+
+
+
+class TokenBucket:
+    """Не более rate операций в секунду с запасом burst (общий для всех рассылок).
+    
+    Скорость адаптивная (AIMD): на RetryAfter все ждут указанное время, а
+    скорость падает вдвое; каждый успешный вызов прибавляет increase, пока
+    скорость не вернется к исходной.
+    """
+    
+    def __init__(self, rate: float, burst: int, min_rate: float = 1.0, increase: float = 0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.increase = increase
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+    
+    async def acquire(self, tokens: float = 1.0):
+        """Ожидание свободного токена; ожидающие обслуживаются по очереди"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+    
+    def slow_down(self, retry_after: float):
+        """Flood control: пауза для всех отправителей и снижение скорости вдвое"""
+        now = time.monotonic()
+        # Параллельные отправители получают RetryAfter почти одновременно:
+        # скорость снижается один раз на каждую паузу
+        if now >= self.blocked_until:
+            self.rate = max(self.min_rate, self.rate / 2)
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.tokens = 0.0
+        self.updated = self.blocked_until
+    
+    def speed_up(self):
+        """Успешный вызов: скорость плавно возвращается к исходной"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class ChatRateLimiter:
+    """Минимальный интервал между сообщениями в один чат"""
+    
+    # Порог числа чатов, после которого забываются уже прошедшие слоты
+    PRUNE_THRESHOLD = 10000
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_slot = {}
+    
+    async def wait(self, chat_id: int):
+        """Ожидание, пока с последнего сообщения в чат пройдет interval"""
+        delay = self._next_slot.get(chat_id, 0.0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    
+    def mark(self, chat_id: int):
+        """Отметка отправки в чат: следующее сообщение не раньше чем через interval"""
+        now = time.monotonic()
+        self._next_slot[chat_id] = now + self.interval
+        
+        if len(self._next_slot) > self.PRUNE_THRESHOLD:
+            self._next_slot = {chat: at for chat, at in self._next_slot.items() if at > now}
+
+
+class BroadcastEngine:
+    """Рассылка по потоку получателей пулом из concurrency отправителей.
+    
+    Каждый вызов API отправитель делает через call(chat_id, ...): слот чата,
+    токен общего лимита и повтор после RetryAfter. Очередь между чтением получателей и отправителями
+    ограничена, поэтому в памяти держится лишь несколько страниц аудитории.
+    """
+    
+    def __init__(self, bucket: TokenBucket, chat_limiter: ChatRateLimiter, concurrency: int,
+                 retries: int = 3):
+        self.bucket = bucket
+        self.chat_limiter = chat_limiter
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+    
+    async def throttle(self, chat_id: int):
+        """Ожидание права на один вызов API для чата"""
+        await self.chat_limiter.wait(chat_id)
+        await self.bucket.acquire()
+        self.chat_limiter.mark(chat_id)
+    
+    async def call(self, chat_id: int, request: Callable[[], Awaitable]):
+        """Вызов API для чата с учетом лимитов; на RetryAfter - общая пауза и повтор"""
+        for attempt in range(self.retries + 1):
+            await self.throttle(chat_id)
+            try:
+                result = await request()
+            except TelegramRetryAfter as e:
+                self.bucket.slow_down(e.retry_after)
+                logger.warning(f"⚠️ Flood control Telegram: пауза {e.retry_after} с, "
+                               f"скорость снижена до {self.bucket.rate:.1f} сообщений/с")
+                if attempt == self.retries:
+                    raise
+                continue
+            
+            self.bucket.speed_up()
+            return result
+    
+    async def run(self, recipients: AsyncIterable,
+                  send: Callable[[object], Awaitable[bool]]) -> Tuple[int, int]:
+        """Отправка всем получателям: (успешно, неудачно).
+        
+        send возвращает True/False по результату отправки или None, если
+        получатель пропущен (например, рассылка поставлена на паузу).
+        """
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        counts = [0, 0]
+        
+        async def sender():
+            while True:
+                recipient = await queue.get()
+                if recipient is None:
+                    return
+                try:
+                    ok = await send(recipient)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка отправителя рассылки: {e}")
+                    ok = False
+                if ok is not None:
+                    counts[0 if ok else 1] += 1
+        
+        senders = [asyncio.create_task(sender()) for _ in range(self.concurrency)]
+        try:
+            async for recipient in recipients:
+                await queue.put(recipient)
+            for _ in senders:
+                await queue.put(None)
+            await asyncio.gather(*senders)
+        except BaseException:
+            for task in senders:
+                task.cancel()
+            raise
+        
+        return counts[0], counts[1]
@@ -0,0 +1,180 @@
+"""
+Многопроцессная рассылка: получатели делятся между процессами-воркерами
+по user_id % N, а общий лимит Telegram выдает координатор основного
+процесса через Unix-сокет
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from typing import Callable, Dict, Optional, Tuple
+
+from broadcast import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCoordinator:
+    """Выдача токенов общего TokenBucket воркерам рассылки через Unix-сокет.
+    
+    Протокол построчный. Воркер шлет "acquire" и ждет ответ "go <rate>" или
+    "stop <rate>" (токен выдан, но рассылку поставили на паузу или отменили:
+    новых получателей брать не нужно); "slow <retry_after>" - flood control,
+    "ok" - успешный вызов API, "done <shard> <sent> <failed>" - итог воркера.
+    """
+    
+    def __init__(self, bucket: TokenBucket, is_running: Callable[[], bool]):
+        self.bucket = bucket
+        self.is_running = is_running
+        self.results: Dict[int, Tuple[int, int]] = {}
+        self.path = None
+        self._server = None
+        self._clients = set()
+    
+    async def start(self) -> str:
+        """Запуск сервера токенов; возвращает путь к сокету"""
+        self.path = os.path.join(tempfile.mkdtemp(prefix="broadcast_"), "tokens.sock")
+        self._server = await asyncio.start_unix_server(self._serve, path=self.path)
+        return self.path
+    
+    async def wait_clients(self):
+        """Ожидание, пока координатор дочитает все сообщения отключившихся воркеров"""
+        await asyncio.gather(*self._clients, return_exceptions=True)
+    
+    async def close(self):
+        """Остановка сервера и удаление сокета"""
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self.path:
+            shutil.rmtree(os.path.dirname(self.path), ignore_errors=True)
+    
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Обслуживание одного воркера"""
+        task = asyncio.current_task()
+        self._clients.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                
+                command, *args = line.decode().split()
+                if command == "acquire":
+                    await self.bucket.acquire()
+                    reply = "go" if self.is_running() else "stop"
+                    writer.write(f"{reply} {self.bucket.rate}\n".encode())
+                    await writer.drain()
+                elif command == "slow":
+                    self.bucket.slow_down(float(args[0]))
+                elif command == "ok":
+                    self.bucket.speed_up()
+                elif command == "done":
+                    shard, sent, failed = map(int, args)
+                    self.results[shard] = (sent, failed)
+        except Exception as e:
+            logger.error(f"❌ Ошибка координатора рассылки: {e}")
+        finally:
+            self._clients.discard(task)
+            writer.close()
+
+
+class RemoteTokenBucket:
+    """TokenBucket воркера: каждый токен выдает координатор основного процесса.
+    
+    on_stop вызывается, когда координатор сообщает о паузе или отмене рассылки.
+    """
+    
+    def __init__(self, path: str, on_stop: Optional[Callable[[], None]] = None):
+        self.path = path
+        self.on_stop = on_stop
+        self.rate = 0.0
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+    
+    async def connect(self):
+        """Подключение к координатору"""
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+    
+    async def close(self):
+        """Отключение от координатора"""
+        if self._writer:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+    
+    async def acquire(self):
+        """Ожидание токена от координатора"""
+        # Ответы приходят в порядке запросов: в полете один запрос воркера
+        async with self._lock:
+            self._writer.write(b"acquire\n")
+            await self._writer.drain()
+            line = await self._reader.readline()
+        
+        if not line:
+            raise ConnectionError("координатор рассылки недоступен")
+        
+        reply, rate = line.decode().split()
+        self.rate = float(rate)
+        if reply == "stop" and self.on_stop:
+            self.on_stop()
+    
+    def slow_down(self, retry_after: float):
+        """Flood control: общая пауза и снижение скорости у координатора"""
+        self._writer.write(f"slow {retry_after}\n".encode())
+    
+    def speed_up(self):
+        """Успешный вызов: координатор плавно возвращает скорость"""
+        self._writer.write(b"ok\n")
+    
+    async def report(self, shard: int, sent: int, failed: int):
+        """Передача итогов воркера координатору"""
+        self._writer.write(f"done {shard} {sent} {failed}\n".encode())
+        await self._writer.drain()
+
+
+async def run_sharded(mailing_id: int, shards: int, bucket: TokenBucket,
+                      is_running: Callable[[], bool]) -> Dict[int, Tuple[int, int]]:
+    """Отправка рассылки shards процессами-воркерами с общим лимитом bucket.
+    
+    Возвращает итоги по воркерам: номер -> (успешно, неудачно).
+    """
+    coordinator = TokenCoordinator(bucket, is_running)
+    path = await coordinator.start()
+    processes = []
+    
+    try:
+        for shard in range(shards):
+            processes.append(await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__),
+                str(mailing_id), str(shard), str(shards), path
+            ))
+        
+        codes = await asyncio.gather(*(process.wait() for process in processes))
+        for shard, code in enumerate(codes):
+            if code:
+                logger.error(f"❌ Воркер {shard} рассылки {mailing_id} завершился с кодом {code}")
+        
+        await coordinator.wait_clients()
+        return coordinator.results
+    
+    finally:
+        # Остановка основного процесса: воркеры не должны слать без лимита
+        for process in processes:
+            if process.returncode is None:
+                process.terminate()
+        await coordinator.close()
+
+
+if __name__ == "__main__":
+    # Воркер: python broadcast_workers.py <mailing_id> <shard> <shards> <socket>
+    # Импорт ленивый: основной модуль нужен только процессу-воркеру
+    import main
+    
+    mailing_id, shard, shards = map(int, sys.argv[1:4])
+    asyncio.run(main.run_mailing_shard(mailing_id, shard, shards, sys.argv[4]))
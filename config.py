@@ -1,7 +1,11 @@
 import os
-from dotenv import load_dotenv
 
-load_dotenv()
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    # python-dotenv не обязателен: на хостинге переменные окружения задает платформа
+    pass
 
 # Токены и настройки
 BOT_TOKEN = os.getenv("BOT_TOKEN")
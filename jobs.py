@@ -0,0 +1,161 @@
+"""
+Очередь отложенных задач бота в хранилище (таблица jobs): уведомления
+администратору, follow-up, запросы контактов. Задача переживает перезапуск
+и недоступность Telegram: неудачная попытка повторяется с экспоненциальной
+паузой
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+
+from storage import now_ts
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """Долговечная очередь задач с пулом асинхронных исполнителей.
+    
+    register(kind, handler) связывает тип задачи с корутинной функцией
+    handler(payload); enqueue(kind, payload) записывает задачу в хранилище и
+    будит диспетчер. Диспетчер захватывает наступившие задачи (не больше, чем
+    свободных исполнителей) и спит до ближайшего срока. Захват - аренда на
+    lease секунд: задачу процесса, упавшего посреди выполнения, по истечении
+    аренды заберет снова любой экземпляр бота.
+    
+    Ошибка обработчика откладывает задачу на backoff_base * 2^(попытка-1) сек
+    (не больше backoff_max), а при RetryAfter - на retry_after из ответа.
+    Ошибки, для которых permanent(e) истинно (бот заблокирован), и исчерпание
+    max_attempts переводят задачу в failed.
+    
+    poll_interval - подстраховочный опрос хранилища (сек) для задач, которые
+    ставят другие реплики бота (общая база PostgreSQL). None - опроса нет:
+    единственный процесс сам будит диспетчер при постановке задачи, и база
+    читается только к сроку ближайшей задачи.
+    """
+    
+    # Повтор захвата после ошибки хранилища (сек)
+    ERROR_RETRY = 60
+    
+    def __init__(self, storage, workers: int = 4, max_attempts: int = 8, backoff_base: int = 30,
+                 backoff_max: int = 3600, lease: int = 300,
+                 permanent: Callable[[Exception], bool] = lambda e: False,
+                 poll_interval: Optional[float] = 60):
+        self.storage = storage
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.permanent = permanent
+        self.poll_interval = poll_interval
+        self.handlers = {}
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+        self._queue = asyncio.Queue()
+        self._busy = 0
+        self._wakeup = asyncio.Event()
+    
+    def register(self, kind: str, handler: Callable[[dict], Awaitable]):
+        """Обработчик задач типа kind"""
+        self.handlers[kind] = handler
+    
+    async def enqueue(self, kind: str, payload: dict = None, run_at: Optional[float] = None,
+                      key: str = None) -> Optional[int]:
+        """Постановка задачи (ID; None, если задача с тем же key уже в очереди)"""
+        if kind not in self.handlers:
+            raise ValueError(f"Неизвестный тип задачи: {kind}")
+        job_id = await self.storage.enqueue_job(kind, payload or {}, int(run_at or now_ts()),
+                                                self.max_attempts, key)
+        self._wakeup.set()
+        return job_id
+    
+    def backoff(self, attempts: int, error: Exception) -> int:
+        """Пауза (сек) перед следующей попыткой"""
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after:
+            return int(retry_after) + 1
+        return min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+    
+    def stats(self) -> dict:
+        """Счетчики очереди для /status"""
+        return {
+            "workers": self.workers,
+            "busy": self._busy,
+            "processed": self.processed,
+            "retried": self.retried,
+            "failed": self.failed
+        }
+    
+    async def _execute(self, job):
+        """Выполнение задачи и запись результата в хранилище"""
+        job_id, kind, attempts = job['id'], job['kind'], job['attempts']
+        handler = self.handlers.get(kind)
+        if handler is None:
+            self.failed += 1
+            logger.error(f"❌ Задача #{job_id}: нет обработчика для типа {kind}")
+            await self.storage.fail_job(job_id, f"нет обработчика для типа {kind}")
+            return
+        
+        try:
+            await handler(job['payload'])
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if self.permanent(e) or attempts >= job['max_attempts']:
+                self.failed += 1
+                logger.error(f"❌ Задача #{job_id} ({kind}) не выполнена после {attempts} попыток: {error}")
+                await self.storage.fail_job(job_id, error)
+            else:
+                delay = self.backoff(attempts, e)
+                self.retried += 1
+                logger.warning(f"⚠️ Задача #{job_id} ({kind}), попытка {attempts}: {error}; повтор через {delay} сек")
+                await self.storage.retry_job(job_id, now_ts() + delay, error)
+        else:
+            self.processed += 1
+            await self.storage.complete_job(job_id)
+    
+    async def _worker(self):
+        """Исполнитель: задачи из локальной очереди по одной"""
+        while True:
+            job = await self._queue.get()
+            self._busy += 1
+            try:
+                await self._execute(job)
+            except Exception as e:
+                # Хранилище недоступно: задача вернется после истечения аренды
+                logger.error(f"❌ Ошибка записи результата задачи #{job['id']}: {e}")
+            finally:
+                self._busy -= 1
+                self._wakeup.set()
+    
+    async def run(self):
+        """Диспетчер: захват наступивших задач для свободных исполнителей и сон до ближайшего срока"""
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        try:
+            while True:
+                self._wakeup.clear()
+                delay = self.poll_interval
+                try:
+                    free = self.workers - self._busy - self._queue.qsize()
+                    if free > 0:
+                        for job in await self.storage.claim_due_jobs(free, self.lease):
+                            self._queue.put_nowait(job)
+                        next_at = await self.storage.get_next_job_time()
+                        if next_at is not None:
+                            due_in = max(0, next_at - now_ts())
+                            delay = due_in if delay is None else min(delay, due_in)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка очереди задач: {e}")
+                    delay = self.ERROR_RETRY
+                
+                # Освободившийся исполнитель или новая задача будят диспетчер раньше срока
+                # (delay None - сон до пробуждения)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for worker in workers:
+                worker.cancel()
@@ -8,11 +8,21 @@ import os
 import asyncio
 import logging
 import sqlite3
+import time
+import re
+import queue
+import threading
+import functools
 import tempfile
 import json
+import base64
 import io
+import html
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any, Tuple
+from typing import Optional, List, Dict, Any, Tuple, Callable, Awaitable
 from pathlib import Path
 
 from aiogram import Bot, Dispatcher, types, F
@@ -23,13 +33,25 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton,
-    ReplyKeyboardRemove, BufferedInputFile, FSInputFile
+    ReplyKeyboardRemove, BufferedInputFile, FSInputFile,
+    InputMediaPhoto, InputMediaDocument, InputMediaVideo
 )
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from docx import Document
 from docx.shared import Inches
 
+from storage import (
+    StorageBackend, USER_FILTERS, USER_FILTER_COLUMNS, SEGMENT_FILTER_PREFIX, SEGMENT_COLUMNS,
+    RECIPIENT_PAGE_SIZE, ADMIN_PAGE_SIZE, now_ts, period_bounds, local_day
+)
+from broadcast import TokenBucket, ChatRateLimiter, BroadcastEngine, is_unreachable
+from broadcast_workers import RemoteTokenBucket, run_sharded
+from timers import TimerHeap
+from jobs import JobQueue
+from segments import SegmentIndex, SegmentError, SEGMENT_HELP
+from config import COMPANY_INFO
+
 # Импорты для HTTP сервера Railway
 import aiohttp
 from aiohttp import web
@@ -39,6 +61,90 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0")) if os.getenv("ADMIN_ID") else None
 PORT = int(os.getenv("PORT", 8080))
 
+# Настройки базы данных: sqlite (по умолчанию) или postgres (DATABASE_URL)
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite").lower()
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+DB_PATH = os.getenv("DB_PATH", "tenders.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 256))
+SQLITE_BUSY_TIMEOUT_MS = 5000
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", 1))
+
+# Групповой коммит отложенной записи: сброс каждые N мс или по M операций
+DB_WRITE_FLUSH_MS = int(os.getenv("DB_WRITE_FLUSH_MS", 200))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", 500))
+
+# Кэш чтений по пользователю: число пользователей и время жизни записи (сек)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 1024))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 60))
+
+# Рассылки: общий лимит Telegram (сообщений/с и запас), интервал между
+# сообщениями в один чат (сек) и число параллельных отправителей
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 30))
+BROADCAST_BURST = int(os.getenv("BROADCAST_BURST", 5))
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", 1.0))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 25))
+
+# Крупные рассылки (от BROADCAST_SHARD_MIN получателей) отправляются
+# BROADCAST_WORKERS процессами; 1 - отправка в основном процессе
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 1))
+BROADCAST_SHARD_MIN = int(os.getenv("BROADCAST_SHARD_MIN", 5000))
+
+# Недоступные получатели (бот заблокирован, чат не найден) деактивируются пачками по N
+UNREACHABLE_BATCH = int(os.getenv("UNREACHABLE_BATCH", 100))
+
+# Клавиатура обратной связи прикрепляется к самому сообщению рассылки (один вызов API
+# на получателя); 0 - отдельное сообщение «Как вам эта рассылка?» после каждой рассылки
+MAILING_INLINE_FEEDBACK = os.getenv("MAILING_INLINE_FEEDBACK", "1") == "1"
+
+# Доставка получателям рассылки записывается в БД пачками по N
+DELIVERY_BATCH = int(os.getenv("DELIVERY_BATCH", 100))
+
+# Через сколько секунд после выгрузки спрашивать пользователя, подошла ли подборка
+FOLLOW_UP_DELAY = int(os.getenv("FOLLOW_UP_DELAY", 3600))
+
+# Наступившие follow-up отправляются пачками по N выгрузок, до M одновременно
+FOLLOW_UP_BATCH = int(os.getenv("FOLLOW_UP_BATCH", 100))
+FOLLOW_UP_CONCURRENCY = int(os.getenv("FOLLOW_UP_CONCURRENCY", 10))
+
+# Очередь отложенных задач: исполнителей, попыток на задачу и пауза перед повтором
+# (сек; удваивается с каждой попыткой, но не больше JOB_BACKOFF_MAX)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 8))
+JOB_BACKOFF_BASE = int(os.getenv("JOB_BACKOFF_BASE", 30))
+JOB_BACKOFF_MAX = int(os.getenv("JOB_BACKOFF_MAX", 3600))
+
+# Сводки администратору: отклики на рассылки, отписки, частичные анкеты и запросы
+# контактов копятся и уходят одним сообщением раз в ADMIN_DIGEST_INTERVAL сек
+# (0 - каждое событие сразу); вне рабочего времени сводка ждет рабочего дня.
+# Типы событий из ADMIN_URGENT_EVENTS (через запятую, например "comment,unsubscribe")
+# отправляются сразу. Полные анкеты и сообщения менеджеру всегда приходят сразу
+ADMIN_DIGEST_INTERVAL = int(os.getenv("ADMIN_DIGEST_INTERVAL", 600))
+ADMIN_URGENT_EVENTS = {kind.strip() for kind in os.getenv("ADMIN_URGENT_EVENTS", "").split(",") if kind.strip()}
+# Сколько событий каждого типа перечислять в сводке поименно
+ADMIN_DIGEST_DETAILS = int(os.getenv("ADMIN_DIGEST_DETAILS", 10))
+
+# Рассылка информации о компании и отчет эффективности администратору: раз в N дней
+# в PERIODIC_TASKS_HOUR:00 (0 - только по cron: python scheduler_job.py)
+PERIODIC_TASKS_DAYS = int(os.getenv("PERIODIC_TASKS_DAYS", 0))
+PERIODIC_TASKS_HOUR = int(os.getenv("PERIODIC_TASKS_HOUR", 10))
+
+# Как часто (сек) обновлять сообщение администратора о ходе рассылки
+MAILING_PROGRESS_INTERVAL = float(os.getenv("MAILING_PROGRESS_INTERVAL", 5))
+
+# Альбом для рассылки считается собранным, если N сек не приходило новых частей
+MEDIA_GROUP_WAIT = 1.0
+
+# Профиль PRAGMA, применяемый к каждому соединению пула при его создании
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", SQLITE_BUSY_TIMEOUT_MS),
+    ("mmap_size", 256 * 1024 * 1024),
+    ("cache_size", -32000),
+    ("temp_store", "MEMORY"),
+)
+
 # Настройки времени работы (пн-чт 8:30-17:30 пт 8:30-16:30)
 WORK_START_HOUR = 9
 WORK_END_HOUR = 17
@@ -154,19 +260,409 @@ async def download_anketa_file():
         print(f"❌ Ошибка скачивания анкеты: {e}")
         return False
 
+# =========== ВРЕМЕННЫЕ МЕТКИ ===========
+# Все колонки *_at хранятся как INTEGER: секунды эпохи UTC
+SQL_NOW_TS = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+
+def sql_local_day(column: str) -> str:
+    """SQL-выражение: номер местных суток от эпохи для метки времени column (как local_day)"""
+    return f"CAST(strftime('%s', {column}, 'unixepoch', 'localtime') AS INTEGER) / 86400"
+
+
+def format_ts(ts, fmt: str = '%d.%m.%Y %H:%M', default: str = "??.??.???? ??:??") -> str:
+    """Форматирование метки времени эпохи в локальное время для сообщений"""
+    if not ts:
+        return default
+    return datetime.fromtimestamp(int(ts)).strftime(fmt)
+
+# =========== РАБОЧЕЕ ВРЕМЯ ===========
+def is_working_hours():
+    """Проверка рабочего времени"""
+    now = datetime.now()
+    
+    if now.weekday() not in WORK_DAYS:
+        return False
+    
+    if now.hour < WORK_START_HOUR or now.hour >= WORK_END_HOUR:
+        return False
+    
+    return True
+
+def get_next_working_time():
+    """Получение следующего рабочего времени"""
+    now = datetime.now()
+    
+    if is_working_hours():
+        return now
+    
+    # Рабочий день еще не начался - начало сегодня
+    if now.weekday() in WORK_DAYS and now.hour < WORK_START_HOUR:
+        return now.replace(hour=WORK_START_HOUR, minute=0, second=0, microsecond=0)
+    
+    days_to_add = 1
+    while (now.weekday() + days_to_add) % 7 not in WORK_DAYS:
+        days_to_add += 1
+    
+    next_work_day = now + timedelta(days=days_to_add)
+    return next_work_day.replace(hour=WORK_START_HOUR, minute=0, second=0, microsecond=0)
+
+def get_working_hours_end():
+    """Окончание текущего рабочего дня"""
+    return datetime.now().replace(hour=WORK_END_HOUR, minute=0, second=0, microsecond=0)
+
 # =========== БАЗА ДАННЫХ ===========
+class ConnectionPool:
+    """Пул постоянных соединений SQLite.
+    
+    Соединения создаются лениво (не больше size), получают профиль PRAGMA
+    один раз при создании и переиспользуются между запросами вместе с
+    кэшем подготовленных выражений sqlite3.
+    """
+    
+    def __init__(self, db_name: str, size: int = DB_POOL_SIZE, statement_cache: int = DB_STATEMENT_CACHE):
+        self.db_name = db_name
+        self.size = max(1, size)
+        self.statement_cache = statement_cache
+        self.commits = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._local = threading.local()
+    
+    def _connect(self):
+        """Создание соединения с профилем PRAGMA"""
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.statement_cache
+        )
+        conn.row_factory = sqlite3.Row
+        
+        for name, value in SQLITE_PRAGMAS:
+            conn.execute(f"PRAGMA {name} = {value}")
+        
+        return conn
+    
+    def _acquire(self):
+        """Получение свободного соединения (или создание нового в пределах лимита)"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        return self._idle.get()
+    
+    def _release(self, conn):
+        """Возврат соединения в пул"""
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        self._idle.put(conn)
+    
+    @contextmanager
+    def connection(self):
+        """Соединение из пула; вложенные вызовы в том же потоке получают то же соединение"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+        
+        conn = self._acquire()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._release(conn)
+    
+    @contextmanager
+    def transaction(self):
+        """Транзакция записи; вложенные транзакции сливаются с внешней"""
+        with self.connection() as conn:
+            if getattr(self._local, "tx_depth", 0):
+                self._local.tx_depth += 1
+                try:
+                    yield conn
+                finally:
+                    self._local.tx_depth -= 1
+                return
+            
+            self._local.tx_depth = 1
+            self._local.after_commit = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                yield conn
+                conn.execute("COMMIT")
+                self.commits += 1
+            except BaseException:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._local.tx_depth = 0
+                callbacks, self._local.after_commit = self._local.after_commit, []
+                for callback in callbacks:
+                    callback()
+    
+    def after_commit(self, callback):
+        """Вызов callback после завершения внешней транзакции потока (сразу, если ее нет).
+        
+        Нужен для сброса кэшей: до COMMIT другие потоки читают старую строку и
+        могли бы положить ее в кэш уже после сброса. После отката callback тоже
+        вызывается - лишний сброс кэша безвреден.
+        """
+        if getattr(self._local, "tx_depth", 0):
+            self._local.after_commit.append(callback)
+        else:
+            callback()
+    
+    def close_all(self):
+        """Закрытие всех свободных соединений"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+class UserCache:
+    """Ограниченный LRU-кэш с TTL для чтений по user_id.
+    
+    Для каждого пользователя хранятся результаты нескольких методов чтения.
+    Методы записи сбрасывают запись пользователя целиком; номер версии не
+    дает чтению, начатому до сброса, положить в кэш устаревшее значение.
+    """
+    
+    def __init__(self, max_users: int = USER_CACHE_SIZE, ttl: int = USER_CACHE_TTL):
+        self.max_users = max(1, max_users)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+    
+    def get(self, user_id: int, key: str):
+        """Поиск значения: (найдено, значение)"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            cached = entry.get(key) if entry else None
+            if cached and cached[0] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return True, cached[1]
+            self.misses += 1
+            return False, None
+    
+    def version(self) -> int:
+        """Текущая версия (меняется при каждом сбросе)"""
+        return self._version
+    
+    def put(self, user_id: int, key: str, value, version: int):
+        """Сохранение значения, если с начала чтения не было сбросов"""
+        with self._lock:
+            if version != self._version:
+                return
+            entry = self._entries.setdefault(user_id, {})
+            entry[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self, user_id: int):
+        """Сброс всех значений пользователя"""
+        with self._lock:
+            self._version += 1
+            self._entries.pop(user_id, None)
+    
+    def stats(self) -> dict:
+        """Счетчики попаданий и промахов"""
+        total = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0
+        }
+
+def _user_cached(method):
+    """Чтение через кэш пользователя (первый аргумент - user_id)"""
+    @functools.wraps(method)
+    def wrapper(self, user_id: int):
+        found, value = self.user_cache.get(user_id, method.__name__)
+        if found:
+            return value
+        
+        version = self.user_cache.version()
+        value = method(self, user_id)
+        self.user_cache.put(user_id, method.__name__, value, version)
+        return value
+    
+    return wrapper
+
+def _invalidates_user(method):
+    """Метод записи, после которого кэш пользователя сбрасывается (после COMMIT внешней транзакции)"""
+    @functools.wraps(method)
+    def wrapper(self, user_id: int, *args, **kwargs):
+        try:
+            return method(self, user_id, *args, **kwargs)
+        finally:
+            self.pool.after_commit(lambda: self.user_cache.invalidate(user_id))
+    
+    return wrapper
+
 class Database:
-    def __init__(self, db_name="tenders.db"):
+    def __init__(self, db_name=DB_PATH):
         self.db_name = db_name
+        self.pool = ConnectionPool(db_name)
+        self.user_cache = UserCache()
         self.init_db()
     
+    def connection(self):
+        """Соединение из пула для чтения"""
+        return self.pool.connection()
+    
+    def transaction(self):
+        """Соединение из пула в транзакции записи"""
+        return self.pool.transaction()
+    
+    def close(self):
+        """Закрытие соединений пула"""
+        self.pool.close_all()
+    
     def init_db(self):
-        """Инициализация базы данных с новыми таблицами"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        """Инициализация базы данных: применение недостающих миграций схемы"""
+        current = self.get_schema_version()
+        latest = self.MIGRATIONS[-1][0]
+        
+        # Быстрый путь: схема уже актуальна
+        if current >= latest:
+            logger.info(f"✅ База данных инициализирована (схема v{current})")
+            return
+        
+        for version, description, step in self.MIGRATIONS:
+            if version <= current:
+                continue
+            
+            with self.transaction() as conn:
+                # Повторная проверка под блокировкой записи: миграцию мог применить другой процесс
+                applied = conn.execute(
+                    'SELECT 1 FROM schema_version WHERE version = ?', (version,)
+                ).fetchone() if self._has_table(conn, 'schema_version') else None
+                if applied:
+                    continue
+                
+                getattr(self, step)(conn)
+                conn.execute('''
+                INSERT INTO schema_version (version, description)
+                VALUES (?, ?)
+                ''', (version, description))
+            
+            logger.info(f"✅ Миграция схемы v{version}: {description}")
+        
+        with self.connection() as conn:
+            conn.execute("PRAGMA optimize")
+        
+        logger.info(f"✅ База данных инициализирована (схема v{latest})")
+    
+    def get_schema_version(self):
+        """Текущая версия схемы (0 для пустой базы)"""
+        with self.connection() as conn:
+            if not self._has_table(conn, 'schema_version'):
+                return 0
+            return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    
+    @staticmethod
+    def _has_table(conn, table: str):
+        """Проверка существования таблицы"""
+        return conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone() is not None
+    
+    @staticmethod
+    def _add_column(conn, table: str, column: str, definition: str):
+        """Добавление колонки, если ее еще нет (для миграций)"""
+        columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+        if column not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    
+    # Упорядоченные шаги миграции схемы: (версия, описание, метод)
+    MIGRATIONS = [
+        (1, "Базовые таблицы", "_migrate_base_schema"),
+        (2, "Индексы для частых запросов", "_migrate_hot_query_indexes"),
+        (3, "Метки времени в секундах эпохи UTC", "_migrate_epoch_timestamps"),
+        (4, "Счетчики статистики по дням", "_migrate_stats_counters"),
+        (5, "Индекс аудитории рассылок", "_migrate_audience_index"),
+        (6, "Очередь получателей рассылок", "_migrate_mailing_jobs"),
+        (7, "Вложения рассылок", "_migrate_mailing_media"),
+        (8, "Отложенные рассылки", "_migrate_scheduled_mailings"),
+        (9, "Метка изменения пользователей", "_migrate_user_updated_at"),
+        (10, "Очередь задач", "_migrate_jobs"),
+        (11, "События для сводок администратору", "_migrate_admin_events"),
+        (12, "Счетчики статистики по местным суткам", "_migrate_local_day_counters"),
+    ]
+    
+    # Вклад строки в stats_counters: таблица -> (колонки для UPDATE-триггера,
+    # [(день, метрика, приращение, условие)]), {r} - NEW или OLD.
+    # День 0 - «текущие» показатели (подписки, статусы анкет), остальные дни -
+    # номер местных суток от эпохи (local_day): границы дней совпадают с period_bounds.
+    # При смене часового пояса сервера счетчики пересчитывает recompute_stats_counters().
+    STATS_CONTRIBUTIONS = {
+        'users': ('is_active, mailing_subscribed, created_at', [
+            (sql_local_day("{r}.created_at"), "'new_users'", "1", "1"),
+            ("0", "CASE {r}.mailing_subscribed WHEN 1 THEN 'subscribed_users' ELSE 'unsubscribed_users' END",
+             "1", "{r}.is_active = 1"),
+        ]),
+        'questionnaires': ('status, created_at', [
+            (sql_local_day("{r}.created_at"), "'new_questionnaires'", "1", "1"),
+            ("0", "'questionnaires_' || {r}.status", "1", "1"),
+        ]),
+        'tender_exports': ('status, sent_at', [
+            (sql_local_day("{r}.sent_at"), "'exports_completed'", "1", "{r}.status = 'completed'"),
+        ]),
+        'manager_messages': ('created_at', [
+            (sql_local_day("{r}.created_at"), "'manager_messages'", "1", "1"),
+        ]),
+        'manual_mailings': ('sent_count, feedback_count, created_at', [
+            (sql_local_day("{r}.created_at"), "'mailings_count'", "1", "1"),
+            (sql_local_day("{r}.created_at"), "'mailings_sent'", "{r}.sent_count", "1"),
+            (sql_local_day("{r}.created_at"), "'mailings_feedback'", "{r}.feedback_count", "1"),
+        ]),
+        'mailing_feedback': ('feedback_type, created_at', [
+            (sql_local_day("{r}.created_at"), "'feedback_total'", "1", "1"),
+            (sql_local_day("{r}.created_at"), "'feedback_' || {r}.feedback_type", "1", "1"),
+        ]),
+    }
+    
+    def _migrate_base_schema(self, conn):
+        """Миграция 1: базовые таблицы бота"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
         
         # Пользователи - добавляем поле для управления рассылкой
-        cursor.execute('''
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER UNIQUE,
@@ -187,7 +683,7 @@ class Database:
         ''')
         
         # Анкеты (отдельная таблица для истории) с статусом
-        cursor.execute('''
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS questionnaires (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -206,7 +702,7 @@ class Database:
         ''')
         
         # Выгрузки тендеров - УПРОЩЕННАЯ ВЕРСИЯ
-        cursor.execute('''
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS tender_exports (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -224,7 +720,7 @@ class Database:
         ''')
         
         # Рассылки (ручные) - основная таблица
-        cursor.execute('''
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS manual_mailings (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             admin_id INTEGER,
@@ -240,7 +736,7 @@ class Database:
         ''')
         
         # Отправленные сообщения рассылки (каждому пользователю)
-        cursor.execute('''
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS sent_messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             mailing_id INTEGER,
@@ -252,7 +748,7 @@ class Database:
         ''')
         
         # Обратная связь по рассылкам
-        cursor.execute('''
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS mailing_feedback (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             mailing_id INTEGER,
@@ -265,7 +761,7 @@ class Database:
         ''')
         
         # Сообщения менеджеру
-        cursor.execute('''
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS manager_messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -280,7 +776,7 @@ class Database:
         ''')
         
         # Запросы контактов для выгрузок
-        cursor.execute('''
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS contact_requests (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -290,267 +786,503 @@ class Database:
             completed_at TIMESTAMP
         )
         ''')
+    
+    def _migrate_hot_query_indexes(self, conn):
+        """Миграция 2: вторичные индексы под горячие запросы"""
+        for statement in (
+            # get_exports_for_followup: status / follow_up_sent / sent_at
+            '''CREATE INDEX IF NOT EXISTS idx_tender_exports_followup
+               ON tender_exports (status, follow_up_sent, follow_up_scheduled, sent_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_tender_exports_user
+               ON tender_exports (user_id, sent_at)''',
+            # get_sent_message_by_telegram_id: (user_id, telegram_message_id)
+            '''CREATE INDEX IF NOT EXISTS idx_sent_messages_user_message
+               ON sent_messages (user_id, telegram_message_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_sent_messages_mailing
+               ON sent_messages (mailing_id)''',
+            # get_mailing_feedback: mailing_id
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_feedback_mailing
+               ON mailing_feedback (mailing_id, created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_feedback_user
+               ON mailing_feedback (user_id, created_at)''',
+            # Входящие менеджера: processed / created_at
+            '''CREATE INDEX IF NOT EXISTS idx_manager_messages_inbox
+               ON manager_messages (processed, created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_manager_messages_user
+               ON manager_messages (user_id)''',
+            # has_complete_questionnaire / get_last_complete_questionnaire: (user_id, status)
+            '''CREATE INDEX IF NOT EXISTS idx_questionnaires_user_status
+               ON questionnaires (user_id, status, created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_questionnaires_status
+               ON questionnaires (status, created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_contact_requests_export
+               ON contact_requests (export_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_users_created
+               ON users (created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_manual_mailings_created
+               ON manual_mailings (created_at)''',
+        ):
+            conn.execute(statement)
+    
+    def _migrate_epoch_timestamps(self, conn):
+        """Миграция 3: колонки *_at переводятся в INTEGER (эпоха UTC) с индексами под диапазоны"""
+        for table in ('users', 'questionnaires', 'tender_exports', 'manual_mailings',
+                      'sent_messages', 'mailing_feedback', 'manager_messages',
+                      'contact_requests', 'schema_version'):
+            timestamp_columns = [
+                row['name'] for row in conn.execute(f'PRAGMA table_info({table})')
+                if row['type'] == 'TIMESTAMP'
+            ]
+            self._rebuild_table(conn, table, {
+                column: f"CASE WHEN typeof({column}) = 'text' "
+                        f"THEN CAST(strftime('%s', {column}) AS INTEGER) ELSE {column} END"
+                for column in timestamp_columns
+            })
+        
+        # Индексы удалены вместе со старыми таблицами
+        self._migrate_hot_query_indexes(conn)
+        for statement in (
+            # get_statistics / отчеты за период: полуинтервалы по времени
+            '''CREATE INDEX IF NOT EXISTS idx_tender_exports_status_sent
+               ON tender_exports (status, sent_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_manager_messages_created
+               ON manager_messages (created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_questionnaires_created
+               ON questionnaires (created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_feedback_created
+               ON mailing_feedback (created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_feedback_type
+               ON mailing_feedback (feedback_type, created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_users_audience_created
+               ON users (is_active, mailing_subscribed, created_at)''',
+        ):
+            conn.execute(statement)
+    
+    def _migrate_stats_counters(self, conn):
+        """Миграция 4: таблица stats_counters, триггеры и заполнение по существующим данным"""
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            day INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric)
+        ) WITHOUT ROWID
+        ''')
         
-        conn.commit()
-        conn.close()
-        logger.info("✅ База данных инициализирована")
+        upsert = '''
+            INSERT INTO stats_counters (day, metric, value)
+            SELECT {day}, {metric}, {delta} WHERE {when}
+            ON CONFLICT (day, metric) DO UPDATE SET value = value + excluded.value;'''
+        
+        for table, (columns, contributions) in self.STATS_CONTRIBUTIONS.items():
+            def steps(row: str, sign: str):
+                return ''.join(
+                    upsert.format(day=day.format(r=row), metric=metric.format(r=row),
+                                  delta=f"{sign}({delta.format(r=row)})", when=when.format(r=row))
+                    for day, metric, delta, when in contributions
+                )
+            
+            for event, body in (
+                ('INSERT', steps('NEW', '+')),
+                ('DELETE', steps('OLD', '-')),
+                (f'UPDATE OF {columns}', steps('OLD', '-') + steps('NEW', '+')),
+            ):
+                name = f"trg_stats_{table}_{event.split()[0].lower()}"
+                conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+                conn.execute(f'CREATE TRIGGER {name} AFTER {event} ON {table} BEGIN {body} END')
+            
+            # Заполнение счетчиков по уже накопленным строкам
+            for day, metric, delta, when in contributions:
+                conn.execute(f'''
+                INSERT INTO stats_counters (day, metric, value)
+                SELECT {day.format(r='t')}, {metric.format(r='t')}, SUM({delta.format(r='t')})
+                FROM {table} AS t
+                WHERE {when.format(r='t')}
+                GROUP BY 1, 2
+                ON CONFLICT (day, metric) DO UPDATE SET value = value + excluded.value
+                ''')
+    
+    def _migrate_local_day_counters(self, conn):
+        """Миграция 12: счетчики по местным суткам вместо суток UTC - пересчет с нуля"""
+        self._rebuild_stats_counters(conn)
+    
+    def _rebuild_stats_counters(self, conn):
+        """Пересчет stats_counters с нуля по исходным таблицам"""
+        conn.execute('DELETE FROM stats_counters')
+        self._migrate_stats_counters(conn)
+    
+    def recompute_stats_counters(self):
+        """Пересчет дневных счетчиков статистики в текущем часовом поясе процесса.
+        
+        Нужен после смены часового пояса сервера (TZ): дни уже записанных
+        событий посчитаны по старым местным суткам. Запуск при остановленном боте:
+        python -c "import main; main.Database(main.DB_PATH).recompute_stats_counters()"
+        """
+        with self.transaction() as conn:
+            self._rebuild_stats_counters(conn)
+        logger.info("📊 Счетчики статистики пересчитаны по местным суткам")
+    
+    def _migrate_audience_index(self, conn):
+        """Миграция 5: индекс под постраничный обход аудитории (keyset по user_id)"""
+        conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_users_audience
+        ON users (is_active, mailing_subscribed, user_id)
+        ''')
+    
+    def _migrate_mailing_jobs(self, conn):
+        """Миграция 6: статус рассылки и очередь получателей с состоянием каждой отправки"""
+        # Уже отправленные рассылки считаются завершенными
+        self._add_column(conn, 'manual_mailings', 'status', "TEXT DEFAULT 'done'")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS mailing_recipients (
+            mailing_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            telegram_message_id INTEGER,
+            sent_message_id INTEGER,
+            error TEXT,
+            updated_at INTEGER,
+            PRIMARY KEY (mailing_id, user_id)
+        ) WITHOUT ROWID
+        ''')
+        for statement in (
+            # Очередь рассылки: (mailing_id, state) + keyset по user_id
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_recipients_state
+               ON mailing_recipients (mailing_id, state, user_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_manual_mailings_status
+               ON manual_mailings (status)''',
+        ):
+            conn.execute(statement)
+    
+    def _migrate_mailing_media(self, conn):
+        """Миграция 7: вложения рассылки (JSON-список типов и file_id)"""
+        self._add_column(conn, 'manual_mailings', 'media', 'TEXT')
+    
+    def _migrate_scheduled_mailings(self, conn):
+        """Миграция 8: расписание рассылок (срок и окно доставки в рабочее время)"""
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS scheduled_mailings (
+            mailing_id INTEGER PRIMARY KEY,
+            run_at INTEGER NOT NULL,
+            working_hours_only INTEGER DEFAULT 0,
+            created_at INTEGER DEFAULT ({SQL_NOW_TS})
+        )
+        ''')
     
+    def _migrate_user_updated_at(self, conn):
+        """Миграция 9: время изменения пользователя для инкрементального обновления сегментов"""
+        self._add_column(conn, 'users', 'updated_at', 'INTEGER')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_users_updated ON users (updated_at)')
+        conn.execute('DROP TRIGGER IF EXISTS trg_users_touch')
+        conn.execute(f'''
+        CREATE TRIGGER trg_users_touch AFTER UPDATE OF {SEGMENT_COLUMNS} ON users
+        BEGIN
+            UPDATE users SET updated_at = {SQL_NOW_TS} WHERE id = NEW.id;
+        END
+        ''')
+    
+    def _migrate_jobs(self, conn):
+        """Миграция 10: очередь отложенных задач (уведомления, follow-up, запросы контактов)"""
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{{}}',
+            job_key TEXT UNIQUE,
+            status TEXT NOT NULL DEFAULT 'queued',
+            run_at INTEGER NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            max_attempts INTEGER DEFAULT 8,
+            last_error TEXT,
+            created_at INTEGER DEFAULT ({SQL_NOW_TS}),
+            updated_at INTEGER
+        )
+        ''')
+        # Диспетчер выбирает наступившие задачи: (status, run_at)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, run_at)')
+    
+    def _migrate_admin_events(self, conn):
+        """Миграция 11: события, копящиеся до очередной сводки администратору"""
+        conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS admin_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            mailing_id INTEGER,
+            user_id INTEGER,
+            username TEXT,
+            details TEXT,
+            created_at INTEGER DEFAULT ({SQL_NOW_TS})
+        )
+        ''')
+    
+    @staticmethod
+    def _rebuild_table(conn, table: str, conversions: dict):
+        """Пересоздание таблицы: колонки TIMESTAMP становятся INTEGER с умолчанием «сейчас»"""
+        create_sql = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()['sql']
+        create_sql = re.sub(r'TIMESTAMP DEFAULT CURRENT_TIMESTAMP',
+                            f'INTEGER DEFAULT ({SQL_NOW_TS})', create_sql)
+        create_sql = re.sub(r'\bTIMESTAMP\b', 'INTEGER', create_sql)
+        create_sql = re.sub(rf'\b{table}\b', f'{table}_new', create_sql, count=1)
+        
+        columns = [row['name'] for row in conn.execute(f'PRAGMA table_info({table})')]
+        select_list = ', '.join(conversions.get(column, column) for column in columns)
+        
+        conn.execute(f'DROP TABLE IF EXISTS {table}_new')
+        conn.execute(create_sql)
+        conn.execute(f'INSERT INTO {table}_new ({", ".join(columns)}) SELECT {select_list} FROM {table}')
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+    
+    @_invalidates_user
     def add_user(self, user_id: int, username: str, first_name: str, last_name: str = ""):
         """Добавление пользователя"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
-        VALUES (?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name))
+        with self.transaction() as conn:
+            conn.execute('''
+            INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+            ''', (user_id, username, first_name, last_name))
         
-        conn.commit()
-        conn.close()
         return True
     
+    @_invalidates_user
+    def update_user_phone(self, user_id: int, phone: str):
+        """Сохранение телефона пользователя"""
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE users
+            SET phone = ?
+            WHERE user_id = ?
+            ''', (phone, user_id))
+    
+    @_invalidates_user
     def save_questionnaire_partial(self, user_id: int, data: dict):
         """Сохранение частичной анкеты (только вопросы 1-4)"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO questionnaires 
-        (user_id, activity, region, budget, keywords, status)
-        VALUES (?, ?, ?, ?, ?, 'partial')
-        ''', (
-            user_id,
-            data.get('activity'),
-            data.get('region'),
-            data.get('budget'),
-            data.get('keywords')
-        ))
-        
-        conn.commit()
-        last_id = cursor.lastrowid
-        
-        cursor.execute('''
-        UPDATE users 
-        SET activity = ?, region = ?, has_filled_questionnaire = 1
-        WHERE user_id = ?
-        ''', (
-            data.get('activity'),
-            data.get('region'),
-            user_id
-        ))
-        
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO questionnaires
+            (user_id, activity, region, budget, keywords, status)
+            VALUES (?, ?, ?, ?, ?, 'partial')
+            ''', (
+                user_id,
+                data.get('activity'),
+                data.get('region'),
+                data.get('budget'),
+                data.get('keywords')
+            ))
+            
+            last_id = cursor.lastrowid
+            
+            conn.execute('''
+            UPDATE users
+            SET activity = ?, region = ?, has_filled_questionnaire = 1
+            WHERE user_id = ?
+            ''', (
+                data.get('activity'),
+                data.get('region'),
+                user_id
+            ))
         
         return last_id
     
+    @_invalidates_user
     def save_questionnaire(self, user_id: int, data: dict, anketa_path: str = None):
         """Сохранение полной анкеты (все 8 вопросов)"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO questionnaires 
-        (user_id, full_name, company_name, phone, email, activity, region, budget, keywords, filled_anketa_path, status)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'complete')
-        ''', (
-            user_id,
-            data.get('full_name'),
-            data.get('company_name'),
-            data.get('phone'),
-            data.get('email'),
-            data.get('activity'),
-            data.get('region'),
-            data.get('budget'),
-            data.get('keywords'),
-            anketa_path
-        ))
-        
-        conn.commit()
-        last_id = cursor.lastrowid
-        
-        cursor.execute('''
-        UPDATE users 
-        SET phone = ?, email = ?, company = ?, activity = ?, region = ?, has_filled_questionnaire = 1
-        WHERE user_id = ?
-        ''', (
-            data.get('phone'),
-            data.get('email'),
-            data.get('company_name'),
-            data.get('activity'),
-            data.get('region'),
-            user_id
-        ))
-        
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO questionnaires
+            (user_id, full_name, company_name, phone, email, activity, region, budget, keywords, filled_anketa_path, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'complete')
+            ''', (
+                user_id,
+                data.get('full_name'),
+                data.get('company_name'),
+                data.get('phone'),
+                data.get('email'),
+                data.get('activity'),
+                data.get('region'),
+                data.get('budget'),
+                data.get('keywords'),
+                anketa_path
+            ))
+            
+            last_id = cursor.lastrowid
+            
+            conn.execute('''
+            UPDATE users
+            SET phone = ?, email = ?, company = ?, activity = ?, region = ?, has_filled_questionnaire = 1
+            WHERE user_id = ?
+            ''', (
+                data.get('phone'),
+                data.get('email'),
+                data.get('company_name'),
+                data.get('activity'),
+                data.get('region'),
+                user_id
+            ))
         
         return last_id
     
+    @_invalidates_user
     def update_partial_to_complete(self, user_id: int, data: dict):
         """Обновление частичной анкеты до полной (добавление контактов)"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE questionnaires 
-        SET company_name = ?, full_name = ?, phone = ?, email = ?, status = 'complete'
-        WHERE user_id = ? AND status = 'partial'
-        ''', (
-            data.get('company_name'),
-            data.get('full_name'),
-            data.get('phone'),
-            data.get('email'),
-            user_id
-        ))
-        
-        cursor.execute('''
-        UPDATE users 
-        SET phone = ?, email = ?, company = ?
-        WHERE user_id = ?
-        ''', (
-            data.get('phone'),
-            data.get('email'),
-            data.get('company_name'),
-            user_id
-        ))
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE questionnaires
+            SET company_name = ?, full_name = ?, phone = ?, email = ?, status = 'complete'
+            WHERE user_id = ? AND status = 'partial'
+            ''', (
+                data.get('company_name'),
+                data.get('full_name'),
+                data.get('phone'),
+                data.get('email'),
+                user_id
+            ))
+            
+            conn.execute('''
+            UPDATE users
+            SET phone = ?, email = ?, company = ?
+            WHERE user_id = ?
+            ''', (
+                data.get('phone'),
+                data.get('email'),
+                data.get('company_name'),
+                user_id
+            ))
         
-        conn.commit()
-        conn.close()
         return True
     
     def create_tender_export(self, user_id: int, file_path: str = None, file_name: str = None):
         """Создание записи о выгрузке тендеров - УПРОЩЕННАЯ ВЕРСИЯ"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO tender_exports 
-        (user_id, file_path, file_name, follow_up_scheduled)
-        VALUES (?, ?, ?, ?)
-        ''', (user_id, file_path, file_name, 1))
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO tender_exports
+            (user_id, file_path, file_name, follow_up_scheduled)
+            VALUES (?, ?, ?, ?)
+            ''', (user_id, file_path, file_name, 1))
         
-        conn.commit()
-        export_id = cursor.lastrowid
-        conn.close()
-        
-        return export_id
+        return cursor.lastrowid
     
     def mark_export_completed(self, export_id: int, admin_name: str = "Олег"):
-        """Отметка выполнения выгрузки администратором"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE tender_exports 
-        SET sent_by = ?, status = 'completed', admin_notified = 1
-        WHERE id = ?
-        ''', (admin_name, export_id))
-        
-        conn.commit()
-        conn.close()
+        """Отметка выполнения выгрузки администратором (sent_at выгрузки - отсчет follow-up)"""
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE tender_exports
+            SET sent_by = ?, status = 'completed', admin_notified = 1
+            WHERE id = ?
+            ''', (admin_name, export_id))
+            export = conn.execute('SELECT sent_at FROM tender_exports WHERE id = ?', (export_id,)).fetchone()
+        
+        return export['sent_at'] if export else None
+    
+    def cancel_export(self, export_id: int):
+        """Отмена выгрузки"""
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE tender_exports
+            SET status = 'cancelled'
+            WHERE id = ?
+            ''', (export_id,))
     
     def save_export_file(self, export_id: int, file_path: str, file_name: str):
         """Сохранение пути к файлу выгрузки"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE tender_exports 
-        SET file_path = ?, file_name = ?, status = 'pending'
-        WHERE id = ?
-        ''', (file_path, file_name, export_id))
-        
-        conn.commit()
-        conn.close()
-    
-    def get_exports_for_followup(self):
-        """Получение выгрузок, для которых нужно отправить follow-up"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        one_hour_ago = (datetime.now() - timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S')
-        
-        cursor.execute('''
-        SELECT te.*, u.username, u.first_name, u.last_name
-        FROM tender_exports te
-        JOIN users u ON te.user_id = u.user_id
-        WHERE te.status = 'completed' 
-        AND te.follow_up_scheduled = 1
-        AND te.follow_up_sent = 0
-        AND te.sent_at <= ?
-        ''', (one_hour_ago,))
-        
-        exports = cursor.fetchall()
-        conn.close()
-        
-        return exports
-    
-    def mark_followup_sent(self, export_id: int):
-        """Отметка, что follow-up отправлен"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE tender_exports 
-        SET follow_up_sent = 1, follow_up_at = datetime('now')
-        WHERE id = ?
-        ''', (export_id,))
-        
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE tender_exports
+            SET file_path = ?, file_name = ?, status = 'pending'
+            WHERE id = ?
+            ''', (file_path, file_name, export_id))
+    
+    def get_exports_for_followup(self, delay: int = 3600, limit: int = None, after_id: int = 0):
+        """Выгрузки, для которых нужно отправить follow-up (через delay сек после выгрузки):
+        пачка из limit штук по возрастанию ID после after_id"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT te.*, u.username, u.first_name, u.last_name
+            FROM tender_exports te
+            JOIN users u ON te.user_id = u.user_id
+            WHERE te.status = 'completed'
+            AND te.follow_up_scheduled = 1
+            AND te.follow_up_sent = 0
+            AND te.sent_at <= ?
+            AND te.id > ?
+            ORDER BY te.id
+            LIMIT ?
+            ''', (now_ts() - delay, after_id, limit or -1)).fetchall()
+    
+    def get_pending_followups(self):
+        """Выгрузки, ожидающие follow-up: (id, sent_at) - для таймеров при запуске"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT id, sent_at
+            FROM tender_exports
+            WHERE status = 'completed'
+            AND follow_up_scheduled = 1
+            AND follow_up_sent = 0
+            ''').fetchall()
+    
+    def get_export_for_followup(self, export_id: int):
+        """Выгрузка с данными пользователя, если follow-up по ней еще не отправлен"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT te.*, u.username, u.first_name, u.last_name
+            FROM tender_exports te
+            JOIN users u ON te.user_id = u.user_id
+            WHERE te.id = ?
+            AND te.status = 'completed'
+            AND te.follow_up_scheduled = 1
+            AND te.follow_up_sent = 0
+            ''', (export_id,)).fetchone()
+    
+    def mark_followups_sent(self, export_ids: list):
+        """Отметка, что follow-up по выгрузкам отправлен (одна транзакция на пачку)"""
+        now = now_ts()
+        with self.transaction() as conn:
+            for start in range(0, len(export_ids), 500):
+                batch = list(export_ids[start:start + 500])
+                conn.execute(f'''
+                UPDATE tender_exports
+                SET follow_up_sent = 1, follow_up_at = ?
+                WHERE id IN ({", ".join("?" * len(batch))})
+                ''', [now, *batch])
     
     def save_followup_response(self, export_id: int, response: str):
         """Сохранение ответа на follow-up"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE tender_exports 
-        SET follow_up_response = ?
-        WHERE id = ?
-        ''', (response, export_id))
-        
-        conn.commit()
-        conn.close()
-    
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE tender_exports
+            SET follow_up_response = ?
+            WHERE id = ?
+            ''', (response, export_id))
+    
+    @_invalidates_user
     def toggle_user_mailing_subscription(self, user_id: int):
         """Включение/выключение подписки на рассылку"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT mailing_subscribed FROM users WHERE user_id = ?', (user_id,))
-        current = cursor.fetchone()
-        
-        if current:
+        with self.transaction() as conn:
+            current = conn.execute('SELECT mailing_subscribed FROM users WHERE user_id = ?', (user_id,)).fetchone()
+            
+            if not current:
+                return None
+            
             new_status = not bool(current[0])
-            cursor.execute('''
-            UPDATE users 
+            conn.execute('''
+            UPDATE users
             SET mailing_subscribed = ?
             WHERE user_id = ?
             ''', (1 if new_status else 0, user_id))
-            
-            conn.commit()
-            conn.close()
-            return new_status
         
-        conn.close()
-        return None
+        return new_status
     
+    @_user_cached
     def get_user_mailing_status(self, user_id: int):
         """Получение статуса подписки на рассылку"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT mailing_subscribed, username, first_name, last_name 
-        FROM users 
-        WHERE user_id = ?
-        ''', (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            result = conn.execute('''
+            SELECT mailing_subscribed, username, first_name, last_name
+            FROM users
+            WHERE user_id = ?
+            ''', (user_id,)).fetchone()
         
         if result:
             return {
@@ -561,517 +1293,1181 @@ class Database:
             }
         return None
     
+    def deactivate_users(self, user_ids: list):
+        """Деактивация пользователей, которым нельзя доставить сообщение (пачкой UPDATE)"""
+        with self.transaction() as conn:
+            for start in range(0, len(user_ids), 500):
+                batch = list(user_ids[start:start + 500])
+                conn.execute(f'''
+                UPDATE users
+                SET is_active = 0
+                WHERE is_active = 1 AND user_id IN ({", ".join("?" * len(batch))})
+                ''', batch)
+            
+            def invalidate():
+                for user_id in user_ids:
+                    self.user_cache.invalidate(user_id)
+            
+            self.pool.after_commit(invalidate)
+        
+        return len(user_ids)
+    
+    # Фильтры аудитории общие для всех бэкендов (storage.USER_FILTERS)
+    USER_FILTERS = USER_FILTERS
+    USER_FILTER_COLUMNS = USER_FILTER_COLUMNS
+    
+    def _user_filter(self, filter_type: str):
+        """Условие и параметры фильтра аудитории (None для неизвестного фильтра)"""
+        if filter_type not in self.USER_FILTERS:
+            return None
+        condition, params = self.USER_FILTERS[filter_type]
+        return condition, tuple(params()) if params else ()
+    
+    def _recipient_filter(self, filter_type: str, user_ids: Optional[list] = None):
+        """Фильтр очереди получателей: для сегмента - активные подписчики из списка user_ids"""
+        if filter_type.startswith(SEGMENT_FILTER_PREFIX):
+            return self._user_filter("all") if user_ids is not None else None
+        return self._user_filter(filter_type)
+    
     def get_users_by_filter(self, filter_type: str):
         """Получение пользователей по фильтру с учетом подписки"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        if filter_type == "all":
-            cursor.execute('''
-            SELECT user_id, username, first_name, last_name, company, mailing_subscribed
-            FROM users 
-            WHERE is_active = 1 AND mailing_subscribed = 1
-            ''')
-        elif filter_type == "with_questionnaire":
-            cursor.execute('''
-            SELECT user_id, username, first_name, last_name, company, mailing_subscribed
-            FROM users 
-            WHERE is_active = 1 AND has_filled_questionnaire = 1 AND mailing_subscribed = 1
-            ''')
-        elif filter_type == "without_questionnaire":
-            cursor.execute('''
-            SELECT user_id, username, first_name, last_name, company, mailing_subscribed
-            FROM users 
-            WHERE is_active = 1 AND has_filled_questionnaire = 0 AND mailing_subscribed = 1
-            ''')
-        elif filter_type == "recent_week":
-            cursor.execute('''
-            SELECT user_id, username, first_name, last_name, company, mailing_subscribed
-            FROM users 
-            WHERE is_active = 1 AND mailing_subscribed = 1 
-            AND date(created_at) >= date('now', '-7 days')
-            ''')
-        elif filter_type == "subscribed":
-            cursor.execute('''
-            SELECT user_id, username, first_name, last_name, company, mailing_subscribed
-            FROM users 
-            WHERE is_active = 1 AND mailing_subscribed = 1
-            ''')
-        elif filter_type == "unsubscribed":
-            cursor.execute('''
-            SELECT user_id, username, first_name, last_name, company, mailing_subscribed
-            FROM users 
-            WHERE is_active = 1 AND mailing_subscribed = 0
-            ''')
-        else:
-            conn.close()
+        user_filter = self._user_filter(filter_type)
+        if not user_filter:
+            return []
+        
+        condition, params = user_filter
+        with self.connection() as conn:
+            return conn.execute(f'''
+            SELECT {self.USER_FILTER_COLUMNS}
+            FROM users
+            WHERE {condition}
+            ORDER BY user_id
+            ''', params).fetchall()
+    
+    def count_users_by_filter(self, filter_type: str):
+        """Количество пользователей по фильтру (для предпросмотра рассылки)"""
+        user_filter = self._user_filter(filter_type)
+        if not user_filter:
+            return 0
+        
+        condition, params = user_filter
+        with self.connection() as conn:
+            return conn.execute(f'''
+            SELECT COUNT(*) FROM users
+            WHERE {condition}
+            ''', params).fetchone()[0]
+    
+    def get_users_page(self, filter_type: str, after_user_id: int = 0, limit: int = RECIPIENT_PAGE_SIZE):
+        """Страница пользователей по фильтру: keyset по user_id"""
+        user_filter = self._user_filter(filter_type)
+        if not user_filter:
             return []
         
-        users = cursor.fetchall()
-        conn.close()
+        condition, params = user_filter
+        with self.connection() as conn:
+            return conn.execute(f'''
+            SELECT {self.USER_FILTER_COLUMNS}
+            FROM users
+            WHERE {condition} AND user_id > ?
+            ORDER BY user_id
+            LIMIT ?
+            ''', params + (after_user_id, limit)).fetchall()
+    
+    def iter_users_by_filter(self, filter_type: str, page_size: int = RECIPIENT_PAGE_SIZE):
+        """Потоковый обход пользователей по фильтру страницами фиксированного размера"""
+        after_user_id = 0
+        while True:
+            page = self.get_users_page(filter_type, after_user_id, page_size)
+            yield from page
+            if len(page) < page_size:
+                return
+            after_user_id = page[-1]['user_id']
+    
+    def _keyset_page(self, query: str, params: tuple, keys: tuple, cursor: tuple = None,
+                     direction: str = "next", limit: int = ADMIN_PAGE_SIZE):
+        """Страница keyset-пагинации, новые сверху: (строки, есть_предыдущая, есть_следующая).
         
-        return users
+        query - SELECT с WHERE без сортировки, keys - колонки ключа сортировки,
+        cursor - значения ключа крайней строки текущей страницы.
+        """
+        backwards = cursor is not None and direction == "prev"
+        if cursor is not None:
+            placeholders = ", ".join("?" * len(keys))
+            query += f" AND ({', '.join(keys)}) {'>' if backwards else '<'} ({placeholders})"
+            params = tuple(params) + tuple(cursor)
+        
+        order = "ASC" if backwards else "DESC"
+        query += " ORDER BY " + ", ".join(f"{key} {order}" for key in keys) + " LIMIT ?"
+        
+        with self.connection() as conn:
+            rows = conn.execute(query, tuple(params) + (limit + 1,)).fetchall()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            return rows[::-1], has_more, True
+        return rows, cursor is not None, has_more
+    
+    def get_user_segment_rows(self, after_id: int = 0, updated_since: int = 0):
+        """Строки пользователей для сегментов: новые (id > after_id) и измененные начиная с updated_since"""
+        with self.connection() as conn:
+            return conn.execute(f'''
+            SELECT id, user_id, created_at, {SEGMENT_COLUMNS}
+            FROM users
+            WHERE id > ? OR updated_at >= ?
+            ''', (after_id, updated_since)).fetchall()
+    
+    def get_subscription_users_page(self, filter_type: str = "all", cursor: tuple = None,
+                                    direction: str = "next", limit: int = ADMIN_PAGE_SIZE):
+        """Страница пользователей для управления подписками (all / subscribed / unsubscribed)"""
+        condition = "is_active = 1"
+        if filter_type in ("subscribed", "unsubscribed"):
+            condition = self.USER_FILTERS[filter_type][0]
+        
+        return self._keyset_page(f'''
+            SELECT id, user_id, username, first_name, last_name, company,
+                   mailing_subscribed, has_filled_questionnaire, created_at
+            FROM users
+            WHERE {condition}
+            ''', (), ("id",), cursor, direction, limit)
     
     def get_all_users_with_subscription(self, limit: int = 50):
         """Получение всех пользователей с информацией о подписке"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT user_id, username, first_name, last_name, company, 
-               mailing_subscribed, has_filled_questionnaire, created_at
-        FROM users 
-        WHERE is_active = 1
-        ORDER BY created_at DESC
-        LIMIT ?
-        ''', (limit,))
-        
-        users = cursor.fetchall()
-        conn.close()
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT user_id, username, first_name, last_name, company,
+                   mailing_subscribed, has_filled_questionnaire, created_at
+            FROM users
+            WHERE is_active = 1
+            ORDER BY created_at DESC
+            LIMIT ?
+            ''', (limit,)).fetchall()
+    
+    def get_user_activity_summary(self, user_id: int):
+        """Пользователь со сводкой активности (анкеты, выгрузки, сообщения, отзывы)"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT u.*,
+                   COUNT(DISTINCT q.id) as questionnaire_count,
+                   COUNT(DISTINCT te.id) as export_count,
+                   COUNT(DISTINCT mm.id) as message_count,
+                   COUNT(DISTINCT mf.id) as feedback_count
+            FROM users u
+            LEFT JOIN questionnaires q ON u.user_id = q.user_id
+            LEFT JOIN tender_exports te ON u.user_id = te.user_id
+            LEFT JOIN manager_messages mm ON u.user_id = mm.user_id
+            LEFT JOIN mailing_feedback mf ON u.user_id = mf.user_id
+            WHERE u.user_id = ?
+            GROUP BY u.user_id
+            ''', (user_id,)).fetchone()
+    
+    def get_subscription_stats(self):
+        """Статистика подписок активных пользователей"""
+        with self.connection() as conn:
+            stats = conn.execute('''
+            SELECT
+                COUNT(*) as total_users,
+                SUM(CASE WHEN mailing_subscribed = 1 THEN 1 ELSE 0 END) as subscribed,
+                SUM(CASE WHEN mailing_subscribed = 0 THEN 1 ELSE 0 END) as unsubscribed,
+                SUM(CASE WHEN has_filled_questionnaire = 1 THEN 1 ELSE 0 END) as with_anketa,
+                SUM(CASE WHEN has_filled_questionnaire = 0 THEN 1 ELSE 0 END) as without_anketa
+            FROM users
+            WHERE is_active = 1
+            ''').fetchone()
+            
+            recent = conn.execute('''
+            SELECT COUNT(*) as recent_unsubscribes
+            FROM mailing_feedback
+            WHERE feedback_type = 'unsubscribe'
+            AND created_at >= ? AND created_at < ?
+            ''', period_bounds(30)).fetchone()
         
-        return users
+        return {
+            'total_users': stats['total_users'] or 0,
+            'subscribed': stats['subscribed'] or 0,
+            'unsubscribed': stats['unsubscribed'] or 0,
+            'with_anketa': stats['with_anketa'] or 0,
+            'without_anketa': stats['without_anketa'] or 0,
+            'recent_unsubscribes': recent['recent_unsubscribes'] or 0
+        }
     
     def create_manual_mailing(self, admin_id: int, mailing_text: str, mailing_type: str, filter_criteria: str):
         """Создание ручной рассылки"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO manual_mailings (admin_id, mailing_text, mailing_type, filter_criteria)
+            VALUES (?, ?, ?, ?)
+            ''', (admin_id, mailing_text, mailing_type, filter_criteria))
         
-        cursor.execute('''
-        INSERT INTO manual_mailings (admin_id, mailing_text, mailing_type, filter_criteria)
-        VALUES (?, ?, ?, ?)
-        ''', (admin_id, mailing_text, mailing_type, filter_criteria))
-        
-        conn.commit()
-        mailing_id = cursor.lastrowid
-        conn.close()
-        
-        return mailing_id
+        return cursor.lastrowid
     
     def save_sent_message(self, mailing_id: int, user_id: int, telegram_message_id: int):
         """Сохранение отправленного сообщения"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO sent_messages (mailing_id, user_id, telegram_message_id)
-        VALUES (?, ?, ?)
-        ''', (mailing_id, user_id, telegram_message_id))
-        
-        conn.commit()
-        message_id = cursor.lastrowid
-        conn.close()
-        
-        return message_id
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO sent_messages (mailing_id, user_id, telegram_message_id)
+            VALUES (?, ?, ?)
+            ''', (mailing_id, user_id, telegram_message_id))
+        
+        return cursor.lastrowid
+    
+    def get_sent_message(self, sent_message_id: int, user_id: int):
+        """Получение отправленного сообщения рассылки пользователя"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT sm.*, mm.mailing_text, mm.id as mailing_id
+            FROM sent_messages sm
+            JOIN manual_mailings mm ON sm.mailing_id = mm.id
+            WHERE sm.id = ? AND sm.user_id = ?
+            ''', (sent_message_id, user_id)).fetchone()
     
     def update_mailing_stats(self, mailing_id: int, sent_count: int, failed_count: int):
         """Обновление статистики рассылки"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE manual_mailings 
-        SET sent_count = ?, failed_count = ?, sent_at = datetime('now')
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE manual_mailings
+            SET sent_count = ?, failed_count = ?, sent_at = ?
+            WHERE id = ?
+            ''', (sent_count, failed_count, now_ts(), mailing_id))
+    
+    def create_mailing_job(self, admin_id: int, mailing_text: str, filter_type: str,
+                           media: Optional[list] = None, user_ids: Optional[list] = None):
+        """Создание рассылки с очередью получателей по фильтру: (ID рассылки, число получателей).
+        
+        Для сегмента (SEGMENT_FILTER_PREFIX) получатели передаются в user_ids.
+        """
+        user_filter = self._recipient_filter(filter_type, user_ids)
+        if not user_filter:
+            return None, 0
+        
+        with self.transaction() as conn:
+            mailing_id = conn.execute('''
+            INSERT INTO manual_mailings (admin_id, mailing_text, mailing_type, filter_criteria, media, status)
+            VALUES (?, ?, ?, '{}', ?, 'running')
+            ''', (admin_id, mailing_text, filter_type, json.dumps(media) if media else None)).lastrowid
+            
+            recipients = self._enqueue_recipients(conn, mailing_id, user_filter, user_ids)
+        
+        return mailing_id, recipients
+    
+    @staticmethod
+    def _enqueue_recipients(conn, mailing_id: int, user_filter: tuple, user_ids: Optional[list] = None) -> int:
+        """Заполнение очереди получателей рассылки по фильтру (число получателей)"""
+        condition, params = user_filter
+        if user_ids is None:
+            recipients = conn.execute(f'''
+            INSERT INTO mailing_recipients (mailing_id, user_id)
+            SELECT ?, user_id FROM users
+            WHERE {condition}
+            ''', (mailing_id,) + params).rowcount
+        else:
+            # Список сегмента сверяется с фильтром: пользователь мог отписаться после предпросмотра
+            recipients = conn.executemany(f'''
+            INSERT INTO mailing_recipients (mailing_id, user_id)
+            SELECT ?, user_id FROM users
+            WHERE {condition} AND user_id = ?
+            ''', ((mailing_id, *params, user_id) for user_id in user_ids)).rowcount
+        
+        conn.execute('''
+        UPDATE manual_mailings
+        SET filter_criteria = ?
         WHERE id = ?
-        ''', (sent_count, failed_count, mailing_id))
+        ''', (json.dumps({"user_count": recipients}), mailing_id))
+        return recipients
+    
+    def schedule_mailing(self, admin_id: int, mailing_text: str, filter_type: str, media: Optional[list],
+                         run_at: int, working_hours_only: bool = False):
+        """Отложенная рассылка: получатели выбираются по фильтру в момент отправки (ID рассылки)"""
+        if not filter_type.startswith(SEGMENT_FILTER_PREFIX) and not self._user_filter(filter_type):
+            return None
+        
+        with self.transaction() as conn:
+            mailing_id = conn.execute('''
+            INSERT INTO manual_mailings (admin_id, mailing_text, mailing_type, filter_criteria, media, status)
+            VALUES (?, ?, ?, '{}', ?, 'scheduled')
+            ''', (admin_id, mailing_text, filter_type, json.dumps(media) if media else None)).lastrowid
+            
+            conn.execute('''
+            INSERT INTO scheduled_mailings (mailing_id, run_at, working_hours_only)
+            VALUES (?, ?, ?)
+            ''', (mailing_id, run_at, int(working_hours_only)))
+        
+        return mailing_id
+    
+    def get_scheduled_mailings(self):
+        """Рассылки, ожидающие срока отправки"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT mm.id, mm.admin_id, sm.run_at, sm.working_hours_only
+            FROM scheduled_mailings sm
+            JOIN manual_mailings mm ON mm.id = sm.mailing_id
+            WHERE mm.status = 'scheduled'
+            ORDER BY sm.run_at
+            ''').fetchall()
+    
+    def reschedule_mailing(self, mailing_id: int, run_at: int):
+        """Перенос рассылки на run_at; идущая рассылка останавливается до срока (True, если перенесена)"""
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            UPDATE manual_mailings
+            SET status = 'scheduled'
+            WHERE id = ? AND status IN ('scheduled', 'running')
+            ''', (mailing_id,))
+            if not cursor.rowcount:
+                return False
+            
+            conn.execute('UPDATE scheduled_mailings SET run_at = ? WHERE mailing_id = ?', (run_at, mailing_id))
         
-        conn.commit()
-        conn.close()
+        return True
     
-    def save_mailing_feedback(self, mailing_id: int, user_id: int, sent_message_id: int, 
-                             feedback_type: str, feedback_text: str = ""):
-        """Сохранение обратной связи по рассылке"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO mailing_feedback 
-        (mailing_id, user_id, sent_message_id, feedback_type, feedback_text)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (mailing_id, user_id, sent_message_id, feedback_type, feedback_text))
-        
-        cursor.execute('''
-        UPDATE manual_mailings 
-        SET feedback_count = feedback_count + 1
-        WHERE id = ?
-        ''', (mailing_id,))
+    def start_scheduled_mailing(self, mailing_id: int, user_ids: Optional[list] = None):
+        """Запуск отложенной рассылки: очередь получателей (при первом запуске) и статус running.
         
-        cursor.execute('''
-        UPDATE sent_messages 
-        SET feedback_received = 1
-        WHERE id = ?
-        ''', (sent_message_id,))
+        Для сегмента получатели передаются в user_ids. Возвращает число получателей
+        в очереди или None, если рассылка уже не ждет запуска.
+        """
+        with self.transaction() as conn:
+            mailing = conn.execute('''
+            SELECT mailing_type FROM manual_mailings
+            WHERE id = ? AND status = 'scheduled'
+            ''', (mailing_id,)).fetchone()
+            if not mailing:
+                return None
+            
+            # Рассылка, продолженная в новом окне доставки, уже имеет очередь
+            if conn.execute('SELECT 1 FROM mailing_recipients WHERE mailing_id = ? LIMIT 1',
+                            (mailing_id,)).fetchone():
+                queued = conn.execute('''
+                SELECT COUNT(*) FROM mailing_recipients
+                WHERE mailing_id = ? AND state = 'queued'
+                ''', (mailing_id,)).fetchone()[0]
+            else:
+                user_filter = self._recipient_filter(mailing['mailing_type'], user_ids)
+                queued = self._enqueue_recipients(conn, mailing_id, user_filter, user_ids) if user_filter else 0
+            
+            conn.execute("UPDATE manual_mailings SET status = 'running' WHERE id = ?", (mailing_id,))
+        
+        return queued
+    
+    def get_mailing(self, mailing_id: int):
+        """Получение рассылки по ID (с расписанием, если она отложенная)"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT mm.*, sm.run_at, sm.working_hours_only
+            FROM manual_mailings mm
+            LEFT JOIN scheduled_mailings sm ON sm.mailing_id = mm.id
+            WHERE mm.id = ?
+            ''', (mailing_id,)).fetchone()
+    
+    def get_active_mailing_jobs(self):
+        """Рассылки, которые идут или стоят на паузе"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT id, admin_id, status
+            FROM manual_mailings
+            WHERE status IN ('running', 'paused')
+            ORDER BY id
+            ''').fetchall()
+    
+    def set_mailing_status(self, mailing_id: int, status: str, from_statuses: tuple):
+        """Смена статуса рассылки, если текущий статус из from_statuses (True, если сменен)"""
+        placeholders = ", ".join("?" * len(from_statuses))
+        with self.transaction() as conn:
+            cursor = conn.execute(f'''
+            UPDATE manual_mailings
+            SET status = ?
+            WHERE id = ? AND status IN ({placeholders})
+            ''', (status, mailing_id) + tuple(from_statuses))
+        
+        return cursor.rowcount > 0
+    
+    def get_queued_recipients_page(self, mailing_id: int, after_user_id: int = 0,
+                                   limit: int = RECIPIENT_PAGE_SIZE, shard: int = 0, shards: int = 1):
+        """Страница получателей рассылки в очереди: keyset по user_id (доля воркера shard из shards)"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT user_id
+            FROM mailing_recipients
+            WHERE mailing_id = ? AND state = 'queued' AND user_id > ? AND user_id % ? = ?
+            ORDER BY user_id
+            LIMIT ?
+            ''', (mailing_id, after_user_id, shards, shard, limit)).fetchall()
+    
+    def mark_recipient_sending(self, mailing_id: int, user_id: int):
+        """Захват получателя из очереди перед отправкой (False, если он уже не в очереди)"""
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            UPDATE mailing_recipients
+            SET state = 'sending', updated_at = ?
+            WHERE mailing_id = ? AND user_id = ? AND state = 'queued'
+            ''', (now_ts(), mailing_id, user_id))
+        
+        return cursor.rowcount > 0
+    
+    def complete_mailing_recipient(self, mailing_id: int, user_id: int, telegram_message_id: int):
+        """Отметка доставки получателю и сохранение отправленного сообщения (ID sent_messages)"""
+        with self.transaction() as conn:
+            sent_message_id = self.save_sent_message(mailing_id, user_id, telegram_message_id)
+            conn.execute('''
+            UPDATE mailing_recipients
+            SET state = 'sent', telegram_message_id = ?, sent_message_id = ?, updated_at = ?
+            WHERE mailing_id = ? AND user_id = ?
+            ''', (telegram_message_id, sent_message_id, now_ts(), mailing_id, user_id))
+        
+        return sent_message_id
+    
+    def complete_mailing_recipients(self, mailing_id: int, deliveries: list):
+        """Отметка доставки пачке получателей [(user_id, telegram_message_id)] без строк sent_messages"""
+        updated_at = now_ts()
+        with self.transaction() as conn:
+            conn.executemany('''
+            UPDATE mailing_recipients
+            SET state = 'sent', telegram_message_id = ?, updated_at = ?
+            WHERE mailing_id = ? AND user_id = ?
+            ''', ((message_id, updated_at, mailing_id, user_id) for user_id, message_id in deliveries))
+    
+    def get_or_create_sent_message(self, mailing_id: int, user_id: int, telegram_message_id: int):
+        """ID sent_messages для отклика на рассылку: строка создается при первом отклике.
+        
+        None, если пользователь не получатель рассылки.
+        """
+        with self.transaction() as conn:
+            recipient = conn.execute('''
+            SELECT sent_message_id FROM mailing_recipients
+            WHERE mailing_id = ? AND user_id = ?
+            ''', (mailing_id, user_id)).fetchone()
+            if recipient is None:
+                return None
+            if recipient['sent_message_id']:
+                return recipient['sent_message_id']
+            
+            sent_message_id = self.save_sent_message(mailing_id, user_id, telegram_message_id)
+            conn.execute('''
+            UPDATE mailing_recipients
+            SET sent_message_id = ?
+            WHERE mailing_id = ? AND user_id = ?
+            ''', (sent_message_id, mailing_id, user_id))
+        
+        return sent_message_id
+    
+    def fail_mailing_recipient(self, mailing_id: int, user_id: int, error: str):
+        """Отметка неудачной отправки получателю"""
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE mailing_recipients
+            SET state = 'failed', error = ?, updated_at = ?
+            WHERE mailing_id = ? AND user_id = ?
+            ''', (error, now_ts(), mailing_id, user_id))
+    
+    def get_mailing_job_progress(self, mailing_id: int):
+        """Число получателей рассылки по состояниям (queued / sending / sent / failed / total)"""
+        with self.connection() as conn:
+            counts = {
+                row['state']: row['count']
+                for row in conn.execute('''
+                SELECT state, COUNT(*) as count
+                FROM mailing_recipients
+                WHERE mailing_id = ?
+                GROUP BY state
+                ''', (mailing_id,))
+            }
+        
+        progress = {state: counts.get(state, 0) for state in ('queued', 'sending', 'sent', 'failed')}
+        progress['total'] = sum(progress.values())
+        return progress
+    
+    def recover_interrupted_recipients(self, mailing_id: int = None):
+        """Получатели, застрявшие в 'sending' после перезапуска (или сбоя рассылки mailing_id), считаются неудачными.
         
-        conn.commit()
-        feedback_id = cursor.lastrowid
-        conn.close()
+        Доставка им неизвестна, а повторная отправка могла бы продублировать сообщение.
+        """
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            UPDATE mailing_recipients
+            SET state = 'failed', error = 'interrupted', updated_at = ?
+            WHERE state = 'sending'
+            AND mailing_id IN (SELECT id FROM manual_mailings WHERE status IN ('running', 'paused'))
+            AND (? IS NULL OR mailing_id = ?)
+            ''', (now_ts(), mailing_id, mailing_id))
+        
+        return cursor.rowcount
+    
+    def save_mailing_feedback(self, mailing_id: int, user_id: int, sent_message_id: int,
+                             feedback_type: str, feedback_text: str = ""):
+        """Сохранение обратной связи по рассылке"""
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO mailing_feedback
+            (mailing_id, user_id, sent_message_id, feedback_type, feedback_text)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (mailing_id, user_id, sent_message_id, feedback_type, feedback_text))
+            
+            feedback_id = cursor.lastrowid
+            
+            conn.execute('''
+            UPDATE manual_mailings
+            SET feedback_count = feedback_count + 1
+            WHERE id = ?
+            ''', (mailing_id,))
+            
+            conn.execute('''
+            UPDATE sent_messages
+            SET feedback_received = 1
+            WHERE id = ?
+            ''', (sent_message_id,))
         
         return feedback_id
     
     def get_sent_message_by_telegram_id(self, user_id: int, telegram_message_id: int):
         """Получение отправленного сообщения по ID Telegram"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT sm.*, mm.mailing_text
-        FROM sent_messages sm
-        JOIN manual_mailings mm ON sm.mailing_id = mm.id
-        WHERE sm.user_id = ? AND sm.telegram_message_id = ?
-        ''', (user_id, telegram_message_id))
-        
-        result = cursor.fetchone()
-        conn.close()
-        
-        return result
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT sm.*, mm.mailing_text
+            FROM sent_messages sm
+            JOIN manual_mailings mm ON sm.mailing_id = mm.id
+            WHERE sm.user_id = ? AND sm.telegram_message_id = ?
+            ''', (user_id, telegram_message_id)).fetchone()
     
     def get_mailing_feedback(self, mailing_id: int):
         """Получение обратной связи по рассылке"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT mf.*, u.username, u.first_name, u.last_name
-        FROM mailing_feedback mf
-        JOIN users u ON mf.user_id = u.user_id
-        WHERE mf.mailing_id = ?
-        ORDER BY mf.created_at DESC
-        ''', (mailing_id,))
-        
-        feedback = cursor.fetchall()
-        conn.close()
-        
-        return feedback
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT mf.*, u.username, u.first_name, u.last_name
+            FROM mailing_feedback mf
+            JOIN users u ON mf.user_id = u.user_id
+            WHERE mf.mailing_id = ?
+            ORDER BY mf.created_at DESC
+            ''', (mailing_id,)).fetchall()
     
     def get_mailing_feedback_for_user(self, user_id: int):
         """Получение обратной связи по пользователю"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT mf.*, mm.mailing_text
-        FROM mailing_feedback mf
-        JOIN manual_mailings mm ON mf.mailing_id = mm.id
-        WHERE mf.user_id = ?
-        ORDER BY mf.created_at DESC
-        LIMIT 10
-        ''', (user_id,))
-        
-        feedback = cursor.fetchall()
-        conn.close()
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT mf.*, mm.mailing_text
+            FROM mailing_feedback mf
+            JOIN manual_mailings mm ON mf.mailing_id = mm.id
+            WHERE mf.user_id = ?
+            ORDER BY mf.created_at DESC
+            LIMIT 10
+            ''', (user_id,)).fetchall()
+    
+    def get_mailings_with_feedback(self, limit: int = 10):
+        """Последние отправленные рассылки с числом отозвавшихся пользователей"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT mm.id, mm.mailing_text, mm.created_at,
+                   mm.sent_count, mm.feedback_count,
+                   (SELECT COUNT(DISTINCT mf.user_id)
+                    FROM mailing_feedback mf
+                    WHERE mf.mailing_id = mm.id) as feedback_users
+            FROM manual_mailings mm
+            WHERE mm.sent_count > 0
+            ORDER BY mm.created_at DESC
+            LIMIT ?
+            ''', (limit,)).fetchall()
+    
+    def get_mailings_with_feedback_page(self, cursor: tuple = None, direction: str = "next",
+                                        limit: int = ADMIN_PAGE_SIZE):
+        """Страница отправленных рассылок с числом отозвавшихся пользователей"""
+        return self._keyset_page('''
+            SELECT mm.id, mm.mailing_text, mm.created_at,
+                   mm.sent_count, mm.feedback_count,
+                   (SELECT COUNT(DISTINCT mf.user_id)
+                    FROM mailing_feedback mf
+                    WHERE mf.mailing_id = mm.id) as feedback_users
+            FROM manual_mailings mm
+            WHERE mm.sent_count > 0
+            ''', (), ("mm.created_at", "mm.id"), cursor, direction, limit)
+    
+    def get_feedback_stats(self):
+        """Сводная статистика обратной связи по рассылкам"""
+        start, end = period_bounds(30)
+        
+        with self.connection() as conn:
+            stats = self._sum_counters(conn, 1, local_day(end))
+            recent = self._sum_counters(conn, local_day(start), local_day(end - 1))
+            
+            popular = conn.execute('''
+            SELECT mm.id, mm.mailing_text, COUNT(mf.id) as feedback_count
+            FROM manual_mailings mm
+            LEFT JOIN mailing_feedback mf ON mm.id = mf.mailing_id
+            GROUP BY mm.id
+            ORDER BY feedback_count DESC
+            LIMIT 5
+            ''').fetchall()
         
-        return feedback
+        return {
+            'total_feedback': stats.get('feedback_total', 0),
+            'likes': stats.get('feedback_like', 0),
+            'dislikes': stats.get('feedback_dislike', 0),
+            'comments': stats.get('feedback_comment', 0),
+            'unsubscribes': stats.get('feedback_unsubscribe', 0),
+            'recent_feedback': recent.get('feedback_total', 0),
+            'recent_unsubscribes': recent.get('feedback_unsubscribe', 0),
+            'popular': popular
+        }
     
     def save_manager_message(self, user_id: int, message_type: str, message_text: str, file_id: str = None, file_name: str = None):
         """Сохранение сообщения менеджеру"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO manager_messages (user_id, message_type, message_text, file_id, file_name)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, message_type, message_text, file_id, file_name))
-        
-        conn.commit()
-        message_id = cursor.lastrowid
-        conn.close()
-        
-        return message_id
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO manager_messages (user_id, message_type, message_text, file_id, file_name)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, message_type, message_text, file_id, file_name))
+        
+        return cursor.lastrowid
+    
+    def get_manager_message(self, message_id: int):
+        """Получение сообщения менеджеру вместе с данными пользователя"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT mm.*, u.username, u.phone, u.first_name, u.last_name
+            FROM manager_messages mm
+            JOIN users u ON mm.user_id = u.user_id
+            WHERE mm.id = ?
+            ''', (message_id,)).fetchone()
+    
+    def get_unprocessed_manager_messages(self, limit: int = 10):
+        """Необработанные сообщения менеджеру"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT mm.*, u.username, u.first_name, u.last_name
+            FROM manager_messages mm
+            JOIN users u ON mm.user_id = u.user_id
+            WHERE mm.processed = 0
+            ORDER BY mm.created_at DESC
+            LIMIT ?
+            ''', (limit,)).fetchall()
+    
+    def get_unprocessed_manager_messages_page(self, cursor: tuple = None, direction: str = "next",
+                                              limit: int = ADMIN_PAGE_SIZE):
+        """Страница необработанных сообщений менеджеру"""
+        return self._keyset_page('''
+            SELECT mm.*, u.username, u.first_name, u.last_name
+            FROM manager_messages mm
+            JOIN users u ON mm.user_id = u.user_id
+            WHERE mm.processed = 0
+            ''', (), ("mm.created_at", "mm.id"), cursor, direction, limit)
+    
+    def mark_manager_message_processed(self, message_id: int):
+        """Отметка сообщения менеджеру как обработанного"""
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE manager_messages
+            SET processed = 1
+            WHERE id = ?
+            ''', (message_id,))
     
     def get_pending_exports(self):
         """Получение ожидающих выгрузок"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT te.*, u.username, u.first_name, u.last_name, u.email, u.phone
-        FROM tender_exports te
-        JOIN users u ON te.user_id = u.user_id
-        WHERE te.status = 'pending'
-        ORDER BY te.sent_at DESC
-        LIMIT 10
-        ''')
-        
-        exports = cursor.fetchall()
-        conn.close()
-        
-        return exports
-    
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT te.*, u.username, u.first_name, u.last_name, u.email, u.phone
+            FROM tender_exports te
+            JOIN users u ON te.user_id = u.user_id
+            WHERE te.status = 'pending'
+            ORDER BY te.sent_at DESC
+            LIMIT 10
+            ''').fetchall()
+    
+    @_user_cached
     def get_user_by_id(self, user_id: int):
         """Получение пользователя по ID"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT * FROM users 
-        WHERE user_id = ?
-        ''', (user_id,))
-        
-        user = cursor.fetchone()
-        conn.close()
-        
-        return user
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT * FROM users
+            WHERE user_id = ?
+            ''', (user_id,)).fetchone()
     
     def get_export_by_id(self, export_id: int):
         """Получение выгрузки по ID"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT te.*, u.username, u.first_name, u.last_name, u.email, u.phone
-        FROM tender_exports te
-        JOIN users u ON te.user_id = u.user_id
-        WHERE te.id = ?
-        ''', (export_id,))
-        
-        export = cursor.fetchone()
-        conn.close()
-        
-        return export
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT te.*, u.username, u.first_name, u.last_name, u.email, u.phone
+            FROM tender_exports te
+            JOIN users u ON te.user_id = u.user_id
+            WHERE te.id = ?
+            ''', (export_id,)).fetchone()
     
     def get_user_exports(self, user_id: int):
         """Получение всех выгрузок пользователя"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT te.*
-        FROM tender_exports te
-        WHERE te.user_id = ?
-        ORDER BY te.sent_at DESC
-        LIMIT 20
-        ''', (user_id,))
-        
-        exports = cursor.fetchall()
-        conn.close()
-        
-        return exports
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT te.*
+            FROM tender_exports te
+            WHERE te.user_id = ?
+            ORDER BY te.sent_at DESC
+            LIMIT 20
+            ''', (user_id,)).fetchall()
+    
+    @staticmethod
+    def _sum_counters(conn, first_day: int, last_day: int):
+        """Сумма счетчиков stats_counters по дням [first_day, last_day]"""
+        return {
+            row['metric']: row['value'] or 0
+            for row in conn.execute('''
+            SELECT metric, SUM(value) as value
+            FROM stats_counters
+            WHERE day BETWEEN ? AND ?
+            GROUP BY metric
+            ''', (first_day, last_day))
+        }
     
     def get_statistics(self, days: int = 14):
-        """Получение статистики за указанный период"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        start_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
-        
-        cursor.execute('''
-        SELECT COUNT(*) as count FROM users 
-        WHERE date(created_at) >= ?
-        ''', (start_date,))
-        new_users = cursor.fetchone()['count']
-        
-        cursor.execute('''
-        SELECT COUNT(*) as count FROM tender_exports 
-        WHERE date(sent_at) >= ? AND status = 'completed'
-        ''', (start_date,))
-        exports_completed = cursor.fetchone()['count']
-        
-        cursor.execute('''
-        SELECT COUNT(*) as count FROM manager_messages 
-        WHERE date(created_at) >= ?
-        ''', (start_date,))
-        manager_messages = cursor.fetchone()['count']
-        
-        cursor.execute('''
-        SELECT 
-            COUNT(*) as count, 
-            SUM(sent_count) as total_sent,
-            SUM(feedback_count) as total_feedback
-        FROM manual_mailings 
-        WHERE date(created_at) >= ?
-        ''', (start_date,))
-        mailings = cursor.fetchone()
-        
-        cursor.execute('''
-        SELECT 
-            SUM(CASE WHEN mailing_subscribed = 1 THEN 1 ELSE 0 END) as subscribed,
-            SUM(CASE WHEN mailing_subscribed = 0 THEN 1 ELSE 0 END) as unsubscribed
-        FROM users 
-        WHERE is_active = 1
-        ''')
-        subscriptions = cursor.fetchone()
+        """Получение статистики за указанный период (по дневным счетчикам)"""
+        start, end = period_bounds(days)
         
-        cursor.execute('''
-        SELECT COUNT(*) as count FROM questionnaires 
-        WHERE date(created_at) >= ?
-        ''', (start_date,))
-        new_questionnaires = cursor.fetchone()['count']
-        
-        conn.close()
+        with self.connection() as conn:
+            period = self._sum_counters(conn, local_day(start), local_day(end - 1))
+            current = self._sum_counters(conn, 0, 0)
         
         return {
-            'new_users': new_users,
-            'exports_completed': exports_completed,
-            'manager_messages': manager_messages,
-            'mailings_count': mailings['count'] if mailings and mailings['count'] else 0,
-            'mailings_sent': mailings['total_sent'] if mailings and mailings['total_sent'] else 0,
-            'mailings_feedback': mailings['total_feedback'] if mailings and mailings['total_feedback'] else 0,
-            'subscribed_users': subscriptions['subscribed'] if subscriptions and subscriptions['subscribed'] else 0,
-            'unsubscribed_users': subscriptions['unsubscribed'] if subscriptions and subscriptions['unsubscribed'] else 0,
-            'new_questionnaires': new_questionnaires
+            'new_users': period.get('new_users', 0),
+            'exports_completed': period.get('exports_completed', 0),
+            'manager_messages': period.get('manager_messages', 0),
+            'mailings_count': period.get('mailings_count', 0),
+            'mailings_sent': period.get('mailings_sent', 0),
+            'mailings_feedback': period.get('mailings_feedback', 0),
+            'subscribed_users': current.get('subscribed_users', 0),
+            'unsubscribed_users': current.get('unsubscribed_users', 0),
+            'new_questionnaires': period.get('new_questionnaires', 0),
+            'partial_questionnaires': current.get('questionnaires_partial', 0),
+            'complete_questionnaires': current.get('questionnaires_complete', 0)
         }
     
-    def is_working_hours(self):
-        """Проверка рабочего времени"""
-        now = datetime.now()
-        
-        if now.weekday() not in WORK_DAYS:
-            return False
-        
-        if now.hour < WORK_START_HOUR or now.hour >= WORK_END_HOUR:
-            return False
-        
-        return True
-    
-    def get_next_working_time(self):
-        """Получение следующего рабочего времени"""
-        now = datetime.now()
-        
-        if self.is_working_hours():
-            return now
-        
-        days_to_add = 1
-        while (now.weekday() + days_to_add) % 7 not in WORK_DAYS:
-            days_to_add += 1
-        
-        next_work_day = now + timedelta(days=days_to_add)
-        return next_work_day.replace(hour=WORK_START_HOUR, minute=0, second=0, microsecond=0)
-
-    def get_partial_questionnaires(self):
-        """Получение частичных анкет (только 1-4 вопросы)"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT q.*, u.username 
-        FROM questionnaires q
-        LEFT JOIN users u ON q.user_id = u.user_id
-        WHERE q.status = 'partial'
-        ORDER BY q.created_at DESC
-        LIMIT 20
-        ''')
-        
-        questionnaires = cursor.fetchall()
-        conn.close()
-        
-        return questionnaires
+    def get_partial_questionnaires(self):
+        """Получение частичных анкет (только 1-4 вопросы)"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT q.*, u.username
+            FROM questionnaires q
+            LEFT JOIN users u ON q.user_id = u.user_id
+            WHERE q.status = 'partial'
+            ORDER BY q.created_at DESC
+            LIMIT 20
+            ''').fetchall()
+    
+    def get_partial_questionnaires_page(self, cursor: tuple = None, direction: str = "next",
+                                        limit: int = ADMIN_PAGE_SIZE):
+        """Страница частичных анкет"""
+        return self._keyset_page('''
+            SELECT q.*, u.username
+            FROM questionnaires q
+            LEFT JOIN users u ON q.user_id = u.user_id
+            WHERE q.status = 'partial'
+            ''', (), ("q.created_at", "q.id"), cursor, direction, limit)
     
     def get_complete_questionnaires(self):
         """Получение полных анкет"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT q.*, u.username 
-        FROM questionnaires q
-        LEFT JOIN users u ON q.user_id = u.user_id
-        WHERE q.status = 'complete'
-        ORDER BY q.created_at DESC
-        LIMIT 20
-        ''')
-        
-        questionnaires = cursor.fetchall()
-        conn.close()
-        
-        return questionnaires
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT q.*, u.username
+            FROM questionnaires q
+            LEFT JOIN users u ON q.user_id = u.user_id
+            WHERE q.status = 'complete'
+            ORDER BY q.created_at DESC
+            LIMIT 20
+            ''').fetchall()
     
     def create_contact_request(self, user_id: int, export_id: int):
         """Создание запроса контактов для выгрузки"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO contact_requests (user_id, export_id)
-        VALUES (?, ?)
-        ''', (user_id, export_id))
-        
-        conn.commit()
-        request_id = cursor.lastrowid
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO contact_requests (user_id, export_id)
+            VALUES (?, ?)
+            ''', (user_id, export_id))
         
-        return request_id
+        return cursor.lastrowid
     
     def mark_contact_request_completed(self, export_id: int):
         """Отметка запроса контактов как выполненного"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        UPDATE contact_requests 
-        SET completed = 1, completed_at = datetime('now')
-        WHERE export_id = ?
-        ''', (export_id,))
-        
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE contact_requests
+            SET completed = 1, completed_at = ?
+            WHERE export_id = ?
+            ''', (now_ts(), export_id))
     
     def create_tender_export_without_file(self, user_id: int):
         """Создание записи о выгрузке без файла"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        INSERT INTO tender_exports 
-        (user_id, follow_up_scheduled, status)
-        VALUES (?, ?, 'pending')
-        ''', (user_id, 1))
-        
-        conn.commit()
-        export_id = cursor.lastrowid
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO tender_exports
+            (user_id, follow_up_scheduled, status)
+            VALUES (?, ?, 'pending')
+            ''', (user_id, 1))
         
-        return export_id
-
+        return cursor.lastrowid
+    
+    @_user_cached
     def has_complete_questionnaire(self, user_id: int):
         """Проверка, есть ли у пользователя полная анкета с контактами"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT COUNT(*) as count 
-        FROM questionnaires 
-        WHERE user_id = ? AND status = 'complete'
-        AND full_name IS NOT NULL 
-        AND phone IS NOT NULL 
-        AND email IS NOT NULL
-        ''', (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            result = conn.execute('''
+            SELECT COUNT(*) as count
+            FROM questionnaires
+            WHERE user_id = ? AND status = 'complete'
+            AND full_name IS NOT NULL
+            AND phone IS NOT NULL
+            AND email IS NOT NULL
+            ''', (user_id,)).fetchone()
         
         return result[0] > 0 if result else False
-
+    
+    @_user_cached
     def get_last_complete_questionnaire(self, user_id: int):
         """Получение последней полной анкеты пользователя"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT * 
-        FROM questionnaires 
-        WHERE user_id = ? AND status = 'complete'
-        ORDER BY created_at DESC
-        LIMIT 1
-        ''', (user_id,))
-        
-        questionnaire = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT *
+            FROM questionnaires
+            WHERE user_id = ? AND status = 'complete'
+            ORDER BY created_at DESC
+            LIMIT 1
+            ''', (user_id,)).fetchone()
+    
+    def enqueue_job(self, kind: str, payload: dict, run_at: int, max_attempts: int, key: str = None):
+        """Постановка задачи в очередь (ID; None, если задача с тем же key уже есть)"""
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT OR IGNORE INTO jobs (kind, payload, run_at, max_attempts, job_key)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (kind, json.dumps(payload, ensure_ascii=False), run_at, max_attempts, key))
+        
+        return cursor.lastrowid if cursor.rowcount else None
+    
+    def claim_due_jobs(self, limit: int, lease: int):
+        """Захват наступивших задач на lease сек: список {id, kind, payload, attempts, max_attempts}.
+        
+        Захваченная задача получает статус running и срок окончания аренды в run_at:
+        если процесс упадет, не завершив ее, задача снова станет наступившей.
+        """
+        now = now_ts()
+        with self.transaction() as conn:
+            rows = conn.execute('''
+            SELECT id, kind, payload, attempts, max_attempts
+            FROM jobs
+            WHERE status IN ('queued', 'running') AND run_at <= ?
+            ORDER BY run_at, id
+            LIMIT ?
+            ''', (now, limit)).fetchall()
+            conn.executemany('''
+            UPDATE jobs
+            SET status = 'running', attempts = attempts + 1, run_at = ?, updated_at = ?
+            WHERE id = ?
+            ''', [(now + lease, now, row['id']) for row in rows])
+        
+        return [{
+            "id": row['id'],
+            "kind": row['kind'],
+            "payload": json.loads(row['payload']),
+            "attempts": row['attempts'] + 1,
+            "max_attempts": row['max_attempts']
+        } for row in rows]
+    
+    def complete_job(self, job_id: int):
+        """Удаление выполненной задачи"""
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+    
+    def retry_job(self, job_id: int, run_at: int, error: str):
+        """Возврат задачи в очередь до run_at после ошибки"""
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE jobs
+            SET status = 'queued', run_at = ?, last_error = ?, updated_at = ?
+            WHERE id = ?
+            ''', (run_at, error, now_ts(), job_id))
+    
+    def fail_job(self, job_id: int, error: str):
+        """Отметка задачи как окончательно не выполненной"""
+        with self.transaction() as conn:
+            conn.execute('''
+            UPDATE jobs
+            SET status = 'failed', last_error = ?, updated_at = ?
+            WHERE id = ?
+            ''', (error, now_ts(), job_id))
+    
+    def get_next_job_time(self) -> Optional[int]:
+        """Срок ближайшей задачи (или окончания аренды захваченной), None - очередь пуста"""
+        with self.connection() as conn:
+            return conn.execute(
+                "SELECT MIN(run_at) FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchone()[0]
+    
+    def get_job_counts(self) -> dict:
+        """Число задач по статусам"""
+        with self.connection() as conn:
+            return dict(conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+    
+    def add_admin_event(self, kind: str, mailing_id: int = None, user_id: int = None,
+                        username: str = None, details: str = None):
+        """Событие для сводки администратору"""
+        with self.transaction() as conn:
+            cursor = conn.execute('''
+            INSERT INTO admin_events (kind, mailing_id, user_id, username, details)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (kind, mailing_id, user_id, username, details))
+        
+        return cursor.lastrowid
+    
+    def get_admin_events(self):
+        """Накопленные события для сводки по порядку поступления"""
+        with self.connection() as conn:
+            return conn.execute('''
+            SELECT id, kind, mailing_id, user_id, username, details, created_at
+            FROM admin_events
+            ORDER BY id
+            ''').fetchall()
+    
+    def delete_admin_events(self, event_ids: list):
+        """Удаление событий, вошедших в отправленную сводку (ровно переданные ID)"""
+        with self.transaction() as conn:
+            for start in range(0, len(event_ids), 500):
+                batch = list(event_ids[start:start + 500])
+                conn.execute(f'DELETE FROM admin_events WHERE id IN ({", ".join("?" * len(batch))})', batch)
+
+# =========== АСИНХРОННЫЙ ДОСТУП К БАЗЕ ДАННЫХ ===========
+def _offload(name: str):
+    """Асинхронная версия метода Database, выполняемая в потоке БД"""
+    async def method(self, *args, **kwargs):
+        return await self.run(getattr(self.sync, name), *args, **kwargs)
+    
+    method.__name__ = name
+    method.__doc__ = getattr(Database, name).__doc__
+    return method
+
+class WriteBehindQueue:
+    """Буфер отложенной записи с групповым коммитом.
+    
+    Вызовы методов записи хранилища от множества корутин копятся в памяти и
+    выполняются одной транзакцией (StorageBackend.apply_writes) каждые
+    flush_interval_ms или по max_batch операций. Каждая операция изолирована
+    точкой сохранения, поэтому ошибка одной записи не откатывает остальные.
+    submit() возвращает future с результатом метода (например, id строки),
+    flush() - барьер, сбрасывающий буфер сразу.
+    """
+    
+    def __init__(self, database: StorageBackend, flush_interval_ms: int = DB_WRITE_FLUSH_MS,
+                 max_batch: int = DB_WRITE_BATCH):
+        self.database = database
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self.flushes = 0
+        self.rows = 0
+        self._pending = []
+        self._timer = None
+        self._flush_lock = asyncio.Lock()
+    
+    def submit(self, name: str, *args, **kwargs) -> asyncio.Future:
+        """Постановка вызова метода хранилища в очередь записи"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        # Ошибку уже залогировал flush; вызывающий может не ждать результат
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._pending.append((name, args, kwargs, future))
+        
+        if len(self._pending) >= self.max_batch:
+            self._schedule(loop, 0)
+        elif self._timer is None:
+            self._schedule(loop, self.flush_interval)
+        
+        return future
+    
+    def _schedule(self, loop, delay: float):
+        """Планирование сброса буфера"""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = loop.call_later(delay, lambda: asyncio.ensure_future(self.flush()))
+    
+    async def flush(self):
+        """Барьер: все поставленные ранее операции записаны и закоммичены"""
+        async with self._flush_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            
+            try:
+                results = await self.database.apply_writes(batch)
+            except Exception as e:
+                logger.error(f"❌ Ошибка группового коммита ({len(batch)} операций): {e}")
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            
+            self.flushes += 1
+            self.rows += len(batch)
+            
+            for (*_, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+class AsyncDatabase(StorageBackend):
+    """SQLite-бэкенд хранилища: неблокирующий фасад над Database.
+    
+    Все обращения к SQLite (включая commit и checkpoint WAL) выполняются в
+    выделенном потоке БД, поэтому цикл событий aiogram не ждет диск.
+    """
+    
+    name = "sqlite"
+    
+    def __init__(self, database: Database, workers: int = DB_EXECUTOR_WORKERS):
+        self.sync = database
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+    
+    async def run(self, func, *args, **kwargs):
+        """Выполнение функции в потоке БД"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+    
+    async def close(self):
+        """Остановка потока БД и закрытие соединений"""
+        self._executor.shutdown(wait=True)
+        self.sync.close()
+    
+    def status(self) -> dict:
+        """Сведения о хранилище для /status"""
+        return {
+            "backend": self.name,
+            "commits": self.sync.pool.commits,
+            "user_cache": self.sync.user_cache.stats()
+        }
+    
+    async def apply_writes(self, batch: list) -> list:
+        """Выполнение пачки отложенных записей одной транзакцией"""
+        return await self.run(self._apply_writes, batch)
+    
+    def _apply_writes(self, batch: list) -> list:
+        """Пачка записей в одной транзакции SQLite, каждая под SAVEPOINT (в потоке БД)"""
+        results = []
         
-        return questionnaire
+        with self.sync.transaction() as conn:
+            for name, args, kwargs, _ in batch:
+                conn.execute("SAVEPOINT write_behind")
+                try:
+                    results.append((True, getattr(self.sync, name)(*args, **kwargs)))
+                    conn.execute("RELEASE write_behind")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_behind")
+                    conn.execute("RELEASE write_behind")
+                    logger.error(f"❌ Ошибка отложенной записи {name}: {e}")
+                    results.append((False, e))
+        
+        return results
+    
+    add_user = _offload("add_user")
+    update_user_phone = _offload("update_user_phone")
+    save_questionnaire_partial = _offload("save_questionnaire_partial")
+    save_questionnaire = _offload("save_questionnaire")
+    update_partial_to_complete = _offload("update_partial_to_complete")
+    create_tender_export = _offload("create_tender_export")
+    mark_export_completed = _offload("mark_export_completed")
+    cancel_export = _offload("cancel_export")
+    save_export_file = _offload("save_export_file")
+    get_exports_for_followup = _offload("get_exports_for_followup")
+    get_pending_followups = _offload("get_pending_followups")
+    get_export_for_followup = _offload("get_export_for_followup")
+    mark_followups_sent = _offload("mark_followups_sent")
+    save_followup_response = _offload("save_followup_response")
+    toggle_user_mailing_subscription = _offload("toggle_user_mailing_subscription")
+    get_user_mailing_status = _offload("get_user_mailing_status")
+    deactivate_users = _offload("deactivate_users")
+    get_users_by_filter = _offload("get_users_by_filter")
+    count_users_by_filter = _offload("count_users_by_filter")
+    get_users_page = _offload("get_users_page")
+    get_user_segment_rows = _offload("get_user_segment_rows")
+    get_subscription_users_page = _offload("get_subscription_users_page")
+    get_all_users_with_subscription = _offload("get_all_users_with_subscription")
+    get_user_activity_summary = _offload("get_user_activity_summary")
+    get_subscription_stats = _offload("get_subscription_stats")
+    create_manual_mailing = _offload("create_manual_mailing")
+    save_sent_message = _offload("save_sent_message")
+    get_sent_message = _offload("get_sent_message")
+    update_mailing_stats = _offload("update_mailing_stats")
+    create_mailing_job = _offload("create_mailing_job")
+    schedule_mailing = _offload("schedule_mailing")
+    get_scheduled_mailings = _offload("get_scheduled_mailings")
+    reschedule_mailing = _offload("reschedule_mailing")
+    start_scheduled_mailing = _offload("start_scheduled_mailing")
+    get_mailing = _offload("get_mailing")
+    get_active_mailing_jobs = _offload("get_active_mailing_jobs")
+    set_mailing_status = _offload("set_mailing_status")
+    get_queued_recipients_page = _offload("get_queued_recipients_page")
+    mark_recipient_sending = _offload("mark_recipient_sending")
+    complete_mailing_recipient = _offload("complete_mailing_recipient")
+    complete_mailing_recipients = _offload("complete_mailing_recipients")
+    get_or_create_sent_message = _offload("get_or_create_sent_message")
+    fail_mailing_recipient = _offload("fail_mailing_recipient")
+    get_mailing_job_progress = _offload("get_mailing_job_progress")
+    recover_interrupted_recipients = _offload("recover_interrupted_recipients")
+    save_mailing_feedback = _offload("save_mailing_feedback")
+    get_sent_message_by_telegram_id = _offload("get_sent_message_by_telegram_id")
+    get_mailing_feedback = _offload("get_mailing_feedback")
+    get_mailing_feedback_for_user = _offload("get_mailing_feedback_for_user")
+    get_mailings_with_feedback = _offload("get_mailings_with_feedback")
+    get_mailings_with_feedback_page = _offload("get_mailings_with_feedback_page")
+    get_feedback_stats = _offload("get_feedback_stats")
+    save_manager_message = _offload("save_manager_message")
+    get_manager_message = _offload("get_manager_message")
+    get_unprocessed_manager_messages = _offload("get_unprocessed_manager_messages")
+    get_unprocessed_manager_messages_page = _offload("get_unprocessed_manager_messages_page")
+    mark_manager_message_processed = _offload("mark_manager_message_processed")
+    get_pending_exports = _offload("get_pending_exports")
+    get_user_by_id = _offload("get_user_by_id")
+    get_export_by_id = _offload("get_export_by_id")
+    get_user_exports = _offload("get_user_exports")
+    get_statistics = _offload("get_statistics")
+    get_partial_questionnaires = _offload("get_partial_questionnaires")
+    get_partial_questionnaires_page = _offload("get_partial_questionnaires_page")
+    get_complete_questionnaires = _offload("get_complete_questionnaires")
+    create_contact_request = _offload("create_contact_request")
+    mark_contact_request_completed = _offload("mark_contact_request_completed")
+    create_tender_export_without_file = _offload("create_tender_export_without_file")
+    has_complete_questionnaire = _offload("has_complete_questionnaire")
+    get_last_complete_questionnaire = _offload("get_last_complete_questionnaire")
+    enqueue_job = _offload("enqueue_job")
+    claim_due_jobs = _offload("claim_due_jobs")
+    complete_job = _offload("complete_job")
+    retry_job = _offload("retry_job")
+    fail_job = _offload("fail_job")
+    get_next_job_time = _offload("get_next_job_time")
+    get_job_counts = _offload("get_job_counts")
+    add_admin_event = _offload("add_admin_event")
+    get_admin_events = _offload("get_admin_events")
+    delete_admin_events = _offload("delete_admin_events")
+
+def create_storage() -> StorageBackend:
+    """Создание хранилища по настройке DB_BACKEND"""
+    if DB_BACKEND == "postgres":
+        # asyncpg нужен только для PostgreSQL, поэтому импорт ленивый
+        from postgres_storage import PostgresStorage
+        storage = PostgresStorage(DATABASE_URL, max_size=DB_POOL_SIZE)
+    else:
+        storage = AsyncDatabase(Database())
+    
+    storage.writes = WriteBehindQueue(storage)
+    logger.info(f"✅ Хранилище: {storage.name}")
+    return storage
+
+db = create_storage()
+
+# Битовые карты аудитории для сегментов рассылок (предпросмотр и выбор получателей)
+segments = SegmentIndex(db)
 
-db = Database()
+# Долговечная очередь отложенных задач; обработчики регистрируются рядом со своими функциями
+# SQLite - один процесс: база читается только к сроку ближайшей задачи; к общей базе
+# PostgreSQL подключены несколько реплик, и задачи соседей находит опрос раз в минуту
+job_queue = JobQueue(db, JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_BACKOFF_BASE, JOB_BACKOFF_MAX,
+                     permanent=is_unreachable, poll_interval=60 if DB_BACKEND == "postgres" else None)
 
 # =========== HTTP ОБРАБОТЧИКИ ДЛЯ RAILWAY ===========
 async def health_check(request):
@@ -1082,13 +2478,15 @@ async def status_check(request):
     """Статус бота"""
     try:
         bot_info = await bot.get_me()
-        stats = db.get_statistics(7)
+        stats = await db.get_statistics(7)
         
         return web.json_response({
             "status": "running",
             "bot": f"@{bot_info.username}",
             "name": bot_info.first_name,
             "statistics": stats,
+            "storage": db.status(),
+            "jobs": {**job_queue.stats(), "queue": await db.get_job_counts()},
             "timestamp": datetime.now().isoformat()
         })
     except Exception as e:
@@ -1175,26 +2573,52 @@ def get_mailing_filters_keyboard():
             [KeyboardButton(text="📝 С анкетами")],
             [KeyboardButton(text="📭 Без анкет")],
             [KeyboardButton(text="🆕 За неделю")],
+            [KeyboardButton(text="🧩 Сегмент")],
             [KeyboardButton(text="❌ Отмена")]
         ],
         resize_keyboard=True
     )
 
 def get_mailing_feedback_keyboard(sent_message_id: int):
-    """Клавиатура для обратной связи по рассылке"""
+    """Клавиатура для обратной связи по рассылке (отдельное сообщение, ID sent_messages)"""
+    return make_feedback_keyboard(lambda action: f"feedback_{action}_{sent_message_id}")
+
+def get_inline_feedback_keyboard(mailing_id: int, user_id: int):
+    """Клавиатура обратной связи в самом сообщении рассылки: рассылка и получатель - в callback_data"""
+    return make_feedback_keyboard(lambda action: f"mfb_{action}_{mailing_id}_{user_id}")
+
+def make_feedback_keyboard(callback_data: Callable[[str], str]):
+    """Кнопки обратной связи по рассылке; callback_data(действие) - данные кнопки"""
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [
-                InlineKeyboardButton(text="👍 Понравилось", callback_data=f"feedback_like_{sent_message_id}"),
-                InlineKeyboardButton(text="👎 Не понравилось", callback_data=f"feedback_dislike_{sent_message_id}")
+                InlineKeyboardButton(text="👍 Понравилось", callback_data=callback_data("like")),
+                InlineKeyboardButton(text="👎 Не понравилось", callback_data=callback_data("dislike"))
             ],
             [
-                InlineKeyboardButton(text="💬 Комментарий", callback_data=f"feedback_comment_{sent_message_id}"),
-                InlineKeyboardButton(text="🚫 Отписаться", callback_data=f"feedback_unsubscribe_{sent_message_id}")
+                InlineKeyboardButton(text="💬 Комментарий", callback_data=callback_data("comment")),
+                InlineKeyboardButton(text="🚫 Отписаться", callback_data=callback_data("unsubscribe"))
             ]
         ]
     )
 
+def get_mailing_job_keyboard(mailing_id: int, status: str):
+    """Кнопки управления рассылкой: пауза или продолжение и отмена"""
+    cancel = InlineKeyboardButton(text="⛔ Отменить", callback_data=f"mjob_cancel_{mailing_id}")
+    if status == "scheduled":
+        return InlineKeyboardMarkup(inline_keyboard=[[cancel]])
+    
+    if status == "running":
+        toggle = InlineKeyboardButton(text="⏸ Пауза", callback_data=f"mjob_pause_{mailing_id}")
+    else:
+        toggle = InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"mjob_resume_{mailing_id}")
+    
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [toggle, cancel]
+        ]
+    )
+
 def get_subscription_management_keyboard(user_id: int, current_status: bool):
     """Клавиатура управления подпиской пользователя"""
     status_text = "✅ Подписан" if current_status else "❌ Отписан"
@@ -1284,7 +2708,9 @@ class ManagerDialog(StatesGroup):
 class ManualMailing(StatesGroup):
     waiting_for_text = State()
     waiting_for_filter = State()
+    waiting_for_segment = State()
     waiting_for_confirmation = State()
+    waiting_for_schedule = State()
 
 class FeedbackComment(StatesGroup):
     waiting_for_comment = State()
@@ -1300,6 +2726,216 @@ class ExportContacts(StatesGroup):
     waiting_for_phone = State()
     waiting_for_email = State()
 
+# =========== УВЕДОМЛЕНИЯ АДМИНИСТРАТОРУ ===========
+# Обработчики не ждут Telegram: уведомление записывается в очередь задач
+# (job_queue) и повторяется, пока не будет доставлено
+async def notify_admin(text: str = None, reply_markup: InlineKeyboardMarkup = None, media: dict = None):
+    """Уведомление администратору через очередь задач.
+    
+    media - вложение после текста: {"type": "document"|"photo", "file_id"} или
+    локальный файл {"type": "document", "path", "filename"}; "caption" - подпись.
+    """
+    if not ADMIN_ID:
+        return
+    
+    payload = {"text": text, "media": media}
+    if reply_markup:
+        payload["reply_markup"] = reply_markup.model_dump(exclude_none=True)
+    
+    try:
+        await job_queue.enqueue("admin_message", payload)
+    except Exception as e:
+        logger.error(f"❌ Не удалось поставить уведомление администратору в очередь: {e}")
+
+async def run_admin_message_job(payload: dict):
+    """Задача admin_message: текст и вложение администратору"""
+    if not ADMIN_ID:
+        return
+    
+    if payload.get('text'):
+        markup = payload.get('reply_markup')
+        await bot.send_message(
+            ADMIN_ID,
+            payload['text'],
+            reply_markup=InlineKeyboardMarkup.model_validate(markup) if markup else None,
+            parse_mode=ParseMode.HTML
+        )
+    
+    media = payload.get('media')
+    if not media:
+        return
+    
+    file = media.get('file_id')
+    if media.get('path'):
+        if not os.path.exists(media['path']):
+            logger.warning(f"⚠️ Файл {media['path']} для администратора не найден")
+            return
+        file = FSInputFile(media['path'], filename=media.get('filename'))
+    
+    send = bot.send_photo if media['type'] == "photo" else bot.send_document
+    await send(ADMIN_ID, file, caption=media.get('caption'), parse_mode=ParseMode.HTML)
+
+job_queue.register("admin_message", run_admin_message_job)
+
+# =========== СВОДКИ СОБЫТИЙ ДЛЯ АДМИНИСТРАТОРА ===========
+# После большой рассылки лайков и отписок сотни: по отдельности они заваливают
+# администратора и расходуют лимит отправки, нужный пользователям
+MAILING_EVENT_KINDS = ("like", "dislike", "unsubscribe", "comment")
+
+# Заголовки перечней в сводке
+ADMIN_DIGEST_SECTIONS = {
+    "comment": "💬 Комментарии к рассылкам",
+    "partial_questionnaire": "📋 Частичные анкеты",
+    "contacts_request": "📨 Отправлены запросы контактов"
+}
+
+# Срок сводки, уже поставленной этим процессом: задача не пишется на каждое событие
+admin_digest_scheduled = {"run_at": 0}
+admin_digest_lock = asyncio.Lock()
+
+def admin_digest_time() -> int:
+    """Срок сводки для нового события: конец текущего окна или начало рабочего времени"""
+    if not is_working_hours():
+        return int(get_next_working_time().timestamp())
+    interval = max(1, ADMIN_DIGEST_INTERVAL)
+    return (now_ts() // interval + 1) * interval
+
+async def schedule_admin_digest():
+    """Постановка сводки на ближайший срок"""
+    run_at = admin_digest_time()
+    if admin_digest_scheduled["run_at"] == run_at:
+        return
+    
+    # Ключ по сроку: события одного окна (и целой ночи) попадают в одну сводку
+    # даже при нескольких экземплярах бота
+    await job_queue.enqueue("admin_digest", run_at=run_at, key=f"admin_digest:{run_at}")
+    admin_digest_scheduled["run_at"] = run_at
+
+async def admin_event(kind: str, text: str, mailing_id: int = None, user_id: int = None,
+                      username: str = None, details: str = None):
+    """Событие для администратора: в ближайшую сводку или сразу, если тип срочный.
+    
+    text - отдельное уведомление на случай немедленной отправки, details - строка
+    события в перечне сводки (комментарий, данные анкеты).
+    """
+    if not ADMIN_ID:
+        return
+    
+    if kind in ADMIN_URGENT_EVENTS or ADMIN_DIGEST_INTERVAL <= 0:
+        await notify_admin(text)
+        return
+    
+    db.writes.submit("add_admin_event", kind, mailing_id, user_id, username, details)
+    try:
+        await schedule_admin_digest()
+    except Exception as e:
+        logger.error(f"❌ Не удалось запланировать сводку администратору: {e}")
+
+def build_admin_digest(events) -> str:
+    """Текст сводки: итоги по каждой рассылке и перечни остальных событий"""
+    mailings = {}
+    sections = {}
+    for event in events:
+        kind = event['kind']
+        if kind in MAILING_EVENT_KINDS and event['mailing_id'] is not None:
+            counts = mailings.setdefault(event['mailing_id'], dict.fromkeys(MAILING_EVENT_KINDS, 0))
+            counts[kind] += 1
+        if kind not in MAILING_EVENT_KINDS or kind == "comment":
+            sections.setdefault(kind, []).append(event)
+    
+    lines = [
+        f"📬 <b>СВОДКА СОБЫТИЙ ({len(events)})</b>",
+        f"🕐 {format_ts(events[0]['created_at'])} - {format_ts(events[-1]['created_at'])}",
+        ""
+    ]
+    
+    for mailing_id, counts in sorted(mailings.items()):
+        parts = []
+        if counts['like']:
+            parts.append(f"+{counts['like']} 👍")
+        if counts['dislike']:
+            parts.append(f"{counts['dislike']} 👎")
+        if counts['unsubscribe']:
+            parts.append(f"🚫 отписок: {counts['unsubscribe']}")
+        if counts['comment']:
+            parts.append(f"💬 комментариев: {counts['comment']}")
+        lines.append(f"📨 <b>Рассылка #{mailing_id}:</b> {', '.join(parts)}")
+    
+    for kind, items in sections.items():
+        lines.append("")
+        lines.append(f"<b>{ADMIN_DIGEST_SECTIONS.get(kind, kind)} ({len(items)}):</b>")
+        for event in items[:ADMIN_DIGEST_DETAILS]:
+            who = f"@{event['username']}" if event['username'] else f"ID {event['user_id']}"
+            prefix = f"#{event['mailing_id']} " if kind == "comment" else ""
+            details = html.escape((event['details'] or "")[:300], quote=False)
+            lines.append(f"• {prefix}{html.escape(who, quote=False)}: {details}")
+        if len(items) > ADMIN_DIGEST_DETAILS:
+            lines.append(f"<i>... и еще {len(items) - ADMIN_DIGEST_DETAILS}</i>")
+    
+    return "\n".join(lines)
+
+def split_message(text: str, limit: int = 4096) -> list:
+    """Разбиение длинного текста по строкам на сообщения не длиннее limit"""
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        if current and len(current) + len(line) + 1 > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    chunks.append(current)
+    return chunks
+
+def split_admin_digest(events, limit: int = 4096):
+    """Разбиение событий на части, сводка каждой из которых умещается в одно сообщение.
+    
+    Возвращает пары (события части, текст): часть удаляется из базы сразу после
+    отправки, и повтор задачи после сбоя не пришлет ее администратору еще раз.
+    Длина сводки растет с числом событий, поэтому самая длинная умещающаяся
+    часть ищется делением пополам.
+    """
+    parts = []
+    while events:
+        low, high = 1, len(events)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if len(build_admin_digest(events[:middle])) <= limit:
+                low = middle
+            else:
+                high = middle - 1
+        
+        text = build_admin_digest(events[:low])
+        if len(text) > limit:
+            # Одно событие длиннее сообщения: режется по строкам
+            parts.extend((events[:low], chunk) for chunk in split_message(text, limit))
+        else:
+            parts.append((events[:low], text))
+        events = events[low:]
+    return parts
+
+async def run_admin_digest_job(payload: dict):
+    """Задача admin_digest: все накопленные события сводкой (при необходимости в несколько сообщений)"""
+    if not ADMIN_ID:
+        return
+    
+    async with admin_digest_lock:
+        if not is_working_hours():
+            # Окно закончилось уже после рабочего дня: события ждут следующего
+            await schedule_admin_digest()
+            return
+        
+        await db.writes.flush()
+        events = await db.get_admin_events()
+        if not events:
+            return
+        
+        for part, text in split_admin_digest(events):
+            await bot.send_message(ADMIN_ID, text, parse_mode=ParseMode.HTML)
+            await db.delete_admin_events([event['id'] for event in part])
+        logger.info(f"📬 Сводка из {len(events)} событий отправлена администратору")
+
+job_queue.register("admin_digest", run_admin_digest_job)
+
 # =========== ФУНКЦИЯ ОТПРАВКИ ЧАСТИЧНОЙ АНКЕТЫ АДМИНИСТРАТОРУ ===========
 async def send_partial_questionnaire_to_admin(questionnaire_id: int, user_id: int, user_data: dict, username: str):
     """Отправка первой части анкеты администратору"""
@@ -1307,8 +2943,7 @@ async def send_partial_questionnaire_to_admin(questionnaire_id: int, user_id: in
         logger.warning("ADMIN_ID не установлен, анкета не отправлена администратору")
         return
     
-    try:
-        admin_message = f"""
+    admin_message = f"""
 📋 <b>ЧАСТИЧНАЯ АНКЕТА #{questionnaire_id} (1-4 пункты)</b>
 
 👤 <b>Пользователь:</b> @{username or 'без username'}
@@ -1331,13 +2966,16 @@ async def send_partial_questionnaire_to_admin(questionnaire_id: int, user_id: in
 
 <i>Пользователь ожидает выгрузку тендеров.
 Для завершения анкеты нужны контакты (пункты 5-8).</i>
-        """
-        
-        await bot.send_message(ADMIN_ID, admin_message, parse_mode=ParseMode.HTML)
-        logger.info(f"Частичная анкета #{questionnaire_id} отправлена администратору")
-        
-    except Exception as e:
-        logger.error(f"Ошибка при отправке частичной анкеты администратору: {e}")
+    """
+    
+    await admin_event(
+        "partial_questionnaire",
+        admin_message,
+        user_id=user_id,
+        username=username,
+        details=f"#{questionnaire_id}: {user_data.get('activity', 'Не указано')}, {user_data.get('region', 'Не указано')}"
+    )
+    logger.info(f"Частичная анкета #{questionnaire_id} поставлена в очередь администратору")
 
 # =========== ФУНКЦИЯ ОТПРАВКИ ПОЛНОЙ АНКЕТЫ АДМИНИСТРАТОРУ ===========
 async def send_questionnaire_to_admin(questionnaire_id: int, user_id: int, user_data: dict, username: str, anketa_path: str = None):
@@ -1346,8 +2984,7 @@ async def send_questionnaire_to_admin(questionnaire_id: int, user_id: int, user_
         logger.warning("ADMIN_ID не установлен, анкета не отправлена администратору")
         return
     
-    try:
-        admin_message = f"""
+    admin_message = f"""
 📋 <b>НОВАЯ АНКЕТА #{questionnaire_id}</b>
 
 👤 <b>Пользователь:</b> @{username or 'без username'}
@@ -1380,33 +3017,21 @@ async def send_questionnaire_to_admin(questionnaire_id: int, user_id: int, user_
 <b>8. Email для отправки тендеров:</b>
 {user_data.get('email', 'Не указано')}
 
-{'✅ <b>Заполнено в рабочее время</b>' if db.is_working_hours() else '⏰ <b>Заполнено в нерабочее время</b>'}
-        """
-        
-        if anketa_path and os.path.exists(anketa_path):
-            # Используем BufferedInputFile для отправки файла
-            with open(anketa_path, 'rb') as f:
-                file_data = f.read()
-            
-            input_file = BufferedInputFile(
-                file_data,
-                filename=f"Анкета_{questionnaire_id}_{username or 'user'}.docx"
-            )
-            
-            await bot.send_document(
-                ADMIN_ID,
-                document=input_file,
-                caption=admin_message,
-                parse_mode=ParseMode.HTML
-            )
-            
-            logger.info(f"Анкета #{questionnaire_id} с файлом отправлена администратору {ADMIN_ID}")
-        else:
-            await bot.send_message(ADMIN_ID, admin_message, parse_mode=ParseMode.HTML)
-            logger.info(f"Анкета #{questionnaire_id} отправлена администратору {ADMIN_ID}")
-        
-    except Exception as e:
-        logger.error(f"Ошибка при отправке анкеты администратору: {e}")
+{'✅ <b>Заполнено в рабочее время</b>' if is_working_hours() else '⏰ <b>Заполнено в нерабочее время</b>'}
+    """
+    
+    if anketa_path and os.path.exists(anketa_path):
+        # Файл читается исполнителем очереди в момент отправки
+        await notify_admin(media={
+            "type": "document",
+            "path": anketa_path,
+            "filename": f"Анкета_{questionnaire_id}_{username or 'user'}.docx",
+            "caption": admin_message
+        })
+        logger.info(f"Анкета #{questionnaire_id} с файлом поставлена в очередь администратору {ADMIN_ID}")
+    else:
+        await notify_admin(admin_message)
+        logger.info(f"Анкета #{questionnaire_id} поставлена в очередь администратору {ADMIN_ID}")
 
 # =========== ФУНКЦИЯ ОТПРАВКИ ФАЙЛА ANKETA.DOCX ===========
 async def send_anketa_file(message: types.Message, file_path: str):
@@ -1497,59 +3122,132 @@ async def send_export_notification_to_user(user_id: int, export_id: int, export_
         logger.error(f"❌ Ошибка отправки уведомления о выгрузке пользователю {user_id}: {e}")
 
 # =========== ФУНКЦИЯ ДЛЯ ОТПРАВКИ FOLLOW-UP СООБЩЕНИЙ ===========
-async def send_follow_up_messages():
-    """Отправка follow-up сообщений через 1 час после выгрузке"""
+async def deliver_follow_up(engine: BroadcastEngine, export):
+    """Follow-up по одной выгрузке: вопрос пользователю (ошибка, кроме недоступного чата, пробрасывается)"""
+    export_id = export['id']
+    user_id = export['user_id']
+    
     try:
-        exports = db.get_exports_for_followup()
+        await engine.call(user_id, functools.partial(
+            bot.send_message,
+            user_id,
+            f"📨 <b>Подборка тендеров отправлена!</b>\n\n"
+            f"Удалось ли найти что-то подходящее?",
+            reply_markup=get_follow_up_keyboard(export_id),
+            parse_mode=ParseMode.HTML
+        ))
+        
+        logger.info(f"Follow-up отправлен пользователю {user_id} для выгрузки #{export_id}")
         
+    except Exception as e:
+        # Недоступному пользователю follow-up не повторяем, остальные ошибки - повтор
+        if not is_unreachable(e):
+            raise
+        logger.error(f"Ошибка отправки follow-up пользователю {user_id}: {e}")
+        mark_user_unreachable(user_id)
+
+async def send_follow_up_batch(exports) -> list:
+    """Пачка follow-up: FOLLOW_UP_CONCURRENCY отправок одновременно и одна отметка завершенных (их ID)"""
+    # Follow-up идут через общий лимит рассылок и учитывают RetryAfter
+    engine = BroadcastEngine(broadcast_bucket, broadcast_chat_limiter, FOLLOW_UP_CONCURRENCY)
+    done = []
+    
+    async def iterate():
         for export in exports:
-            export_id = export['id']
-            user_id = export['user_id']
-            username = export['username'] or "Пользователь"
-            
-            try:
-                await bot.send_message(
-                    user_id,
-                    f"📨 <b>Подборка тендеров отправлена!</b>\n\n"
-                    f"Удалось ли найти что-то подходящее?",
-                    reply_markup=get_follow_up_keyboard(export_id),
-                    parse_mode=ParseMode.HTML
-                )
-                
-                db.mark_followup_sent(export_id)
-                
-                logger.info(f"Follow-up отправлен пользователю {user_id} для выгрузки #{export_id}")
+            yield export
+    
+    async def send(export) -> bool:
+        try:
+            await deliver_follow_up(engine, export)
+        except Exception as e:
+            logger.error(f"Ошибка отправки follow-up пользователю {export['user_id']}: {e}")
+            return False
+        done.append(export['id'])
+        return True
+    
+    await engine.run(iterate(), send)
+    
+    if done:
+        await db.mark_followups_sent(done)
+    flush_unreachable_users()
+    return done
+
+# Один проход по наступившим follow-up за раз: задачи, наступившие одновременно,
+# не отправляют одну выгрузку дважды
+follow_up_lock = asyncio.Lock()
+
+async def send_follow_up_messages() -> int:
+    """Отправка всех наступивших follow-up пачками по FOLLOW_UP_BATCH (число отправленных)"""
+    sent = 0
+    async with follow_up_lock:
+        try:
+            after_id = 0
+            while True:
+                exports = await db.get_exports_for_followup(FOLLOW_UP_DELAY, FOLLOW_UP_BATCH, after_id)
+                if not exports:
+                    break
                 
-            except Exception as e:
-                logger.error(f"Ошибка отправки follow-up пользователю {user_id}: {e}")
+                sent += len(await send_follow_up_batch(exports))
+                # Неудачные остаются до повтора задачи follow-up по своей выгрузке
+                after_id = exports[-1]['id']
                 
-    except Exception as e:
-        logger.error(f"Ошибка в send_follow_up_messages: {e}")
+        except Exception as e:
+            logger.error(f"Ошибка в send_follow_up_messages: {e}")
+    
+    return sent
 
 # =========== ФУНКЦИЯ ДЛЯ ПЛАНИРОВАНИЯ FOLLOW-UP ===========
-async def schedule_follow_ups():
-    """Планирование отправки follow-up сообщений"""
-    while True:
-        try:
-            await send_follow_up_messages()
-        except Exception as e:
-            logger.error(f"Ошибка в schedule_follow_ups: {e}")
-        
-        await asyncio.sleep(300)
+# Каждая выгрузка - задача follow_up в очереди задач (job_queue) на точный срок:
+# переживает перезапуск и повторяется, если Telegram был недоступен
+async def schedule_follow_up(export_id: int, sent_at: int):
+    """Задача follow-up через FOLLOW_UP_DELAY после выгрузки (одна на выгрузку)"""
+    return await job_queue.enqueue("follow_up", {"export_id": export_id}, sent_at + FOLLOW_UP_DELAY,
+                                   key=f"follow_up:{export_id}")
+
+async def run_follow_up_job(payload: dict):
+    """Задача follow_up: все наступившие follow-up одной пачкой, включая эту выгрузку.
+    
+    Задачи выгрузок, отправленных в той же пачке, завершаются без отправки.
+    """
+    export_id = payload['export_id']
+    if not await db.get_export_for_followup(export_id):
+        # Follow-up уже отправлен или выгрузка изменилась
+        return
+    
+    await send_follow_up_messages()
+    
+    if await db.get_export_for_followup(export_id):
+        raise RuntimeError(f"follow-up по выгрузке #{export_id} не отправлен")
+
+job_queue.register("follow_up", run_follow_up_job)
+
+async def complete_export(export_id: int, admin_name: str):
+    """Отметка отправленной выгрузки и постановка follow-up в очередь задач"""
+    sent_at = await db.mark_export_completed(export_id, admin_name)
+    if sent_at is not None:
+        await schedule_follow_up(export_id, sent_at)
+
+async def load_follow_ups():
+    """Задачи follow-up для выгрузок, ожидающих вопроса (при запуске; поставленные ранее пропускаются)"""
+    queued = 0
+    for export in await db.get_pending_followups():
+        if await schedule_follow_up(export['id'], export['sent_at'] or now_ts()) is not None:
+            queued += 1
+    if queued:
+        logger.info(f"⏰ Поставлено в очередь follow-up: {queued}")
 
 # =========== ФУНКЦИЯ ЗАПРОСА КОНТАКТОВ ДЛЯ ВЫГРУЗКИ ===========
-async def send_contacts_request(user_id: int, export_id: int, export_data: dict):
-    """Отправка запроса на контакты пользователю"""
-    try:
-        # Получаем частичную анкету пользователя для данных
-        questionnaires = db.get_partial_questionnaires()
-        user_questionnaire = None
-        for q in questionnaires:
-            if q['user_id'] == user_id:
-                user_questionnaire = q
-                break
-        
-        message_text = f"""
+async def send_contacts_request(user_id: int, export_id: int):
+    """Отправка запроса на контакты пользователю (ошибка пробрасывается очереди задач)"""
+    # Получаем частичную анкету пользователя для данных
+    questionnaires = await db.get_partial_questionnaires()
+    user_questionnaire = None
+    for q in questionnaires:
+        if q['user_id'] == user_id:
+            user_questionnaire = q
+            break
+    
+    message_text = f"""
 📋 <b>Мы проанализировали вашу анкету!</b>
 
 ✅ <b>Подготовили для Вас список тендеров</b>
@@ -1563,43 +3261,49 @@ async def send_contacts_request(user_id: int, export_id: int, export_data: dict)
 
 <i>Заполните оставшиеся пункты анкеты, и мы сразу отправим вам подготовленную выгрузку.</i>
 """
-        
-        # Создаем новую запись о запросе контактов
-        db.create_contact_request(user_id, export_id)
-        
-        # Отправляем сообщение пользователю с кнопкой для заполнения контактов
-        await bot.send_message(
-            user_id,
-            message_text,
-            reply_markup=get_request_contacts_keyboard(export_id),
-            parse_mode=ParseMode.HTML
-        )
-        
-        logger.info(f"✅ Запрос контактов отправлен пользователю {user_id} для выгрузки #{export_id}")
-        
-        # Уведомляем администратора о запросе контактов
-        if ADMIN_ID:
-            try:
-                user = db.get_user_by_id(user_id)
-                user_name = f"{user['first_name']} {user['last_name'] or ''}" if user else f"ID: {user_id}"
-                
-                await bot.send_message(
-                    ADMIN_ID,
-                    f"📨 <b>Запрос контактов отправлен пользователю</b>\n\n"
-                    f"👤 Пользователь: {user_name}\n"
-                    f"🆔 ID: {user_id}\n"
-                    f"📋 Выгрузка ID: {export_id}\n\n"
-                    f"<i>Пользователю отправлен запрос на заполнение контактов для получения выгрузки.</i>",
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception as e:
-                logger.error(f"Ошибка уведомления администратора: {e}")
-        
-        return True
-        
+    
+    # Отправляем сообщение пользователю с кнопкой для заполнения контактов
+    await bot.send_message(
+        user_id,
+        message_text,
+        reply_markup=get_request_contacts_keyboard(export_id),
+        parse_mode=ParseMode.HTML
+    )
+    
+    logger.info(f"✅ Запрос контактов отправлен пользователю {user_id} для выгрузки #{export_id}")
+    
+    # Уведомляем администратора о запросе контактов
+    user = await db.get_user_by_id(user_id)
+    user_name = f"{user['first_name']} {user['last_name'] or ''}" if user else f"ID: {user_id}"
+    
+    await admin_event(
+        "contacts_request",
+        f"📨 <b>Запрос контактов отправлен пользователю</b>\n\n"
+        f"👤 Пользователь: {user_name}\n"
+        f"🆔 ID: {user_id}\n"
+        f"📋 Выгрузка ID: {export_id}\n\n"
+        f"<i>Пользователю отправлен запрос на заполнение контактов для получения выгрузки.</i>",
+        user_id=user_id,
+        username=user['username'] if user else None,
+        details=f"{user_name.strip()}, выгрузка #{export_id}"
+    )
+
+async def run_contacts_request_job(payload: dict):
+    """Задача contacts_request: запрос контактов; о недоступном пользователе сообщается администратору"""
+    user_id, export_id = payload['user_id'], payload['export_id']
+    try:
+        await send_contacts_request(user_id, export_id)
     except Exception as e:
-        logger.error(f"❌ Ошибка отправки запроса контактов пользователю {user_id}: {e}")
-        return False
+        if is_unreachable(e):
+            await notify_admin(
+                f"❌ <b>Не удалось отправить запрос контактов пользователю</b>\n\n"
+                f"🆔 ID: {user_id}\n"
+                f"📋 Выгрузка ID: {export_id}\n\n"
+                f"<i>Пользователь заблокировал бота или удалил чат.</i>"
+            )
+        raise
+
+job_queue.register("contacts_request", run_contacts_request_job)
 
 # =========== ФУНКЦИЯ ОТПРАВКИ ВЫГРУЗКИ ПОЛЬЗОВАТЕЛЮ ===========
 async def send_export_to_user(export_id: int, export_data: dict):
@@ -1637,7 +3341,7 @@ async def send_export_file_to_user(user_id: int, file_path: str, file_name: str,
             logger.info(f"✅ Файл выгрузки #{export_id} отправлен пользователю {user_id}")
             
             # Обновляем статус выгрузки
-            db.mark_export_completed(export_id, "Автоматическая отправка")
+            await complete_export(export_id, "Автоматическая отправка")
         else:
             await bot.send_message(
                 user_id,
@@ -1661,7 +3365,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
     user = message.from_user
     user_id = user.id
     
-    db.add_user(user_id, user.username or "", user.first_name, user.last_name or "")
+    await db.add_user(user_id, user.username or "", user.first_name, user.last_name or "")
     
     is_admin = ADMIN_ID and user_id == ADMIN_ID
     
@@ -1711,7 +3415,7 @@ async def cmd_my_exports(message: types.Message):
     """Мои выгрузки - показываем подробную информацию"""
     user_id = message.from_user.id
     
-    exports = db.get_user_exports(user_id)
+    exports = await db.get_user_exports(user_id)
     
     if not exports:
         await message.answer(
@@ -1726,7 +3430,7 @@ async def cmd_my_exports(message: types.Message):
     response = f"📋 <b>Ваши выгрузки тендеров ({len(exports)}):</b>\n\n"
     
     for i, export in enumerate(exports, 1):
-        date_str = export['sent_at'][:10] if export['sent_at'] else "??.??.????"
+        date_str = format_ts(export['sent_at'], '%d.%m.%Y', "??.??.????")
         status_icon = "✅" if export['status'] == 'completed' else "⏳" if export['status'] == 'pending' else "❌"
         status_text = {
             'completed': 'Отправлена',
@@ -1782,17 +3486,7 @@ async def handle_main_phone_contact(message: types.Message):
     phone = message.contact.phone_number
     
     # Сохраняем телефон в базе данных
-    conn = sqlite3.connect("tenders.db")
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    UPDATE users 
-    SET phone = ?
-    WHERE user_id = ?
-    ''', (phone, user_id))
-    
-    conn.commit()
-    conn.close()
+    await db.update_user_phone(user_id, phone)
     
     await message.answer(
         f"✅ <b>Телефон сохранен!</b>\n\n"
@@ -1910,6 +3604,7 @@ async def cancel_action(message: types.Message, state: FSMContext):
     if current_state in [ManagerDialog.waiting_for_message, 
                          ManualMailing.waiting_for_text,
                          ManualMailing.waiting_for_filter,
+                         ManualMailing.waiting_for_segment,
                          ManualMailing.waiting_for_confirmation,
                          FeedbackComment.waiting_for_comment,
                          SendExport.waiting_for_user_id,
@@ -1972,41 +3667,34 @@ async def process_manager_message(message: types.Message, state: FSMContext):
         await message.answer("❌ Извините, я могу принимать только текст, документы и фотографии.", parse_mode=ParseMode.HTML)
         return
     
-    message_id = db.save_manager_message(user_id, message_type, message_text, file_id, file_name)
+    message_id = await db.save_manager_message(user_id, message_type, message_text, file_id, file_name)
     
     if ADMIN_ID:
-        try:
-            admin_message = f"📩 <b>НОВОЕ СООБЩЕНИЕ ОТ ПОЛЬЗОВАТЕЛЯ</b>\n\n"
-            admin_message += f"👤 <b>Пользователь:</b> @{user.username or 'без username'}\n"
-            admin_message += f"🆔 <b>ID:</b> {user_id}\n"
-            admin_message += f"👤 <b>Имя:</b> {user.first_name} {user.last_name or ''}\n"
-            admin_message += f"📅 <b>Время:</b> {datetime.now().strftime('%H:%M %d.%m.%Y')}\n"
-            admin_message += f"📝 <b>Тип:</b> {message_type}\n\n"
-            
-            if message_type == "text":
-                admin_message += f"💬 <b>Сообщение:</b>\n{message_text[:500]}"
-                if len(message_text) > 500:
-                    admin_message += "..."
-            
-            elif message_type == "document":
-                admin_message += f"📎 <b>Документ:</b> {file_name}\n"
-                admin_message += f"💬 <b>Сообщение:</b>\n{message_text}"
-                
-            elif message_type == "photo":
-                admin_message += f"🖼 <b>Фотография</b>\n"
-                admin_message += f"💬 <b>Сообщение:</b>\n{message_text}"
-            
-            keyboard = get_manager_response_keyboard(message_id)
-            await bot.send_message(ADMIN_ID, admin_message, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+        admin_message = f"📩 <b>НОВОЕ СООБЩЕНИЕ ОТ ПОЛЬЗОВАТЕЛЯ</b>\n\n"
+        admin_message += f"👤 <b>Пользователь:</b> @{user.username or 'без username'}\n"
+        admin_message += f"🆔 <b>ID:</b> {user_id}\n"
+        admin_message += f"👤 <b>Имя:</b> {user.first_name} {user.last_name or ''}\n"
+        admin_message += f"📅 <b>Время:</b> {datetime.now().strftime('%H:%M %d.%m.%Y')}\n"
+        admin_message += f"📝 <b>Тип:</b> {message_type}\n\n"
+        
+        media = None
+        if message_type == "text":
+            admin_message += f"💬 <b>Сообщение:</b>\n{message_text[:500]}"
+            if len(message_text) > 500:
+                admin_message += "..."
+        
+        elif message_type == "document":
+            admin_message += f"📎 <b>Документ:</b> {file_name}\n"
+            admin_message += f"💬 <b>Сообщение:</b>\n{message_text}"
+            media = {"type": "document", "file_id": file_id, "caption": f"Документ от пользователя {user_id}"}
             
-            if file_id:
-                if message_type == "document":
-                    await bot.send_document(ADMIN_ID, file_id, caption=f"Документ от пользователя {user_id}", parse_mode=ParseMode.HTML)
-                elif message_type == "photo":
-                    await bot.send_photo(ADMIN_ID, file_id, caption=f"Фото от пользователя {user_id}", parse_mode=ParseMode.HTML)
-            
-        except Exception as e:
-            logger.error(f"Не удалось отправить уведомление админу: {e}")
+        elif message_type == "photo":
+            admin_message += f"🖼 <b>Фотография</b>\n"
+            admin_message += f"💬 <b>Сообщение:</b>\n{message_text}"
+            media = {"type": "photo", "file_id": file_id, "caption": f"Фото от пользователя {user_id}"}
+        
+        # Текст с кнопками и вложение - одна задача: администратор получит их по порядку
+        await notify_admin(admin_message, get_manager_response_keyboard(message_id), media)
     
     await message.answer(
         "✅ <b>Ваше сообщение отправлено менеджеру!</b>\n\n"
@@ -2028,19 +3716,7 @@ async def handle_call_callback(callback: types.CallbackQuery):
     
     message_id = int(callback.data.split("_")[1])
     
-    conn = sqlite3.connect("tenders.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT mm.*, u.phone, u.first_name, u.last_name 
-    FROM manager_messages mm
-    JOIN users u ON mm.user_id = u.user_id
-    WHERE mm.id = ?
-    ''', (message_id,))
-    
-    message = cursor.fetchone()
-    conn.close()
+    message = await db.get_manager_message(message_id)
     
     if not message:
         await callback.answer("Сообщение не найдено", show_alert=True)
@@ -2053,7 +3729,7 @@ async def handle_call_callback(callback: types.CallbackQuery):
         response = f"📞 <b>Телефон пользователя:</b> {phone}\n"
         response += f"👤 <b>Имя:</b> {user_name}\n"
         response += f"🆔 <b>ID:</b> {message['user_id']}\n"
-        response += f"📅 <b>Время сообщения:</b> {message['created_at'][:19]}"
+        response += f"📅 <b>Время сообщения:</b> {format_ts(message['created_at'], '%d.%m.%Y %H:%M:%S')}"
     else:
         response = "❌ У пользователя не указан телефон в анкете."
     
@@ -2069,19 +3745,7 @@ async def handle_write_callback(callback: types.CallbackQuery):
     
     message_id = int(callback.data.split("_")[1])
     
-    conn = sqlite3.connect("tenders.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT mm.*, u.username, u.first_name, u.last_name 
-    FROM manager_messages mm
-    JOIN users u ON mm.user_id = u.user_id
-    WHERE mm.id = ?
-    ''', (message_id,))
-    
-    message = cursor.fetchone()
-    conn.close()
+    message = await db.get_manager_message(message_id)
     
     if not message:
         await callback.answer("Сообщение не найдено", show_alert=True)
@@ -2114,17 +3778,7 @@ async def handle_done_callback(callback: types.CallbackQuery):
     
     message_id = int(callback.data.split("_")[1])
     
-    conn = sqlite3.connect("tenders.db")
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    UPDATE manager_messages 
-    SET processed = 1
-    WHERE id = ?
-    ''', (message_id,))
-    
-    conn.commit()
-    conn.close()
+    await db.mark_manager_message_processed(message_id)
     
     await callback.message.edit_text(
         callback.message.text + "\n\n✅ <b>ОБРАБОТАНО</b>",
@@ -2141,7 +3795,95 @@ async def handle_my_exports_callback(callback: types.CallbackQuery):
     await cmd_my_exports(callback.message)
     await callback.answer()
 
+# =========== ПОСТРАНИЧНЫЕ СПИСКИ АДМИНА ===========
+# Списки листаются кнопками с callback_data "pg:<список>:<n|p>:<курсор>", где
+# курсор - ключ сортировки крайней строки страницы (keyset), закодированный в base64url.
+# Каждый список регистрирует функцию отрисовки страницы: (cursor, direction) -> (текст, клавиатура)
+PAGED_VIEWS = {}
+
+def paged_view(name: str):
+    """Регистрация функции отрисовки страницы списка"""
+    def decorator(render):
+        PAGED_VIEWS[name] = render
+        return render
+    return decorator
+
+def encode_cursor(values) -> str:
+    """Непрозрачный курсор для callback_data"""
+    raw = ":".join(str(int(value or 0)) for value in values).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(token: str) -> Optional[tuple]:
+    """Разбор курсора из callback_data (None, если курсор поврежден)"""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        return tuple(int(value) for value in raw.split(":"))
+    except ValueError:
+        return None
+
+def get_pager_buttons(view: str, rows, key_fields: tuple, has_prev: bool, has_next: bool):
+    """Ряд кнопок «Назад / Далее» для страницы списка"""
+    buttons = []
+    if rows and has_prev:
+        cursor = encode_cursor(rows[0][field] for field in key_fields)
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"pg:{view}:p:{cursor}"))
+    if rows and has_next:
+        cursor = encode_cursor(rows[-1][field] for field in key_fields)
+        buttons.append(InlineKeyboardButton(text="Далее ➡️", callback_data=f"pg:{view}:n:{cursor}"))
+    return buttons
+
+@dp.callback_query(F.data.startswith("pg:"))
+async def handle_admin_page(callback: types.CallbackQuery):
+    """Перелистывание страниц админских списков"""
+    if not ADMIN_ID or callback.from_user.id != ADMIN_ID:
+        await callback.answer("⛔ Доступ запрещен", show_alert=True)
+        return
+    
+    parts = callback.data.split(":", 3)
+    render = PAGED_VIEWS.get(parts[1]) if len(parts) == 4 else None
+    cursor = decode_cursor(parts[3]) if render else None
+    
+    if cursor is None:
+        await callback.answer("Список устарел, откройте его заново", show_alert=True)
+        return
+    
+    try:
+        page = await render(cursor, "prev" if parts[2] == "p" else "next")
+        
+        if not page:
+            await callback.answer("Больше записей нет")
+            return
+        
+        text, keyboard = page
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+        await callback.answer()
+    except Exception as e:
+        logger.error(f"Ошибка перелистывания списка {parts[1]}: {e}")
+        await callback.answer("Не удалось открыть страницу", show_alert=True)
+
 # =========== АДМИН ПАНЕЛЬ ===========
+@paged_view("partial")
+async def render_partial_questionnaires_page(cursor: tuple = None, direction: str = "next"):
+    """Страница списка частичных анкет"""
+    questionnaires, has_prev, has_next = await db.get_partial_questionnaires_page(cursor, direction)
+    
+    if not questionnaires:
+        return None
+    
+    response = "📋 <b>Частичные анкеты (ожидают выгрузку):</b>\n\n"
+    
+    for q in questionnaires:
+        date_str = format_ts(q['created_at'], default="??.?? ??:??")
+        response += f"<b>#{q['id']}</b>\n"
+        response += f"👤 @{q['username'] or 'без username'}\n"
+        response += f"🎯 {(q['activity'] or '')[:30]}...\n"
+        response += f"📍 {(q['region'] or '')[:30]}...\n"
+        response += f"💰 {(q['budget'] or '')[:30]}...\n"
+        response += f"⏰ {date_str}\n\n"
+    
+    pager = get_pager_buttons("partial", questionnaires, ("created_at", "id"), has_prev, has_next)
+    return response, InlineKeyboardMarkup(inline_keyboard=[pager] if pager else [])
+
 @dp.message(F.text == "📊 Частичные анкеты")
 async def show_partial_questionnaires(message: types.Message):
     """Показать частичные анкеты (только 1-4 пункты)"""
@@ -2149,24 +3891,14 @@ async def show_partial_questionnaires(message: types.Message):
         await message.answer("⛔ Доступ запрещен", parse_mode=ParseMode.HTML)
         return
     
-    questionnaires = db.get_partial_questionnaires()
+    page = await render_partial_questionnaires_page()
     
-    if not questionnaires:
+    if not page:
         await message.answer("📭 Частичных анкет нет", parse_mode=ParseMode.HTML)
         return
     
-    response = f"📋 <b>Частичные анкеты (ожидают выгрузку) ({len(questionnaires)}):</b>\n\n"
-    
-    for i, q in enumerate(questionnaires, 1):
-        date_str = q['created_at'][:16] if q['created_at'] else "??.?? ??:??"
-        response += f"<b>{i}. #{q['id']}</b>\n"
-        response += f"👤 @{q['username'] or 'без username'}\n"
-        response += f"🎯 {q['activity'][:30]}...\n"
-        response += f"📍 {q['region'][:30]}...\n"
-        response += f"💰 {q['budget'][:30]}...\n"
-        response += f"⏰ {date_str}\n\n"
-    
-    await message.answer(response, parse_mode=ParseMode.HTML)
+    response, keyboard = page
+    await message.answer(response, reply_markup=keyboard, parse_mode=ParseMode.HTML)
 
 @dp.message(F.text == "📤 Отправить выгрузку")
 async def start_send_export(message: types.Message, state: FSMContext):
@@ -2199,23 +3931,23 @@ async def process_export_user_id(message: types.Message, state: FSMContext):
     user_id = int(message.text)
     
     # Проверяем существование пользователя в базе
-    user = db.get_user_by_id(user_id)
+    user = await db.get_user_by_id(user_id)
     
     if not user:
         # Если пользователя нет в базе, добавляем его
         try:
             # Пробуем получить информацию о пользователе через Telegram API
             chat = await bot.get_chat(user_id)
-            db.add_user(user_id, chat.username or "", chat.first_name or "", chat.last_name or "")
-            user = db.get_user_by_id(user_id)
+            await db.add_user(user_id, chat.username or "", chat.first_name or "", chat.last_name or "")
+            user = await db.get_user_by_id(user_id)
             
             if not user:
                 await message.answer(f"❌ Не удалось добавить пользователя {user_id} в базу данных", parse_mode=ParseMode.HTML)
                 return
         except Exception as e:
             # Если не удалось получить информацию, все равно добавляем с минимальными данными
-            db.add_user(user_id, "", f"Пользователь_{user_id}", "")
-            user = db.get_user_by_id(user_id)
+            await db.add_user(user_id, "", f"Пользователь_{user_id}", "")
+            user = await db.get_user_by_id(user_id)
     
     await state.update_data(user_id=user_id)
     await state.set_state(SendExport.waiting_for_export_file)
@@ -2251,7 +3983,7 @@ async def process_export_file(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    user = db.get_user_by_id(user_id)
+    user = await db.get_user_by_id(user_id)
     if not user:
         await message.answer("❌ Пользователь не найден", parse_mode=ParseMode.HTML)
         await state.clear()
@@ -2281,7 +4013,7 @@ async def process_export_file(message: types.Message, state: FSMContext):
             await bot.download_file(file_path, export_path)
             
             # Создаем запись о выгрузке
-            export_id = db.create_tender_export(
+            export_id = await db.create_tender_export(
                 user_id,
                 export_path,
                 file_name
@@ -2307,7 +4039,7 @@ async def process_export_file(message: types.Message, state: FSMContext):
                 f.write(text_export)
             
             # Создаем запись о выгрузке
-            export_id = db.create_tender_export(
+            export_id = await db.create_tender_export(
                 user_id,
                 export_path,
                 "Выгрузка_тендеров.txt"
@@ -2316,7 +4048,7 @@ async def process_export_file(message: types.Message, state: FSMContext):
         except Exception as e:
             logger.error(f"❌ Ошибка создания текстовой выгрузки: {e}")
             # Создаем выгрузку без файла
-            export_id = db.create_tender_export_without_file(user_id)
+            export_id = await db.create_tender_export_without_file(user_id)
     
     else:
         await message.answer("❌ Пожалуйста, отправьте файл или текст с выгрузкой", parse_mode=ParseMode.HTML)
@@ -2357,7 +4089,7 @@ async def handle_confirm_export(callback: types.CallbackQuery):
     
     export_id = int(callback.data.split("_")[2])
     
-    export = db.get_export_by_id(export_id)
+    export = await db.get_export_by_id(export_id)
     
     if not export:
         await callback.answer("Выгрузка не найдена", show_alert=True)
@@ -2367,7 +4099,7 @@ async def handle_confirm_export(callback: types.CallbackQuery):
         user_id = export['user_id']
         
         # Проверяем, есть ли у пользователя полная анкета с контактами
-        if db.has_complete_questionnaire(user_id):
+        if await db.has_complete_questionnaire(user_id):
             # Если контакты есть, отправляем выгрузку сразу
             await send_export_to_user(export_id, export)
             
@@ -2389,39 +4121,25 @@ async def handle_confirm_export(callback: types.CallbackQuery):
             
             logger.info(f"✅ Выгрузка #{export_id} отправлена пользователю {user_id}")
         else:
-            # Если контактов нет, отправляем запрос на контакты
-            success = await send_contacts_request(user_id, export_id, export)
+            # Если контактов нет, запрос контактов уходит через очередь задач
+            await db.create_contact_request(user_id, export_id)
+            await job_queue.enqueue("contacts_request", {"user_id": user_id, "export_id": export_id})
             
-            if success:
-                await callback.message.edit_text(
-                    callback.message.text + "\n\n📨 <b>ЗАПРОС КОНТАКТОВ ОТПРАВЛЕН</b>",
-                    reply_markup=None,
-                    parse_mode=ParseMode.HTML
-                )
-                
-                await callback.message.answer(
-                    f"📨 <b>Запрос контактов отправлен пользователю</b>\n\n"
-                    f"👤 Пользователь ID: {user_id}\n"
-                    f"📱 Username: @{export['username'] or 'без username'}\n"
-                    f"🆔 Выгрузка ID: {export_id}\n\n"
-                    f"<i>Пользователь получил сообщение с предложением заполнить контакты для получения выгрузки.</i>",
-                    parse_mode=ParseMode.HTML
-                )
-            else:
-                await callback.message.edit_text(
-                    callback.message.text + "\n\n❌ <b>ОШИБКА ОТПРАВКИ ЗАПРОСА КОНТАКТОВ</b>",
-                    reply_markup=None,
-                    parse_mode=ParseMode.HTML
-                )
-                
-                await callback.message.answer(
-                    f"❌ <b>Не удалось отправить запрос контактов пользователю</b>\n\n"
-                    f"👤 Пользователь ID: {user_id}\n"
-                    f"📱 Username: @{export['username'] or 'без username'}\n"
-                    f"🆔 Выгрузка ID: {export_id}\n\n"
-                    f"<i>Возможно, пользователь заблокировал бота или произошла ошибка отправки.</i>",
-                    parse_mode=ParseMode.HTML
-                )
+            await callback.message.edit_text(
+                callback.message.text + "\n\n📨 <b>ЗАПРОС КОНТАКТОВ ПОСТАВЛЕН В ОЧЕРЕДЬ</b>",
+                reply_markup=None,
+                parse_mode=ParseMode.HTML
+            )
+            
+            await callback.message.answer(
+                f"📨 <b>Запрос контактов поставлен в очередь отправки</b>\n\n"
+                f"👤 Пользователь ID: {user_id}\n"
+                f"📱 Username: @{export['username'] or 'без username'}\n"
+                f"🆔 Выгрузка ID: {export_id}\n\n"
+                f"<i>Пользователь получит сообщение с предложением заполнить контакты. "
+                f"Об отправке (или о том, что пользователь недоступен) придет уведомление.</i>",
+                parse_mode=ParseMode.HTML
+            )
         
         await callback.answer()
         
@@ -2438,7 +4156,7 @@ async def handle_cancel_export(callback: types.CallbackQuery):
     
     export_id = int(callback.data.split("_")[2])
     
-    export = db.get_export_by_id(export_id)
+    export = await db.get_export_by_id(export_id)
     if export and export['file_path'] and os.path.exists(export['file_path']):
         try:
             os.remove(export['file_path'])
@@ -2446,11 +4164,7 @@ async def handle_cancel_export(callback: types.CallbackQuery):
         except Exception as e:
             logger.error(f"Не удалось удалить файл при отмене выгрузки: {e}")
     
-    conn = sqlite3.connect("tenders.db")
-    cursor = conn.cursor()
-    cursor.execute('UPDATE tender_exports SET status = "cancelled" WHERE id = ?', (export_id,))
-    conn.commit()
-    conn.close()
+    await db.cancel_export(export_id)
     
     await callback.message.edit_text(
         callback.message.text + "\n\n❌ <b>ОТПРАВКА ОТМЕНЕНА</b>",
@@ -2467,11 +4181,11 @@ async def show_statistics(message: types.Message):
         await message.answer("⛔ Доступ запрещен", parse_mode=ParseMode.HTML)
         return
     
-    stats = db.get_statistics(14)
+    stats = await db.get_statistics(14)
     
-    # Получаем количество частичных и полных анкет
-    partial = len(db.get_partial_questionnaires())
-    complete = len(db.get_complete_questionnaires())
+    # Количество частичных и полных анкет берется из счетчиков
+    partial = stats['partial_questionnaires']
+    complete = stats['complete_questionnaires']
     
     response = f"""
 📊 <b>Статистика за 2 недели</b>
@@ -2519,7 +4233,7 @@ async def handle_follow_up_response(callback: types.CallbackQuery):
         }
         
         response_text = response_map.get(response_type, "Неизвестно")
-        db.save_followup_response(export_id, response_text)
+        await db.save_followup_response(export_id, response_text)
         
         thank_you_text = {
             "yes": "Отлично! Мы рады, что вы нашли подходящие тендеры. 🎉",
@@ -2533,21 +4247,14 @@ async def handle_follow_up_response(callback: types.CallbackQuery):
             parse_mode=ParseMode.HTML
         )
         
-        if ADMIN_ID:
-            try:
-                export = db.get_export_by_id(export_id)
-                if export:
-                    await bot.send_message(
-                        ADMIN_ID,
-                        f"📨 <b>ПОЛЬЗОВАТЕЛЬ ОТВЕТИЛ НА FOLLOW-UP</b>\n\n"
-                        f"👤 Пользователь: @{username}\n"
-                        f"🆔 ID: {user_id}\n"
-                        f"💬 Ответ: {response_text}\n"
-                        f"📅 Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}",
-                        parse_mode=ParseMode.HTML
-                    )
-            except Exception as e:
-                logger.error(f"Не удалось уведомить админа о follow-up: {e}")
+        if ADMIN_ID and await db.get_export_by_id(export_id):
+            await notify_admin(
+                f"📨 <b>ПОЛЬЗОВАТЕЛЬ ОТВЕТИЛ НА FOLLOW-UP</b>\n\n"
+                f"👤 Пользователь: @{username}\n"
+                f"🆔 ID: {user_id}\n"
+                f"💬 Ответ: {response_text}\n"
+                f"📅 Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}"
+            )
         
         await callback.answer()
         
@@ -2556,18 +4263,15 @@ async def handle_follow_up_response(callback: types.CallbackQuery):
         await callback.answer("Произошла ошибка", show_alert=True)
 
 # =========== УПРАВЛЕНИЕ ПОДПИСКАМИ ===========
-@dp.message(F.text == "👥 Управление подписками")
-async def manage_subscriptions(message: types.Message):
-    """Управление подписками пользователей"""
-    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
-        await message.answer("⛔ Доступ запрещен", parse_mode=ParseMode.HTML)
-        return
-    
-    users = db.get_all_users_with_subscription(30)
+# Списки подписок: фильтр -> имя постраничного списка
+SUBSCRIPTION_VIEWS = {"all": "subs_all", "subscribed": "subs_on", "unsubscribed": "subs_off"}
+
+async def render_subscriptions_page(cursor: tuple = None, direction: str = "next", filter_type: str = "all"):
+    """Страница списка пользователей для управления подписками"""
+    users, has_prev, has_next = await db.get_subscription_users_page(filter_type, cursor, direction)
     
     if not users:
-        await message.answer("👥 Пользователей нет", parse_mode=ParseMode.HTML)
-        return
+        return None
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
     
@@ -2589,27 +4293,64 @@ async def manage_subscriptions(message: types.Message):
             )
         ])
     
-    keyboard.inline_keyboard.append([
-        InlineKeyboardButton(text="✅ Только подписанные", callback_data="filter_subscribed"),
-        InlineKeyboardButton(text="❌ Только отписанные", callback_data="filter_unsubscribed")
-    ])
+    pager = get_pager_buttons(SUBSCRIPTION_VIEWS[filter_type], users, ("id",), has_prev, has_next)
+    if pager:
+        keyboard.inline_keyboard.append(pager)
     
-    keyboard.inline_keyboard.append([
-        InlineKeyboardButton(text="📊 Статистика подписок", callback_data="subscription_stats"),
-        InlineKeyboardButton(text="🔄 Обновить список", callback_data="refresh_subs")
-    ])
+    if filter_type == "all":
+        keyboard.inline_keyboard.append([
+            InlineKeyboardButton(text="✅ Только подписанные", callback_data="filter_subscribed"),
+            InlineKeyboardButton(text="❌ Только отписанные", callback_data="filter_unsubscribed")
+        ])
+        
+        keyboard.inline_keyboard.append([
+            InlineKeyboardButton(text="📊 Статистика подписок", callback_data="subscription_stats"),
+            InlineKeyboardButton(text="🔄 Обновить список", callback_data="refresh_subs")
+        ])
+        
+        header = "Выберите пользователя для управления его подпиской:\n\n"
+    else:
+        keyboard.inline_keyboard.append([
+            InlineKeyboardButton(text="👥 Все пользователи", callback_data="filter_all"),
+            InlineKeyboardButton(text="🔄 Обновить список", callback_data="refresh_subs")
+        ])
+        
+        filter_name = "подписанные" if filter_type == "subscribed" else "отписанные"
+        user_count = await db.count_users_by_filter(filter_type)
+        header = (
+            f"<b>Фильтр:</b> {filter_name}\n"
+            f"<b>Найдено пользователей:</b> {user_count}\n\n"
+        )
     
-    await message.answer(
+    text = (
         "👥 <b>Управление подписками на рассылку</b>\n\n"
-        "Выберите пользователя для управления его подпиской:\n\n"
+        f"{header}"
         "<b>Легенда:</b>\n"
         "✅ - подписан на рассылку\n"
         "❌ - отписан от рассылки\n"
         "📋 - заполнил анкету\n"
-        "📭 - без анкеты",
-        reply_markup=keyboard,
-        parse_mode=ParseMode.HTML
+        "📭 - без анкеты"
     )
+    return text, keyboard
+
+for _filter_type, _view in SUBSCRIPTION_VIEWS.items():
+    PAGED_VIEWS[_view] = functools.partial(render_subscriptions_page, filter_type=_filter_type)
+
+@dp.message(F.text == "👥 Управление подписками")
+async def manage_subscriptions(message: types.Message):
+    """Управление подписками пользователей"""
+    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ Доступ запрещен", parse_mode=ParseMode.HTML)
+        return
+    
+    page = await render_subscriptions_page()
+    
+    if not page:
+        await message.answer("👥 Пользователей нет", parse_mode=ParseMode.HTML)
+        return
+    
+    text, keyboard = page
+    await message.answer(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
 
 @dp.callback_query(F.data.startswith("manage_user_"))
 async def handle_manage_user(callback: types.CallbackQuery):
@@ -2620,7 +4361,7 @@ async def handle_manage_user(callback: types.CallbackQuery):
     
     user_id = int(callback.data.split("_")[2])
     
-    user_info = db.get_user_mailing_status(user_id)
+    user_info = await db.get_user_mailing_status(user_id)
     
     if not user_info:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -2653,13 +4394,13 @@ async def handle_toggle_subscription(callback: types.CallbackQuery):
     
     user_id = int(callback.data.split("_")[2])
     
-    new_status = db.toggle_user_mailing_subscription(user_id)
+    new_status = await db.toggle_user_mailing_subscription(user_id)
     
     if new_status is None:
         await callback.answer("Ошибка при изменении подписки", show_alert=True)
         return
     
-    user_info = db.get_user_mailing_status(user_id)
+    user_info = await db.get_user_mailing_status(user_id)
     
     if not user_info:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -2690,27 +4431,7 @@ async def handle_user_stats(callback: types.CallbackQuery):
     
     user_id = int(callback.data.split("_")[2])
     
-    conn = sqlite3.connect("tenders.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT u.*, 
-           COUNT(DISTINCT q.id) as questionnaire_count,
-           COUNT(DISTINCT te.id) as export_count,
-           COUNT(DISTINCT mm.id) as message_count,
-           COUNT(DISTINCT mf.id) as feedback_count
-    FROM users u
-    LEFT JOIN questionnaires q ON u.user_id = q.user_id
-    LEFT JOIN tender_exports te ON u.user_id = te.user_id
-    LEFT JOIN manager_messages mm ON u.user_id = mm.user_id
-    LEFT JOIN mailing_feedback mf ON u.user_id = mf.user_id
-    WHERE u.user_id = ?
-    GROUP BY u.user_id
-    ''', (user_id,))
-    
-    user = cursor.fetchone()
-    conn.close()
+    user = await db.get_user_activity_summary(user_id)
     
     if not user:
         await callback.answer("Пользователь не найден", show_alert=True)
@@ -2719,7 +4440,7 @@ async def handle_user_stats(callback: types.CallbackQuery):
     user_name = f"{user['first_name']} {user['last_name'] or ''}".strip()
     username = f"@{user['username']}" if user['username'] else "без username"
     
-    feedback = db.get_mailing_feedback_for_user(user_id)
+    feedback = await db.get_mailing_feedback_for_user(user_id)
     
     response = f"""
 📊 <b>Статистика пользователя</b>
@@ -2745,14 +4466,14 @@ async def handle_user_stats(callback: types.CallbackQuery):
 • Компания: {user['company'] or 'Не указана'}
 
 <b>Дата регистрации:</b>
-{user['created_at'][:19] if user['created_at'] else 'Неизвестно'}
+{format_ts(user['created_at'], '%d.%m.%Y %H:%M:%S', 'Неизвестно')}
 """
     
     if feedback:
         response += "\n<b>Последние отзывы:</b>\n"
         for i, fb in enumerate(feedback[:3], 1):
             fb_type = "👍" if fb['feedback_type'] == 'like' else "👎" if fb['feedback_type'] == 'dislike' else "💬" if fb['feedback_type'] == 'comment' else "🚫"
-            response += f"{i}. {fb_type} {fb['feedback_text'] or fb['feedback_type']} ({fb['created_at'][:16]})\n"
+            response += f"{i}. {fb_type} {fb['feedback_text'] or fb['feedback_type']} ({format_ts(fb['created_at'])})\n"
     
     await callback.message.answer(response, parse_mode=ParseMode.HTML)
     await callback.answer()
@@ -2764,33 +4485,7 @@ async def handle_subscription_stats(callback: types.CallbackQuery):
         await callback.answer("⛔ Доступ запрещен", show_alert=True)
         return
     
-    conn = sqlite3.connect("tenders.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT 
-        COUNT(*) as total_users,
-        SUM(CASE WHEN mailing_subscribed = 1 THEN 1 ELSE 0 END) as subscribed,
-        SUM(CASE WHEN mailing_subscribed = 0 THEN 1 ELSE 0 END) as unsubscribed,
-        SUM(CASE WHEN has_filled_questionnaire = 1 THEN 1 ELSE 0 END) as with_anketa,
-        SUM(CASE WHEN has_filled_questionnaire = 0 THEN 1 ELSE 0 END) as without_anketa
-    FROM users 
-    WHERE is_active = 1
-    ''')
-    
-    stats = cursor.fetchone()
-    
-    cursor.execute('''
-    SELECT COUNT(*) as recent_unsubscribes
-    FROM mailing_feedback 
-    WHERE feedback_type = 'unsubscribe'
-    AND date(created_at) >= date('now', '-30 days')
-    ''')
-    
-    recent = cursor.fetchone()
-    
-    conn.close()
+    stats = await db.get_subscription_stats()
     
     percentage = (stats['subscribed'] / stats['total_users'] * 100) if stats['total_users'] > 0 else 0
     
@@ -2808,7 +4503,7 @@ async def handle_subscription_stats(callback: types.CallbackQuery):
 • Без анкеты: {stats['without_anketa']}
 
 <b>Отписки за 30 дней:</b>
-• Всего отписок: {recent['recent_unsubscribes']}
+• Всего отписок: {stats['recent_unsubscribes']}
 """
     
     await callback.message.answer(response, parse_mode=ParseMode.HTML)
@@ -2817,7 +4512,21 @@ async def handle_subscription_stats(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "refresh_subs")
 async def handle_refresh_subs(callback: types.CallbackQuery):
     """Обновление списка подписок"""
-    await manage_subscriptions(callback.message)
+    if not ADMIN_ID or callback.from_user.id != ADMIN_ID:
+        await callback.answer("⛔ Доступ запрещен", show_alert=True)
+        return
+    
+    page = await render_subscriptions_page()
+    
+    if not page:
+        await callback.answer("Пользователей нет", show_alert=True)
+        return
+    
+    text, keyboard = page
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Ошибка обновления списка подписок: {e}")
     await callback.answer("Список обновлен")
 
 @dp.callback_query(F.data.startswith("filter_"))
@@ -2828,58 +4537,18 @@ async def handle_filter_subs(callback: types.CallbackQuery):
         return
     
     filter_type = callback.data.split("_")[1]
+    if filter_type not in SUBSCRIPTION_VIEWS:
+        filter_type = "all"
     
-    if filter_type == "subscribed":
-        users = db.get_users_by_filter("subscribed")
-        filter_name = "подписанные"
-    elif filter_type == "unsubscribed":
-        users = db.get_users_by_filter("unsubscribed")
-        filter_name = "отписанные"
-    else:
-        users = db.get_all_users_with_subscription(30)
-        filter_name = "все"
+    page = await render_subscriptions_page(filter_type=filter_type)
     
-    if not users:
+    if not page:
+        filter_name = {"subscribed": "подписанные", "unsubscribed": "отписанные"}.get(filter_type, "все")
         await callback.answer(f"Нет пользователей с фильтром '{filter_name}'", show_alert=True)
         return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
-    
-    for user in users:
-        status_icon = "✅" if user['mailing_subscribed'] else "❌"
-        has_anketa = "📋" if user['has_filled_questionnaire'] else "📭"
-        
-        button_text = f"{status_icon} {has_anketa} {user['first_name']}"
-        if user['last_name']:
-            button_text += f" {user['last_name']}"
-        
-        if user['username']:
-            button_text += f" (@{user['username']})"
-        
-        keyboard.inline_keyboard.append([
-            InlineKeyboardButton(
-                text=button_text[:50],
-                callback_data=f"manage_user_{user['user_id']}"
-            )
-        ])
-    
-    keyboard.inline_keyboard.append([
-        InlineKeyboardButton(text="👥 Все пользователи", callback_data="filter_all"),
-        InlineKeyboardButton(text="🔄 Обновить список", callback_data="refresh_subs")
-    ])
-    
-    await callback.message.edit_text(
-        f"👥 <b>Управление подписками на рассылку</b>\n\n"
-        f"<b>Фильтр:</b> {filter_name}\n"
-        f"<b>Найдено пользователей:</b> {len(users)}\n\n"
-        "<b>Легенда:</b>\n"
-        "✅ - подписан на рассылку\n"
-        "❌ - отписан от рассылки\n"
-        "📋 - заполнил анкету\n"
-        "📭 - без анкеты",
-        reply_markup=keyboard,
-        parse_mode=ParseMode.HTML
-    )
+    text, keyboard = page
+    await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
     
     await callback.answer()
 
@@ -2896,37 +4565,131 @@ async def start_create_mailing(message: types.Message, state: FSMContext):
         "📨 <b>Создание ручной рассылки</b>\n\n"
         "Введите текст рассылки. Вы можете использовать HTML-разметку:\n"
         "<b>жирный</b>, <i>курсив</i>, <code>код</code>\n\n"
+        "Можно отправить фото, документ, видео или альбом - подпись станет текстом рассылки.\n\n"
         "<i>Для отмены нажмите '❌ Отмена'</i>",
         reply_markup=get_cancel_keyboard(),
         parse_mode=ParseMode.HTML
     )
 
+# Типы вложений рассылки: название для администратора и класс части альбома
+MAILING_MEDIA_TYPES = {
+    "photo": ("фото", InputMediaPhoto),
+    "document": ("документ", InputMediaDocument),
+    "video": ("видео", InputMediaVideo),
+}
+
+# Части альбомов, присланных для рассылки: media_group_id -> (ID сообщения, вложение, подпись)
+mailing_albums: Dict[str, list] = {}
+
+def get_message_media(message: types.Message) -> Optional[dict]:
+    """Вложение сообщения для рассылки: тип и file_id (у фото - самый большой размер)"""
+    if message.photo:
+        return {"type": "photo", "file_id": message.photo[-1].file_id}
+    if message.document:
+        return {"type": "document", "file_id": message.document.file_id}
+    if message.video:
+        return {"type": "video", "file_id": message.video.file_id}
+    return None
+
+def describe_mailing_media(media: list) -> str:
+    """Краткое описание вложений рассылки: «фото: 2, документ: 1»"""
+    counts = {}
+    for item in media:
+        name = MAILING_MEDIA_TYPES[item['type']][0]
+        counts[name] = counts.get(name, 0) + 1
+    return ", ".join(f"{name}: {count}" for name, count in counts.items())
+
 @dp.message(ManualMailing.waiting_for_text)
 async def process_mailing_text(message: types.Message, state: FSMContext):
-    """Обработка текста рассылки"""
+    """Обработка текста или вложений рассылки"""
     if message.text == "❌ Отмена":
         await state.clear()
         await message.answer("❌ Создание рассылки отменено.", reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
         return
     
-    await state.update_data(mailing_text=message.text)
+    media = get_message_media(message)
+    if message.media_group_id and media:
+        # Части альбома приходят отдельными сообщениями: первое собирает остальные
+        album = mailing_albums.setdefault(message.media_group_id, [])
+        album.append((message.message_id, media, message.caption))
+        if len(album) > 1:
+            return
+        
+        # Ожидание, пока части не перестанут приходить
+        received = 0
+        while received != len(album):
+            received = len(album)
+            await asyncio.sleep(MEDIA_GROUP_WAIT)
+        album = sorted(album, key=lambda part: part[0])
+        media = [item for _, item, _ in album]
+        mailing_text = next((caption for *_, caption in album if caption), "")
+    elif media:
+        media = [media]
+        mailing_text = message.caption or ""
+    elif message.text:
+        mailing_text = message.text
+    else:
+        await message.answer("❌ Отправьте текст, фото, документ, видео или альбом.", parse_mode=ParseMode.HTML)
+        return
+    
+    # Файлы уже загружены в Telegram: рассылка использует file_id без повторной загрузки
+    await state.update_data(mailing_text=mailing_text, mailing_media=media)
     await state.set_state(ManualMailing.waiting_for_filter)
+    if message.media_group_id:
+        # Части, пришедшие до смены состояния, попали в список и не начнут новый альбом
+        mailing_albums.pop(message.media_group_id, None)
     
+    saved = f"Вложения рассылки сохранены ({describe_mailing_media(media)})" if media else "Текст рассылки сохранен"
     await message.answer(
-        "✅ <b>Текст рассылки сохранен</b>\n\n"
+        f"✅ <b>{saved}</b>\n\n"
         "Теперь выберите категорию пользователей для рассылки:",
         reply_markup=get_mailing_filters_keyboard(),
         parse_mode=ParseMode.HTML
     )
 
+def ignore_late_album_part(message: types.Message):
+    """Часть альбома, пришедшая после сборки вложений рассылки, не считается ответом на вопрос"""
+    logger.warning(f"⚠️ Часть альбома {message.media_group_id} пришла после сборки рассылки и пропущена")
+
+# Категории рассылки как выражения сегментов: предпросмотр считается по битовым картам
+MAILING_FILTER_SEGMENTS = {
+    "all": "подписан",
+    "with_questionnaire": "анкета",
+    "without_questionnaire": "НЕ анкета",
+    "recent_week": "неделя",
+}
+
+async def segment_recipients(filter_type: str) -> Optional[list]:
+    """Получатели рассылки по сегменту (None для фиксированных категорий)"""
+    if not filter_type.startswith(SEGMENT_FILTER_PREFIX):
+        return None
+    return await segments.select(filter_type[len(SEGMENT_FILTER_PREFIX):])
+
 @dp.message(ManualMailing.waiting_for_filter)
 async def process_mailing_filter(message: types.Message, state: FSMContext):
     """Обработка фильтра для рассылки"""
+    if message.media_group_id:
+        ignore_late_album_part(message)
+        return
+    
     if message.text == "❌ Отмена":
         await state.clear()
         await message.answer("❌ Создание рассылки отменено.", reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
         return
     
+    if message.text == "🧩 Сегмент":
+        await state.set_state(ManualMailing.waiting_for_segment)
+        await message.answer(
+            "🧩 <b>Сегмент аудитории</b>\n\n"
+            "Введите выражение из признаков, например:\n"
+            "<code>анкета И месяц И НЕ отписан И регион=Владимир</code>\n\n"
+            f"{SEGMENT_HELP}\n\n"
+            "<i>Рассылка уйдет только активным пользователям, подписанным на рассылки.</i>",
+            reply_markup=get_cancel_keyboard(),
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
     filter_map = {
         "👥 Все подписанные": "all",
         "📝 С анкетами": "with_questionnaire",
@@ -2940,9 +4703,9 @@ async def process_mailing_filter(message: types.Message, state: FSMContext):
     
     filter_type = filter_map[message.text]
     
-    users = db.get_users_by_filter(filter_type)
+    user_count = await segments.count(MAILING_FILTER_SEGMENTS[filter_type])
     
-    if not users:
+    if not user_count:
         await message.answer(
             f"❌ Нет пользователей по выбранному фильтру: {message.text}\n"
             "Попробуйте выбрать другую категорию.",
@@ -2951,7 +4714,45 @@ async def process_mailing_filter(message: types.Message, state: FSMContext):
         )
         return
     
-    await state.update_data(filter_type=filter_type, user_count=len(users))
+    await ask_mailing_confirmation(message, state, filter_type, message.text, user_count)
+
+@dp.message(ManualMailing.waiting_for_segment)
+async def process_mailing_segment(message: types.Message, state: FSMContext):
+    """Выражение сегмента: размер аудитории считается сразу по битовым картам"""
+    if message.media_group_id:
+        ignore_late_album_part(message)
+        return
+    
+    if message.text == "❌ Отмена":
+        await state.clear()
+        await message.answer("❌ Создание рассылки отменено.", reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
+        return
+    
+    expression = (message.text or "").strip()
+    try:
+        user_count = await segments.count(expression)
+    except SegmentError as e:
+        await message.answer(
+            f"❌ {html.escape(str(e))}\n\nИсправьте выражение или нажмите «❌ Отмена».",
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
+    if not user_count:
+        await message.answer(
+            f"❌ В сегменте <code>{html.escape(expression)}</code> нет подписанных пользователей.\n"
+            "Измените выражение.",
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
+    await ask_mailing_confirmation(message, state, f"{SEGMENT_FILTER_PREFIX}{expression}",
+                                   f"🧩 {html.escape(expression)}", user_count)
+
+async def ask_mailing_confirmation(message: types.Message, state: FSMContext, filter_type: str,
+                                   category: str, user_count: int):
+    """Предпросмотр рассылки и запрос подтверждения"""
+    await state.update_data(filter_type=filter_type, user_count=user_count)
     await state.set_state(ManualMailing.waiting_for_confirmation)
     
     data = await state.get_data()
@@ -2960,224 +4761,941 @@ async def process_mailing_filter(message: types.Message, state: FSMContext):
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="✅ Да, отправить")],
+            [KeyboardButton(text="⏰ Запланировать"), KeyboardButton(text="🕘 В рабочее время")],
             [KeyboardButton(text="❌ Нет, отменить")]
         ],
         resize_keyboard=True
     )
     
+    media = data.get('mailing_media')
+    attachments = f"<b>Вложения:</b> {describe_mailing_media(media)}\n" if media else ""
+    
+    await message.answer(
+        f"📨 <b>Подтверждение рассылки</b>\n\n"
+        f"<b>Текст:</b>\n{mailing_text or '<i>без текста</i>'}\n\n"
+        f"{attachments}"
+        f"<b>Категория:</b> {category}\n"
+        f"<b>Количество пользователей:</b> {user_count}\n\n"
+        f"<i>Отправить рассылку?</i>",
+        reply_markup=keyboard,
+        parse_mode=ParseMode.HTML
+    )
+
+# Общий для всех рассылок лимит Telegram и лимит сообщений в один чат
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
+broadcast_chat_limiter = ChatRateLimiter(BROADCAST_CHAT_INTERVAL)
+
+# Получатели, которым доставка невозможна: деактивируются одним UPDATE на пачку,
+# чтобы следующие рассылки не тратили на них вызовы API
+unreachable_users: set = set()
+
+def mark_user_unreachable(user_id: int):
+    """Пользователь заблокировал бота или удален: исключается из будущих рассылок"""
+    unreachable_users.add(user_id)
+    if len(unreachable_users) >= UNREACHABLE_BATCH:
+        flush_unreachable_users()
+
+def flush_unreachable_users():
+    """Деактивация накопленных недоступных пользователей через буфер записи"""
+    if not unreachable_users:
+        return
+    user_ids = sorted(unreachable_users)
+    unreachable_users.clear()
+    db.writes.submit("deactivate_users", user_ids)
+    logger.info(f"🚫 Деактивированы недоступные пользователи: {len(user_ids)}")
+
+# Доставленные получатели по рассылкам: состояние 'sent' пишется одним UPDATE на пачку.
+# Не записанные до перезапуска остаются в 'sending' и повторно не отправляются
+delivered_recipients: Dict[int, list] = {}
+
+def record_delivery(mailing_id: int, user_id: int, telegram_message_id: int):
+    """Доставка получателю рассылки: копится до DELIVERY_BATCH записей"""
+    deliveries = delivered_recipients.setdefault(mailing_id, [])
+    deliveries.append((user_id, telegram_message_id))
+    if len(deliveries) >= DELIVERY_BATCH:
+        flush_delivered_recipients(mailing_id)
+
+def flush_delivered_recipients(mailing_id: int):
+    """Запись накопленных доставок рассылки через буфер записи"""
+    deliveries = delivered_recipients.pop(mailing_id, None)
+    if deliveries:
+        db.writes.submit("complete_mailing_recipients", mailing_id, deliveries)
+
+# Рассылки, которые отправляет этот процесс: ID -> фоновая задача и статус
+# (running / paused / cancelled); статус в БД - источник истины после перезапуска
+mailing_tasks: Dict[int, asyncio.Task] = {}
+mailing_job_status: Dict[int, str] = {}
+
+async def iter_queued_recipients(mailing_id: int, shard: int = 0, shards: int = 1):
+    """Поток получателей рассылки из очереди; обрывается при паузе или отмене"""
+    after_user_id = 0
+    while mailing_job_status.get(mailing_id) == "running":
+        page = await db.get_queued_recipients_page(mailing_id, after_user_id, shard=shard, shards=shards)
+        for recipient in page:
+            if mailing_job_status.get(mailing_id) != "running":
+                return
+            yield recipient
+        if len(page) < RECIPIENT_PAGE_SIZE:
+            return
+        after_user_id = page[-1]['user_id']
+
+def make_mailing_content(mailing) -> Callable[[int], Callable[[], Awaitable]]:
+    """Запрос отправки содержимого рассылки получателю: текст, одно вложение или альбом.
+    
+    Вложения отправляются по file_id из сообщения администратора: файл
+    загружен в Telegram один раз и не передается заново каждому получателю.
+    """
+    text = mailing['mailing_text'] or None
+    media = json.loads(mailing['media']) if mailing['media'] else None
+    
+    if not media:
+        send, payload, options = bot.send_message, text, {"parse_mode": ParseMode.HTML}
+    elif len(media) == 1:
+        send = getattr(bot, f"send_{media[0]['type']}")
+        payload, options = media[0]['file_id'], {"caption": text, "parse_mode": ParseMode.HTML}
+    else:
+        # Подпись альбома - у первой части; части собираются один раз на всю рассылку
+        send, options = bot.send_media_group, {}
+        payload = [
+            MAILING_MEDIA_TYPES[item['type']][1](
+                media=item['file_id'],
+                caption=text if index == 0 else None,
+                parse_mode=ParseMode.HTML
+            )
+            for index, item in enumerate(media)
+        ]
+    
+    # У альбома не бывает клавиатуры: вопрос об отзыве уходит отдельным сообщением
+    inline_feedback = MAILING_INLINE_FEEDBACK and len(media or []) < 2
+    
+    def request(user_id: int):
+        if inline_feedback:
+            return functools.partial(send, user_id, payload, **options,
+                                     reply_markup=get_inline_feedback_keyboard(mailing['id'], user_id))
+        return functools.partial(send, user_id, payload, **options)
+    
+    return request
+
+# Вопрос об отзыве, если клавиатура не прикреплена к самой рассылке
+MAILING_FEEDBACK_PROMPT = "💬 <b>Как вам эта рассылка?</b>\n\nПожалуйста, оставьте обратную связь:"
+
+async def send_mailing_to_user(engine: BroadcastEngine, mailing_id: int,
+                               content: Callable[[int], Callable[[], Awaitable]], user) -> Optional[bool]:
+    """Отправка рассылки одному получателю: содержимое и клавиатура обратной связи.
+    
+    Состояние получателя в mailing_recipients фиксируется до отправки содержимого
+    и после нее, поэтому после перезапуска рассылка продолжится без дублей.
+    С MAILING_INLINE_FEEDBACK клавиатура - в самом сообщении, доставка пишется
+    пачкой, а строка sent_messages появляется только при отклике.
+    """
+    user_id = user['user_id']
+    if mailing_job_status.get(mailing_id) != "running":
+        return None
+    
+    # Захват получателя из очереди: запись идет через буфер, один коммит на всех отправителей
+    if not await db.writes.submit("mark_recipient_sending", mailing_id, user_id):
+        return None
+    
+    try:
+        sent_message = await engine.call(user_id, content(user_id))
+        album = isinstance(sent_message, list)
+        if album:
+            # Альбом: сохраняется первое сообщение группы
+            sent_message = sent_message[0]
+        
+        if MAILING_INLINE_FEEDBACK:
+            record_delivery(mailing_id, user_id, sent_message.message_id)
+            if album:
+                await engine.call(user_id, functools.partial(
+                    bot.send_message,
+                    user_id,
+                    MAILING_FEEDBACK_PROMPT,
+                    reply_markup=get_inline_feedback_keyboard(mailing_id, user_id),
+                    parse_mode=ParseMode.HTML
+                ))
+            return True
+        
+        sent_message_id = await db.writes.submit(
+            "complete_mailing_recipient", mailing_id, user_id, sent_message.message_id
+        )
+        
+        await engine.call(user_id, functools.partial(
+            bot.send_message,
+            user_id,
+            MAILING_FEEDBACK_PROMPT,
+            reply_markup=get_mailing_feedback_keyboard(sent_message_id),
+            parse_mode=ParseMode.HTML
+        ))
+        return True
+        
+    except Exception as e:
+        if is_unreachable(e):
+            mark_user_unreachable(user_id)
+        logger.error(f"Не удалось отправить рассылку пользователю {user_id}: {e}")
+        db.writes.submit("fail_mailing_recipient", mailing_id, user_id, str(e)[:200])
+        return False
+
+async def save_mailing_job_stats(mailing_id: int):
+    """Перенос итогов очереди получателей в статистику рассылки"""
+    progress = await db.get_mailing_job_progress(mailing_id)
+    await db.update_mailing_stats(mailing_id, progress['sent'], progress['failed'])
+    return progress
+
+def format_mailing_progress(mailing_id: int, progress: dict, note: str, rate: float = None) -> str:
+    """Текст сообщения о ходе рассылки (скорость и оставшееся время - для идущей рассылки)"""
+    text = (
+        f"📨 <b>Рассылка #{mailing_id}</b>\n\n"
+        f"{note}\n\n"
+        f"✅ Отправлено: {progress['sent']}\n"
+        f"❌ Не удалось: {progress['failed']}\n"
+        f"⏳ В очереди: {progress['queued']}"
+    )
+    if rate:
+        eta = int(progress['queued'] / rate)
+        text += (
+            f"\n\n⚡ Скорость: {rate:.1f} получателей/с\n"
+            f"🕒 Осталось: ~{eta // 60} мин {eta % 60} с"
+        )
+    return text
+
+async def report_mailing_progress(mailing_id: int, chat_id: int, message_id: int):
+    """Обновление сообщения о ходе рассылки не чаще раза в MAILING_PROGRESS_INTERVAL секунд"""
+    started = time.monotonic()
+    initial = await db.get_mailing_job_progress(mailing_id)
+    last_text = None
+    
+    while True:
+        await asyncio.sleep(MAILING_PROGRESS_INTERVAL)
+        if mailing_job_status.get(mailing_id) != "running":
+            return
+        
+        progress = await db.get_mailing_job_progress(mailing_id)
+        processed = (progress['sent'] + progress['failed']) - (initial['sent'] + initial['failed'])
+        rate = processed / (time.monotonic() - started)
+        
+        text = format_mailing_progress(mailing_id, progress, "🔄 <b>Рассылка идет</b>", rate)
+        if text == last_text:
+            continue
+        
+        try:
+            # Правка сообщения - тоже вызов API: учитывается в общем лимите
+            await broadcast_bucket.acquire()
+            await bot.edit_message_text(
+                text,
+                chat_id=chat_id,
+                message_id=message_id,
+                reply_markup=get_mailing_job_keyboard(mailing_id, "running"),
+                parse_mode=ParseMode.HTML
+            )
+            last_text = text
+        except Exception as e:
+            logger.error(f"❌ Ошибка обновления прогресса рассылки {mailing_id}: {e}")
+
+async def edit_mailing_progress(progress_message: Optional[Tuple[int, int]], text: str,
+                                reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """Правка сообщения о ходе рассылки (chat_id, message_id), если оно есть"""
+    if not progress_message:
+        return
+    
+    chat_id, message_id = progress_message
+    try:
+        await bot.edit_message_text(
+            text,
+            chat_id=chat_id,
+            message_id=message_id,
+            reply_markup=reply_markup,
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления прогресса рассылки: {e}")
+
+async def run_mailing_job(mailing_id: int, progress_message: Optional[Tuple[int, int]] = None):
+    """Фоновая отправка рассылки по очереди получателей.
+    
+    progress_message - (chat_id, message_id) сообщения, в котором
+    показывается ход рассылки.
+    """
+    reporter = None
+    try:
+        mailing = await db.get_mailing(mailing_id)
+        if progress_message:
+            reporter = asyncio.create_task(report_mailing_progress(mailing_id, *progress_message))
+        if mailing['working_hours_only']:
+            # Окно доставки: в конце рабочего дня рассылка переносится на следующий
+            window_end = get_working_hours_end().timestamp() if is_working_hours() else time.time()
+            timers.schedule(window_end, ("mailing_window", mailing_id),
+                            functools.partial(close_mailing_window, mailing_id))
+        
+        progress = await db.get_mailing_job_progress(mailing_id)
+        if BROADCAST_WORKERS > 1 and progress['queued'] >= BROADCAST_SHARD_MIN:
+            failed_shards = await run_mailing_shards(mailing_id)
+            if failed_shards and mailing_job_status.get(mailing_id) == "running":
+                # Воркеры уже завершены: их начатые отправки не досылаются, остаток очереди шлет этот процесс
+                logger.warning(f"⚠️ Рассылка {mailing_id}: воркеры {failed_shards} не завершили отправку, "
+                               f"остаток очереди отправляется основным процессом")
+                await db.recover_interrupted_recipients(mailing_id)
+                await send_mailing_queue(mailing_id, mailing)
+        else:
+            await send_mailing_queue(mailing_id, mailing)
+        
+        flush_delivered_recipients(mailing_id)
+        flush_unreachable_users()
+        await db.writes.flush()
+        if reporter:
+            reporter.cancel()
+        progress = await save_mailing_job_stats(mailing_id)
+        
+        if mailing_job_status.get(mailing_id) == "scheduled":
+            # Окно доставки закрылось: остаток очереди ждет следующего рабочего времени
+            mailing = await db.get_mailing(mailing_id)
+            await edit_mailing_progress(
+                progress_message,
+                format_mailing_progress(
+                    mailing_id, progress,
+                    f"🕘 <b>Рабочее время закончилось</b>\n"
+                    f"Продолжение: {format_ts(mailing['run_at'])}"
+                ),
+                get_mailing_job_keyboard(mailing_id, "scheduled")
+            )
+            return
+        
+        # Пауза и отмена завершают задачу без отчета: его показывает обработчик кнопки
+        if mailing_job_status.get(mailing_id) != "running":
+            return
+        if progress['queued']:
+            raise RuntimeError(f"после отправки в очереди осталось получателей: {progress['queued']}")
+        
+        await db.set_mailing_status(mailing_id, "done", ("running",))
+        logger.info(f"✅ Рассылка {mailing_id} завершена: {progress['sent']} из {progress['total']}")
+        
+        await edit_mailing_progress(
+            progress_message,
+            format_mailing_progress(mailing_id, progress, "✅ <b>Рассылка завершена</b>")
+        )
+        
+        await bot.send_message(
+            mailing['admin_id'],
+            f"✅ <b>Рассылка завершена!</b>\n\n"
+            f"📨 <b>ID рассылки:</b> {mailing_id}\n"
+            f"👥 <b>Всего пользователей:</b> {progress['total']}\n"
+            f"✅ <b>Успешно отправлено:</b> {progress['sent']}\n"
+            f"❌ <b>Не удалось отправить:</b> {progress['failed']}\n\n"
+            f"<i>Рассылка сохранена в истории. Пользователи получили возможность оставить обратную связь.</i>",
+            reply_markup=get_admin_keyboard(),
+            parse_mode=ParseMode.HTML
+        )
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка рассылки {mailing_id}: {e}")
+        if reporter:
+            reporter.cancel()
+        await suspend_mailing_job(mailing_id, progress_message, f"{type(e).__name__}: {e}")
+    finally:
+        if reporter:
+            reporter.cancel()
+        flush_delivered_recipients(mailing_id)
+        timers.cancel(("mailing_window", mailing_id))
+        mailing_tasks.pop(mailing_id, None)
+        mailing_job_status.pop(mailing_id, None)
+
+async def send_mailing_queue(mailing_id: int, mailing):
+    """Отправка очереди получателей рассылки пулом отправителей этого процесса"""
+    engine = BroadcastEngine(broadcast_bucket, broadcast_chat_limiter, BROADCAST_CONCURRENCY)
+    await engine.run(
+        iter_queued_recipients(mailing_id),
+        functools.partial(send_mailing_to_user, engine, mailing_id, make_mailing_content(mailing))
+    )
+
+async def suspend_mailing_job(mailing_id: int, progress_message: Optional[Tuple[int, int]], reason: str):
+    """Пауза рассылки, остановленной ошибкой: администратор видит причину и может продолжить"""
+    try:
+        flush_delivered_recipients(mailing_id)
+        await db.writes.flush()
+        if not await db.set_mailing_status(mailing_id, "paused", ("running",)):
+            return
+        # Отправители остановлены: исход начатых отправок неизвестен, повтор мог бы их продублировать
+        await db.recover_interrupted_recipients(mailing_id)
+        
+        progress = await save_mailing_job_stats(mailing_id)
+        text = format_mailing_progress(
+            mailing_id, progress,
+            f"⚠️ <b>Рассылка приостановлена из-за ошибки</b>\n{html.escape(reason[:500], quote=False)}"
+        )
+        keyboard = get_mailing_job_keyboard(mailing_id, "paused")
+        if progress_message:
+            await edit_mailing_progress(progress_message, text, keyboard)
+        else:
+            await notify_admin(text, keyboard)
+        logger.warning(f"⏸ Рассылка {mailing_id} приостановлена из-за ошибки: {reason}")
+    except Exception as e:
+        logger.error(f"❌ Не удалось приостановить рассылку {mailing_id}: {e}")
+
+async def run_mailing_shards(mailing_id: int) -> List[int]:
+    """Отправка рассылки процессами-воркерами: каждый берет получателей с user_id % N == номер.
+    
+    Токены общего лимита выдает этот процесс, поэтому лимит Telegram
+    соблюдается для всех воркеров вместе; лимит на чат у каждого свой -
+    чат всегда попадает в один и тот же воркер. Возвращает номера воркеров,
+    не сообщивших итоги (упали или завершились с ошибкой).
+    """
+    logger.info(f"🔀 Рассылка {mailing_id}: отправка {BROADCAST_WORKERS} процессами")
+    results = await run_sharded(
+        mailing_id,
+        BROADCAST_WORKERS,
+        broadcast_bucket,
+        lambda: mailing_job_status.get(mailing_id) == "running"
+    )
+    for shard, (sent, failed) in sorted(results.items()):
+        logger.info(f"🔀 Рассылка {mailing_id}, воркер {shard}: отправлено {sent}, не удалось {failed}")
+    return sorted(set(range(BROADCAST_WORKERS)) - set(results))
+
+async def run_mailing_shard(mailing_id: int, shard: int, shards: int, socket_path: str):
+    """Процесс-воркер рассылки: отправка своей доли получателей с токенами координатора"""
+    def stop():
+        mailing_job_status[mailing_id] = "stopped"
+    
+    bucket = RemoteTokenBucket(socket_path, on_stop=stop)
+    try:
+        await db.open()
+        await bucket.connect()
+        mailing = await db.get_mailing(mailing_id)
+        mailing_job_status[mailing_id] = "running"
+        
+        engine = BroadcastEngine(bucket, broadcast_chat_limiter, BROADCAST_CONCURRENCY)
+        sent, failed = await engine.run(
+            iter_queued_recipients(mailing_id, shard, shards),
+            functools.partial(send_mailing_to_user, engine, mailing_id, make_mailing_content(mailing))
+        )
+        
+        # Итоги попадают в manual_mailings из очереди получателей в основном процессе
+        flush_delivered_recipients(mailing_id)
+        flush_unreachable_users()
+        await db.writes.flush()
+        await bucket.report(shard, sent, failed)
+        
+    except Exception as e:
+        # Код выхода воркера не 0, а итогов у координатора нет: остаток дошлет основной процесс
+        logger.error(f"❌ Ошибка воркера {shard} рассылки {mailing_id}: {e}")
+        raise
+    finally:
+        await bucket.close()
+        await bot.session.close()
+        await db.close()
+
+def start_mailing_job(mailing_id: int, progress_message: Optional[Tuple[int, int]] = None):
+    """Запуск фоновой отправки рассылки в этом процессе"""
+    if mailing_id in mailing_tasks:
+        return
+    mailing_job_status[mailing_id] = "running"
+    mailing_tasks[mailing_id] = asyncio.create_task(run_mailing_job(mailing_id, progress_message))
+
+async def resume_mailing_jobs():
+    """Продолжение рассылок, прерванных перезапуском"""
+    interrupted = await db.recover_interrupted_recipients()
+    if interrupted:
+        logger.warning(f"⚠️ Доставка {interrupted} сообщений рассылки не подтверждена до перезапуска, повторно не отправляем")
+    
+    for job in await db.get_active_mailing_jobs():
+        progress = await db.get_mailing_job_progress(job['id'])
+        note = "🔄 <b>Рассылка продолжена после перезапуска</b>" if job['status'] == "running" \
+            else "⏸ <b>Рассылка на паузе</b>"
+        
+        progress_message = None
+        try:
+            message = await bot.send_message(
+                job['admin_id'],
+                format_mailing_progress(job['id'], progress, note),
+                reply_markup=get_mailing_job_keyboard(job['id'], job['status']),
+                parse_mode=ParseMode.HTML
+            )
+            progress_message = (message.chat.id, message.message_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка уведомления о рассылке {job['id']}: {e}")
+        
+        if job['status'] == "running":
+            start_mailing_job(job['id'], progress_message)
+
+# Отложенные рассылки, окна доставки и follow-up: одна задача спит до ближайшего срока
+timers = TimerHeap()
+
+def schedule_mailing_timer(mailing_id: int, run_at: float):
+    """Таймер запуска отложенной рассылки"""
+    timers.schedule(run_at, ("mailing", mailing_id), functools.partial(launch_scheduled_mailing, mailing_id))
+
+async def launch_scheduled_mailing(mailing_id: int):
+    """Срок отложенной рассылки: запуск или перенос на начало рабочего времени"""
+    mailing = await db.get_mailing(mailing_id)
+    if not mailing or mailing['status'] != "scheduled":
+        return
+    
+    if mailing['working_hours_only'] and not is_working_hours():
+        run_at = get_next_working_time().timestamp()
+        if await db.reschedule_mailing(mailing_id, int(run_at)):
+            schedule_mailing_timer(mailing_id, run_at)
+        return
+    
+    # Сегмент вычисляется в момент отправки, как и фиксированные категории
+    user_count = await db.start_scheduled_mailing(mailing_id, await segment_recipients(mailing['mailing_type']))
+    if user_count is None:
+        return
+    
+    if not user_count:
+        await db.set_mailing_status(mailing_id, "done", ("running",))
+        await bot.send_message(
+            mailing['admin_id'],
+            f"❌ Запланированная рассылка #{mailing_id} не отправлена: нет пользователей по фильтру.",
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
+    progress = await db.get_mailing_job_progress(mailing_id)
+    progress_message = await bot.send_message(
+        mailing['admin_id'],
+        format_mailing_progress(mailing_id, progress, "🔄 <b>Запланированная рассылка началась</b>"),
+        reply_markup=get_mailing_job_keyboard(mailing_id, "running"),
+        parse_mode=ParseMode.HTML
+    )
+    start_mailing_job(mailing_id, (progress_message.chat.id, progress_message.message_id))
+
+async def close_mailing_window(mailing_id: int):
+    """Конец рабочего дня: рассылка с окном доставки ждет следующего рабочего времени"""
+    run_at = get_next_working_time().timestamp()
+    if not await db.reschedule_mailing(mailing_id, int(run_at)):
+        return
+    
+    # Задача досылает начатые сообщения и сообщает о переносе
+    if mailing_id in mailing_job_status:
+        mailing_job_status[mailing_id] = "scheduled"
+    schedule_mailing_timer(mailing_id, run_at)
+    logger.info(f"🕘 Рассылка {mailing_id} продолжится {format_ts(run_at)}")
+
+async def load_scheduled_mailings():
+    """Восстановление таймеров отложенных рассылок после перезапуска"""
+    scheduled = await db.get_scheduled_mailings()
+    for mailing in scheduled:
+        schedule_mailing_timer(mailing['id'], mailing['run_at'])
+    if scheduled:
+        logger.info(f"⏰ Отложенных рассылок: {len(scheduled)}")
+
+async def schedule_manual_mailing(message: types.Message, data: dict, run_at: float, working_hours_only: bool):
+    """Сохранение отложенной рассылки и постановка таймера"""
+    mailing_id = await db.schedule_mailing(
+        message.from_user.id,
+        data['mailing_text'],
+        data['filter_type'],
+        data.get('mailing_media'),
+        int(run_at),
+        working_hours_only
+    )
+    if not mailing_id:
+        await message.answer("❌ Ошибка: неизвестная категория пользователей.", reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
+        return
+    
+    schedule_mailing_timer(mailing_id, run_at)
+    
+    window = "\n🕘 Отправка только в рабочее время" if working_hours_only else ""
+    await message.answer("✅ Рассылка запланирована.", reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
     await message.answer(
-        f"📨 <b>Подтверждение рассылки</b>\n\n"
-        f"<b>Текст:</b>\n{mailing_text}\n\n"
-        f"<b>Категория:</b> {message.text}\n"
-        f"<b>Количество пользователей:</b> {len(users)}\n\n"
-        f"<i>Отправить рассылку?</i>",
-        reply_markup=keyboard,
+        f"⏰ <b>Рассылка #{mailing_id} запланирована</b>\n\n"
+        f"📅 Начало: {format_ts(run_at)}{window}\n"
+        f"<i>Получатели будут выбраны по фильтру в момент отправки.</i>",
+        reply_markup=get_mailing_job_keyboard(mailing_id, "scheduled"),
         parse_mode=ParseMode.HTML
     )
 
 @dp.message(ManualMailing.waiting_for_confirmation)
 async def process_mailing_confirmation(message: types.Message, state: FSMContext):
-    """Подтверждение и отправка рассылки С ОБРАТНОЙ СВЯЗЬЮ"""
+    """Подтверждение рассылки: очередь получателей и запуск фоновой отправки"""
     if message.text == "❌ Нет, отменить":
         await state.clear()
         await message.answer("❌ Рассылка отменена.", reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
         return
     
+    if message.text == "⏰ Запланировать":
+        await state.set_state(ManualMailing.waiting_for_schedule)
+        await message.answer(
+            "⏰ <b>Когда отправить рассылку?</b>\n\n"
+            "Введите дату и время в формате <code>ДД.ММ.ГГГГ ЧЧ:ММ</code>,\n"
+            f"например: <code>{(datetime.now() + timedelta(days=1)):%d.%m.%Y} 10:00</code>",
+            reply_markup=get_cancel_keyboard(),
+            parse_mode=ParseMode.HTML
+        )
+        return
+    
+    if message.text == "🕘 В рабочее время":
+        data = await state.get_data()
+        await state.clear()
+        await schedule_manual_mailing(message, data, get_next_working_time().timestamp(), True)
+        return
+    
     if message.text != "✅ Да, отправить":
         await message.answer("❌ Пожалуйста, используйте кнопки для подтверждения.", parse_mode=ParseMode.HTML)
         return
     
     data = await state.get_data()
-    mailing_text = data['mailing_text']
-    filter_type = data['filter_type']
-    user_count = data['user_count']
+    await state.clear()
     
-    users = db.get_users_by_filter(filter_type)
+    # Очередь получателей фиксируется сразу: прогресс переживет перезапуск
+    mailing_id, user_count = await db.create_mailing_job(
+        message.from_user.id,
+        data['mailing_text'],
+        data['filter_type'],
+        data.get('mailing_media'),
+        await segment_recipients(data['filter_type'])
+    )
     
-    if not users:
+    if not user_count:
+        if mailing_id:
+            await db.set_mailing_status(mailing_id, "done", ("running",))
         await message.answer("❌ Ошибка: пользователи не найдены.", reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
-        await state.clear()
         return
     
-    mailing_id = db.create_manual_mailing(
-        message.from_user.id,
-        mailing_text,
-        filter_type,
-        json.dumps({"user_count": user_count})
+    await message.answer(
+        f"🔄 Начинаю отправку рассылки для {user_count} пользователей...\n"
+        f"<i>Рассылка идет в фоне, ход отправки - в следующем сообщении.</i>",
+        reply_markup=get_admin_keyboard(),
+        parse_mode=ParseMode.HTML
+    )
+    progress_message = await message.answer(
+        format_mailing_progress(
+            mailing_id,
+            {'sent': 0, 'failed': 0, 'queued': user_count},
+            "🔄 <b>Рассылка идет</b>"
+        ),
+        reply_markup=get_mailing_job_keyboard(mailing_id, "running"),
+        parse_mode=ParseMode.HTML
     )
     
-    await message.answer(f"🔄 Начинаю отправку рассылки для {len(users)} пользователей...", parse_mode=ParseMode.HTML)
+    # Обработчик сразу освобождается, отправка идет в фоновой задаче
+    start_mailing_job(mailing_id, (progress_message.chat.id, progress_message.message_id))
+
+@dp.message(ManualMailing.waiting_for_schedule)
+async def process_mailing_schedule(message: types.Message, state: FSMContext):
+    """Время отправки отложенной рассылки"""
+    if message.text == "❌ Отмена":
+        await state.clear()
+        await message.answer("❌ Создание рассылки отменено.", reply_markup=get_admin_keyboard(), parse_mode=ParseMode.HTML)
+        return
     
-    success_count = 0
-    failed_count = 0
+    try:
+        run_at = datetime.strptime((message.text or "").strip(), "%d.%m.%Y %H:%M")
+    except ValueError:
+        await message.answer("❌ Неверный формат. Введите дату и время как <code>ДД.ММ.ГГГГ ЧЧ:ММ</code>.", parse_mode=ParseMode.HTML)
+        return
     
-    for user in users:
-        try:
-            sent_message = await bot.send_message(
-                user['user_id'], 
-                mailing_text, 
-                parse_mode=ParseMode.HTML
-            )
-            
-            sent_message_id = db.save_sent_message(mailing_id, user['user_id'], sent_message.message_id)
-            
-            feedback_keyboard = get_mailing_feedback_keyboard(sent_message_id)
-            await bot.send_message(
-                user['user_id'],
-                "💬 <b>Как вам эта рассылка?</b>\n\n"
-                "Пожалуйста, оставьте обратную связь:",
-                reply_markup=feedback_keyboard,
-                parse_mode=ParseMode.HTML
-            )
-            
-            success_count += 1
-            
-            await asyncio.sleep(0.1)
-            
-        except Exception as e:
-            logger.error(f"Не удалось отправить рассылку пользователю {user['user_id']}: {e}")
-            failed_count += 1
+    if run_at <= datetime.now():
+        await message.answer("❌ Время отправки уже прошло. Укажите время в будущем.", parse_mode=ParseMode.HTML)
+        return
     
-    db.update_mailing_stats(mailing_id, success_count, failed_count)
+    data = await state.get_data()
+    await state.clear()
+    await schedule_manual_mailing(message, data, run_at.timestamp(), False)
+
+@dp.callback_query(F.data.startswith("mjob_"))
+async def handle_mailing_job_control(callback: types.CallbackQuery):
+    """Пауза, продолжение и отмена рассылки"""
+    if not ADMIN_ID or callback.from_user.id != ADMIN_ID:
+        await callback.answer("⛔ Доступ запрещен", show_alert=True)
+        return
     
-    await message.answer(
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"📨 <b>ID рассылки:</b> {mailing_id}\n"
-        f"👥 <b>Всего пользователей:</b> {len(users)}\n"
-        f"✅ <b>Успешно отправлено:</b> {success_count}\n"
-        f"❌ <b>Не удалось отправить:</b> {failed_count}\n\n"
-        f"<i>Рассылка сохранена в истории. Пользователи получили возможность оставить обратную связь.</i>",
-        reply_markup=get_admin_keyboard(),
-        parse_mode=ParseMode.HTML
+    try:
+        _, action, mailing_id = callback.data.split("_")
+        mailing_id = int(mailing_id)
+        
+        if action == "pause":
+            if not await db.set_mailing_status(mailing_id, "paused", ("running",)):
+                await callback.answer("Рассылка не выполняется", show_alert=True)
+                return
+            if mailing_id in mailing_job_status:
+                mailing_job_status[mailing_id] = "paused"
+            status, note = "paused", "⏸ <b>Рассылка на паузе</b>"
+        
+        elif action == "resume":
+            if not await db.set_mailing_status(mailing_id, "running", ("paused",)):
+                await callback.answer("Рассылка не на паузе", show_alert=True)
+                return
+            # Задача, остановленная паузой, сначала досылает начатые сообщения
+            previous = mailing_tasks.get(mailing_id)
+            if previous:
+                await previous
+            start_mailing_job(mailing_id, (callback.message.chat.id, callback.message.message_id))
+            status, note = "running", "🔄 <b>Рассылка идет</b>"
+        
+        elif action == "cancel":
+            if not await db.set_mailing_status(mailing_id, "cancelled", ("running", "paused", "scheduled")):
+                await callback.answer("Рассылка уже завершена", show_alert=True)
+                return
+            timers.cancel(("mailing", mailing_id))
+            if mailing_id in mailing_job_status:
+                mailing_job_status[mailing_id] = "cancelled"
+            status, note = "cancelled", "⛔ <b>Рассылка отменена</b>"
+        
+        else:
+            await callback.answer()
+            return
+        
+        # Задача досылает начатые сообщения и останавливается
+        previous = mailing_tasks.get(mailing_id)
+        if previous and status != "running":
+            await previous
+        
+        progress = await save_mailing_job_stats(mailing_id)
+        await callback.message.edit_text(
+            format_mailing_progress(mailing_id, progress, note),
+            reply_markup=get_mailing_job_keyboard(mailing_id, status) if status != "cancelled" else None,
+            parse_mode=ParseMode.HTML
+        )
+        await callback.answer()
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка управления рассылкой: {e}")
+        await callback.answer("❌ Ошибка управления рассылкой", show_alert=True)
+
+# =========== ПЕРИОДИЧЕСКАЯ РАССЫЛКА И ОТЧЕТ ЭФФЕКТИВНОСТИ ===========
+# Запускаются задачей очереди в процессе бота (PERIODIC_TASKS_DAYS > 0) или по
+# cron (scheduler_job.py). Рассылка - обычное задание рассылки: получатели
+# читаются страницами, отправка идет пулом под общим лимитом, доставка
+# записывается пачками, а после перезапуска рассылка продолжается. Аудитория - фильтр
+# "all" (все подписчики, а не только активные за 14 дней, как раньше); сообщение
+# получает кнопки отзыва, администратор - итог "Рассылка завершена"
+COMPANY_BROADCAST_TEXT = f"📢 <b>Информация от ООО \"Тритика\"</b>\n\n{html.escape(COMPANY_INFO, quote=False)}"
+
+async def start_company_broadcast() -> Tuple[Optional[int], int]:
+    """Запуск рассылки информации о компании всем подписчикам: (ID рассылки, число получателей)"""
+    mailing_id, user_count = await db.create_mailing_job(ADMIN_ID or 0, COMPANY_BROADCAST_TEXT, "all")
+    
+    if not user_count:
+        if mailing_id:
+            await db.set_mailing_status(mailing_id, "done", ("running",))
+        logger.info("📢 Нет подписчиков для периодической рассылки")
+        return mailing_id, 0
+    
+    start_mailing_job(mailing_id)
+    logger.info(f"📢 Периодическая рассылка {mailing_id}: {user_count} получателей")
+    return mailing_id, user_count
+
+def percent(part: int, total: int) -> float:
+    """Доля в процентах (0 при пустом знаменателе)"""
+    return part / total * 100 if total else 0.0
+
+async def build_efficiency_report(days: int = None) -> str:
+    """Отчет эффективности за период по счетчикам статистики"""
+    days = days or PERIODIC_TASKS_DAYS or 14
+    stats = await db.get_statistics(days)
+    start, end = period_bounds(days)
+    
+    questionnaire_rate = percent(stats['new_questionnaires'], stats['new_users'])
+    subscription_rate = percent(stats['subscribed_users'], stats['subscribed_users'] + stats['unsubscribed_users'])
+    feedback_rate = percent(stats['mailings_feedback'], stats['mailings_sent'])
+    
+    report = (
+        f"📊 <b>ОТЧЕТ ЭФФЕКТИВНОСТИ</b>\n"
+        f"Период: {format_ts(start, '%d.%m.%Y')} - {format_ts(end - 1, '%d.%m.%Y')}\n\n"
+        f"📈 <b>За период:</b>\n"
+        f"• Новых пользователей: {stats['new_users']}\n"
+        f"• Заполненных анкет: {stats['new_questionnaires']}\n"
+        f"• Выполненных выгрузок: {stats['exports_completed']}\n"
+        f"• Сообщений менеджеру: {stats['manager_messages']}\n"
+        f"• Рассылок: {stats['mailings_count']}, отправлено сообщений: {stats['mailings_sent']}\n"
+        f"• Отзывов на рассылки: {stats['mailings_feedback']}\n\n"
+        f"👥 <b>Сейчас:</b>\n"
+        f"• С подпиской: {stats['subscribed_users']}\n"
+        f"• Без подписки: {stats['unsubscribed_users']}\n"
+        f"• Частичных анкет: {stats['partial_questionnaires']}\n"
+        f"• Полных анкет: {stats['complete_questionnaires']}\n\n"
+        f"🎯 <b>Метрики:</b>\n"
+        f"• Конверсия в анкеты: {questionnaire_rate:.1f}%\n"
+        f"• Доля подписанных: {subscription_rate:.1f}%\n"
+        f"• Отзывов на 100 сообщений рассылок: {feedback_rate:.1f}\n\n"
+        f"📝 <b>Выводы:</b>\n"
     )
     
-    await state.clear()
+    if stats['new_users'] > 10 and questionnaire_rate < 30:
+        report += "⚠️ Низкая конверсия в анкеты: стоит упростить анкету или добавить стимул ее заполнить\n"
+    else:
+        report += "✅ Конверсия в анкеты на хорошем уровне\n"
+    
+    if subscription_rate < 70:
+        report += "⚠️ Много отписок: стоит реже присылать рассылки или сделать их полезнее\n"
+    else:
+        report += "✅ Большинство пользователей остаются подписанными\n"
+    
+    if stats['mailings_sent'] > 100 and feedback_rate < 1:
+        report += "⚠️ Мало обратной связи: стоит активнее просить оценить рассылку\n"
+    else:
+        report += "✅ Уровень обратной связи удовлетворительный\n"
+    
+    report += f"\n<i>Отчет сгенерирован: {datetime.now().strftime('%d.%m.%Y %H:%M')}</i>"
+    return report
+
+def next_periodic_run(after: float) -> datetime:
+    """Ближайший после after срок периодических задач: каждые PERIODIC_TASKS_DAYS дней в PERIODIC_TASKS_HOUR:00"""
+    run_at = datetime.fromtimestamp(after).replace(hour=PERIODIC_TASKS_HOUR, minute=0, second=0, microsecond=0)
+    # Сроки привязаны к календарю (номер дня кратен периоду) и не сдвигаются от перезапусков
+    run_at += timedelta(days=-run_at.toordinal() % PERIODIC_TASKS_DAYS)
+    if run_at.timestamp() <= after:
+        run_at += timedelta(days=PERIODIC_TASKS_DAYS)
+    return run_at
+
+async def schedule_periodic_tasks():
+    """Задача очереди на ближайший срок периодических задач (одна на срок)"""
+    run_at = next_periodic_run(time.time()).timestamp()
+    await job_queue.enqueue("periodic_tasks", {}, run_at, key=f"periodic_tasks:{int(run_at)}")
+
+async def run_periodic_tasks_job(payload: dict):
+    """Задача periodic_tasks: отчет администратору, рассылка подписчикам и постановка следующего срока"""
+    if PERIODIC_TASKS_DAYS <= 0:
+        return
+    
+    await schedule_periodic_tasks()
+    
+    try:
+        await notify_admin(await build_efficiency_report())
+    except Exception as e:
+        logger.error(f"❌ Ошибка отчета эффективности: {e}")
+    
+    await start_company_broadcast()
+
+job_queue.register("periodic_tasks", run_periodic_tasks_job)
 
 # =========== ОБРАТНАЯ СВЯЗЬ ПО РАССЫЛКАМ ===========
 @dp.callback_query(F.data.startswith("feedback_"))
 async def handle_mailing_feedback(callback: types.CallbackQuery, state: FSMContext):
-    """Обработка обратной связи по рассылке"""
+    """Обратная связь из отдельного сообщения-вопроса (ID sent_messages в callback_data)"""
     try:
         parts = callback.data.split("_")
         feedback_type = parts[1]
         sent_message_id = int(parts[2])
         
-        user_id = callback.from_user.id
-        username = callback.from_user.username or "без username"
-        
-        conn = sqlite3.connect("tenders.db")
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        SELECT sm.*, mm.mailing_text, mm.id as mailing_id
-        FROM sent_messages sm
-        JOIN manual_mailings mm ON sm.mailing_id = mm.id
-        WHERE sm.id = ? AND sm.user_id = ?
-        ''', (sent_message_id, user_id))
-        
-        sent_message = cursor.fetchone()
-        conn.close()
+        sent_message = await db.get_sent_message(sent_message_id, callback.from_user.id)
         
         if not sent_message:
             await callback.answer("Сообщение не найдено", show_alert=True)
             return
         
-        mailing_id = sent_message['mailing_id']
+        await process_mailing_feedback(callback, state, feedback_type, sent_message['mailing_id'], sent_message_id)
+    
+    except Exception as e:
+        logger.error(f"Ошибка обработки обратной связи: {e}")
+        await callback.answer("Произошла ошибка", show_alert=True)
+
+@dp.callback_query(F.data.startswith("mfb_"))
+async def handle_inline_mailing_feedback(callback: types.CallbackQuery, state: FSMContext):
+    """Обратная связь с клавиатуры в самом сообщении рассылки (рассылка и получатель в callback_data)"""
+    try:
+        _, feedback_type, mailing_id, user_id = callback.data.split("_")
+        mailing_id, user_id = int(mailing_id), int(user_id)
         
-        if feedback_type == "unsubscribe":
-            db.toggle_user_mailing_subscription(user_id)
-            
-            db.save_mailing_feedback(
-                mailing_id, 
-                user_id, 
-                sent_message_id, 
-                "unsubscribe", 
-                "Пользователь отписался от рассылки"
-            )
-            
-            await callback.message.edit_text(
-                callback.message.text + "\n\n✅ <b>Вы отписаны от рассылок</b>",
-                reply_markup=None,
-                parse_mode=ParseMode.HTML
-            )
-            
-            await callback.answer("Вы отписаны от рассылок")
-            
-            if ADMIN_ID:
-                try:
-                    await bot.send_message(
-                        ADMIN_ID,
-                        f"🚫 <b>ПОЛЬЗОВАТЕЛЬ ОТПИСАЛСЯ ОТ РАССЫЛКИ</b>\n\n"
-                        f"👤 Пользователь: @{username}\n"
-                        f"🆔 ID: {user_id}\n"
-                        f"📨 Рассылка ID: {mailing_id}\n"
-                        f"📅 Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}",
-                        parse_mode=ParseMode.HTML
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось уведомить админа об отписке: {e}")
-            
-            return
+        # Строка sent_messages создается только при первом отклике получателя
+        sent_message_id = None
+        if user_id == callback.from_user.id:
+            sent_message_id = await db.get_or_create_sent_message(mailing_id, user_id, callback.message.message_id)
         
-        elif feedback_type == "comment":
-            await state.set_state(FeedbackComment.waiting_for_comment)
-            await state.update_data(sent_message_id=sent_message_id, mailing_id=mailing_id)
-            
-            await callback.message.answer(
-                "💬 <b>Напишите ваш комментарий к рассылке:</b>\n\n"
-                "<i>Что понравилось или не понравилось? Что можно улучшить?</i>",
-                reply_markup=get_cancel_keyboard(),
-                parse_mode=ParseMode.HTML
-            )
-            
-            await callback.answer()
+        if not sent_message_id:
+            await callback.answer("Сообщение не найдено", show_alert=True)
             return
         
-        else:
-            feedback_text_map = {
-                "like": "Понравилось",
-                "dislike": "Не понравилось"
-            }
-            
-            db.save_mailing_feedback(
-                mailing_id, 
-                user_id, 
-                sent_message_id, 
-                feedback_type, 
-                feedback_text_map.get(feedback_type, "")
-            )
-            
-            feedback_icon = "👍" if feedback_type == "like" else "👎" if feedback_type == "dislike" else "💬" if feedback_type == "comment" else "🚫"
-            await callback.message.edit_text(
-                callback.message.text + f"\n\n{feedback_icon} <b>Спасибо за ваш отзыв!</b>",
-                reply_markup=None,
-                parse_mode=ParseMode.HTML
-            )
-            
-            await callback.answer(f"Спасибо за ваш отзыв: {feedback_text_map.get(feedback_type, '')}")
-            
-            if ADMIN_ID:
-                try:
-                    feedback_type_text = "Понравилось" if feedback_type == "like" else "Не понравилось"
-                    
-                    await bot.send_message(
-                        ADMIN_ID,
-                        f"{feedback_icon} <b>НОВЫЙ ОТЗЫВ НА РАССЫЛКИ</b>\n\n"
-                        f"👤 Пользователь: @{username}\n"
-                        f"🆔 ID: {user_id}\n"
-                        f"📨 Рассылка ID: {mailing_id}\n"
-                        f"💬 Отзыв: {feedback_type_text}\n"
-                        f"📅 Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}",
-                        parse_mode=ParseMode.HTML
-                    )
-                except Exception as e:
-                    logger.error(f"Не удалось уведомить админа об отзыве: {e}")
+        await process_mailing_feedback(callback, state, feedback_type, mailing_id, sent_message_id)
     
     except Exception as e:
         logger.error(f"Ошибка обработки обратной связи: {e}")
         await callback.answer("Произошла ошибка", show_alert=True)
 
+async def close_feedback_prompt(message: types.Message, note: str):
+    """Снятие клавиатуры обратной связи с отметкой об отклике в тексте или подписи сообщения"""
+    limit = 4096 if message.text is not None else 1024
+    if len((message.text or message.caption or "") + note) > limit:
+        await message.edit_reply_markup(reply_markup=None)
+    elif message.text is not None:
+        await message.edit_text(message.html_text + note, reply_markup=None, parse_mode=ParseMode.HTML)
+    else:
+        await message.edit_caption(caption=message.html_text + note, reply_markup=None, parse_mode=ParseMode.HTML)
+
+async def process_mailing_feedback(callback: types.CallbackQuery, state: FSMContext, feedback_type: str,
+                                   mailing_id: int, sent_message_id: int):
+    """Обработка обратной связи по рассылке"""
+    user_id = callback.from_user.id
+    username = callback.from_user.username or "без username"
+    
+    if feedback_type == "unsubscribe":
+        await db.toggle_user_mailing_subscription(user_id)
+        
+        db.writes.submit(
+            "save_mailing_feedback",
+            mailing_id, 
+            user_id, 
+            sent_message_id, 
+            "unsubscribe", 
+            "Пользователь отписался от рассылки"
+        )
+        
+        await close_feedback_prompt(callback.message, "\n\n✅ <b>Вы отписаны от рассылок</b>")
+        
+        await callback.answer("Вы отписаны от рассылок")
+        
+        await admin_event(
+            "unsubscribe",
+            f"🚫 <b>ПОЛЬЗОВАТЕЛЬ ОТПИСАЛСЯ ОТ РАССЫЛКИ</b>\n\n"
+            f"👤 Пользователь: @{username}\n"
+            f"🆔 ID: {user_id}\n"
+            f"📨 Рассылка ID: {mailing_id}\n"
+            f"📅 Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}",
+            mailing_id=mailing_id,
+            user_id=user_id,
+            username=callback.from_user.username
+        )
+        
+        return
+    
+    elif feedback_type == "comment":
+        await state.set_state(FeedbackComment.waiting_for_comment)
+        await state.update_data(sent_message_id=sent_message_id, mailing_id=mailing_id)
+        
+        await callback.message.answer(
+            "💬 <b>Напишите ваш комментарий к рассылке:</b>\n\n"
+            "<i>Что понравилось или не понравилось? Что можно улучшить?</i>",
+            reply_markup=get_cancel_keyboard(),
+            parse_mode=ParseMode.HTML
+        )
+        
+        await callback.answer()
+        return
+    
+    else:
+        feedback_text_map = {
+            "like": "Понравилось",
+            "dislike": "Не понравилось"
+        }
+        
+        db.writes.submit(
+            "save_mailing_feedback",
+            mailing_id, 
+            user_id, 
+            sent_message_id, 
+            feedback_type, 
+            feedback_text_map.get(feedback_type, "")
+        )
+        
+        feedback_icon = "👍" if feedback_type == "like" else "👎" if feedback_type == "dislike" else "💬" if feedback_type == "comment" else "🚫"
+        await close_feedback_prompt(callback.message, f"\n\n{feedback_icon} <b>Спасибо за ваш отзыв!</b>")
+        
+        await callback.answer(f"Спасибо за ваш отзыв: {feedback_text_map.get(feedback_type, '')}")
+        
+        feedback_type_text = "Понравилось" if feedback_type == "like" else "Не понравилось"
+        
+        await admin_event(
+            feedback_type,
+            f"{feedback_icon} <b>НОВЫЙ ОТЗЫВ НА РАССЫЛКИ</b>\n\n"
+            f"👤 Пользователь: @{username}\n"
+            f"🆔 ID: {user_id}\n"
+            f"📨 Рассылка ID: {mailing_id}\n"
+            f"💬 Отзыв: {feedback_type_text}\n"
+            f"📅 Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}",
+            mailing_id=mailing_id,
+            user_id=user_id,
+            username=callback.from_user.username
+        )
+
 @dp.message(FeedbackComment.waiting_for_comment)
 async def process_feedback_comment(message: types.Message, state: FSMContext):
     """Обработка комментария к рассылке"""
@@ -3192,7 +5710,8 @@ async def process_feedback_comment(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     username = message.from_user.username or "без username"
     
-    db.save_mailing_feedback(
+    db.writes.submit(
+        "save_mailing_feedback",
         mailing_id, 
         user_id, 
         sent_message_id, 
@@ -3207,58 +5726,35 @@ async def process_feedback_comment(message: types.Message, state: FSMContext):
         parse_mode=ParseMode.HTML
     )
     
-    if ADMIN_ID:
-        try:
-            await bot.send_message(
-                ADMIN_ID,
-                f"💬 <b>НОВЫЙ КОММЕНТАРИЙ К РАССЫЛКЕ</b>\n\n"
-                f"👤 Пользователь: @{username}\n"
-                f"🆔 ID: {user_id}\n"
-                f"📨 Рассылка ID: {mailing_id}\n"
-                f"📝 Комментарий: {message.text[:500]}\n"
-                f"📅 Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}",
-                parse_mode=ParseMode.HTML
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить админа о комментарии: {e}")
+    await admin_event(
+        "comment",
+        f"💬 <b>НОВЫЙ КОММЕНТАРИЙ К РАССЫЛКЕ</b>\n\n"
+        f"👤 Пользователь: @{username}\n"
+        f"🆔 ID: {user_id}\n"
+        f"📨 Рассылка ID: {mailing_id}\n"
+        f"📝 Комментарий: {html.escape(message.text[:500], quote=False)}\n"
+        f"📅 Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}",
+        mailing_id=mailing_id,
+        user_id=user_id,
+        username=message.from_user.username,
+        details=message.text[:500]
+    )
     
     await state.clear()
 
 # =========== ПРОСМОТР ОБРАТНОЙ СВЯЗИ ===========
-@dp.message(F.text == "📋 Обратная связь")
-async def show_feedback(message: types.Message):
-    """Показать обратную связь по рассылкам"""
-    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
-        await message.answer("⛔ Доступ запрещен", parse_mode=ParseMode.HTML)
-        return
-    
-    conn = sqlite3.connect("tenders.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT mm.id, mm.mailing_text, mm.created_at, 
-           mm.sent_count, mm.feedback_count,
-           (SELECT COUNT(DISTINCT mf.user_id) 
-            FROM mailing_feedback mf 
-            WHERE mf.mailing_id = mm.id) as feedback_users
-    FROM manual_mailings mm
-    WHERE mm.sent_count > 0
-    ORDER BY mm.created_at DESC
-    LIMIT 10
-    ''')
-    
-    mailings = cursor.fetchall()
-    conn.close()
+@paged_view("fb")
+async def render_feedback_mailings_page(cursor: tuple = None, direction: str = "next"):
+    """Страница списка рассылок с обратной связью"""
+    mailings, has_prev, has_next = await db.get_mailings_with_feedback_page(cursor, direction)
     
     if not mailings:
-        await message.answer("📭 Нет рассылок с обратной связью", parse_mode=ParseMode.HTML)
-        return
+        return None
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
     
     for mailing in mailings:
-        date_str = mailing['created_at'][:10] if mailing['created_at'] else "??.??.????"
+        date_str = format_ts(mailing['created_at'], '%d.%m.%Y', "??.??.????")
         feedback_percent = (mailing['feedback_count'] / mailing['sent_count'] * 100) if mailing['sent_count'] > 0 else 0
         
         button_text = f"📨 #{mailing['id']} ({date_str}) - {feedback_percent}% отзывов"
@@ -3269,17 +5765,36 @@ async def show_feedback(message: types.Message):
             )
         ])
     
+    pager = get_pager_buttons("fb", mailings, ("created_at", "id"), has_prev, has_next)
+    if pager:
+        keyboard.inline_keyboard.append(pager)
+    
     keyboard.inline_keyboard.append([
         InlineKeyboardButton(text="📊 Статистика отзывов", callback_data="feedback_stats"),
         InlineKeyboardButton(text="🔄 Обновить", callback_data="refresh_feedback")
     ])
     
-    await message.answer(
+    text = (
         "📋 <b>Обратная связь по рассылкам</b>\n\n"
-        "Выберите рассылку для просмотра отзывов:",
-        reply_markup=keyboard,
-        parse_mode=ParseMode.HTML
+        "Выберите рассылку для просмотра отзывов:"
     )
+    return text, keyboard
+
+@dp.message(F.text == "📋 Обратная связь")
+async def show_feedback(message: types.Message):
+    """Показать обратную связь по рассылкам"""
+    if not ADMIN_ID or message.from_user.id != ADMIN_ID:
+        await message.answer("⛔ Доступ запрещен", parse_mode=ParseMode.HTML)
+        return
+    
+    page = await render_feedback_mailings_page()
+    
+    if not page:
+        await message.answer("📭 Нет рассылок с обратной связью", parse_mode=ParseMode.HTML)
+        return
+    
+    text, keyboard = page
+    await message.answer(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
 
 @dp.callback_query(F.data.startswith("view_feedback_"))
 async def handle_view_feedback(callback: types.CallbackQuery):
@@ -3290,7 +5805,7 @@ async def handle_view_feedback(callback: types.CallbackQuery):
     
     mailing_id = int(callback.data.split("_")[2])
     
-    feedback = db.get_mailing_feedback(mailing_id)
+    feedback = await db.get_mailing_feedback(mailing_id)
     
     if not feedback:
         await callback.answer("Нет обратной связи по этой рассылке", show_alert=True)
@@ -3317,7 +5832,7 @@ async def handle_view_feedback(callback: types.CallbackQuery):
     for i, fb in enumerate(feedback[:10], 1):
         fb_type = "👍" if fb['feedback_type'] == 'like' else "👎" if fb['feedback_type'] == 'dislike' else "💬" if fb['feedback_type'] == 'comment' else "🚫"
         user_name = f"@{fb['username']}" if fb['username'] else f"{fb['first_name']} {fb['last_name'] or ''}"
-        date_str = fb['created_at'][:16] if fb['created_at'] else "??.?? ??:??"
+        date_str = format_ts(fb['created_at'], default="??.?? ??:??")
         
         response += f"\n{i}. {fb_type} <b>{user_name}</b> ({date_str})"
         if fb['feedback_text']:
@@ -3336,63 +5851,26 @@ async def handle_feedback_stats(callback: types.CallbackQuery):
         await callback.answer("⛔ Доступ запрещен", show_alert=True)
         return
     
-    conn = sqlite3.connect("tenders.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT 
-        COUNT(*) as total_feedback,
-        SUM(CASE WHEN feedback_type = 'like' THEN 1 ELSE 0 END) as likes,
-        SUM(CASE WHEN feedback_type = 'dislike' THEN 1 ELSE 0 END) as dislikes,
-        SUM(CASE WHEN feedback_type = 'comment' THEN 1 ELSE 0 END) as comments,
-        SUM(CASE WHEN feedback_type = 'unsubscribe' THEN 1 ELSE 0 END) as unsubscribes
-    FROM mailing_feedback
-    ''')
-    
-    stats = cursor.fetchone()
-    
-    cursor.execute('''
-    SELECT 
-        COUNT(*) as recent_feedback,
-        SUM(CASE WHEN feedback_type = 'unsubscribe' THEN 1 ELSE 0 END) as recent_unsubscribes
-    FROM mailing_feedback 
-    WHERE date(created_at) >= date('now', '-30 days')
-    ''')
-    
-    recent = cursor.fetchone()
-    
-    cursor.execute('''
-    SELECT mm.id, mm.mailing_text, COUNT(mf.id) as feedback_count
-    FROM manual_mailings mm
-    LEFT JOIN mailing_feedback mf ON mm.id = mf.mailing_id
-    GROUP BY mm.id
-    ORDER BY feedback_count DESC
-    LIMIT 5
-    ''')
-    
-    popular = cursor.fetchall()
-    
-    conn.close()
+    stats = await db.get_feedback_stats()
     
     response = f"""
 📊 <b>Статистика обратной связи</b>
 
 <b>Общая статистика:</b>
-• Всего отзывов: {stats['total_feedback'] or 0}
-• 👍 Понравилось: {stats['likes'] or 0}
-• 👎 Не понравилось: {stats['dislikes'] or 0}
-• 💬 Комментарии: {stats['comments'] or 0}
-• 🚫 Отписки: {stats['unsubscribes'] or 0}
+• Всего отзывов: {stats['total_feedback']}
+• 👍 Понравилось: {stats['likes']}
+• 👎 Не понравилось: {stats['dislikes']}
+• 💬 Комментарии: {stats['comments']}
+• 🚫 Отписки: {stats['unsubscribes']}
 
 <b>За последние 30 дней:</b>
-• Новых отзывов: {recent['recent_feedback'] or 0}
-• Отписок: {recent['recent_unsubscribes'] or 0}
+• Новых отзывов: {stats['recent_feedback']}
+• Отписок: {stats['recent_unsubscribes']}
 
 <b>Самые обсуждаемые рассылки:</b>
 """
     
-    for i, mailing in enumerate(popular, 1):
+    for i, mailing in enumerate(stats['popular'], 1):
         mailing_text_preview = mailing['mailing_text'][:50] + "..." if len(mailing['mailing_text']) > 50 else mailing['mailing_text']
         response += f"\n{i}. ID#{mailing['id']}: {mailing_text_preview}"
         response += f"\n   Отзывов: {mailing['feedback_count']}"
@@ -3403,10 +5881,46 @@ async def handle_feedback_stats(callback: types.CallbackQuery):
 @dp.callback_query(F.data == "refresh_feedback")
 async def handle_refresh_feedback(callback: types.CallbackQuery):
     """Обновление списка обратной связи"""
-    await show_feedback(callback.message)
+    if not ADMIN_ID or callback.from_user.id != ADMIN_ID:
+        await callback.answer("⛔ Доступ запрещен", show_alert=True)
+        return
+    
+    page = await render_feedback_mailings_page()
+    
+    if not page:
+        await callback.answer("Нет рассылок с обратной связью", show_alert=True)
+        return
+    
+    text, keyboard = page
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Ошибка обновления списка обратной связи: {e}")
     await callback.answer("Список обновлен")
 
 # =========== ОСТАЛЬНЫЕ АДМИН ФУНКЦИИ ===========
+@paged_view("inbox")
+async def render_manager_messages_page(cursor: tuple = None, direction: str = "next"):
+    """Страница списка необработанных сообщений менеджеру"""
+    messages, has_prev, has_next = await db.get_unprocessed_manager_messages_page(cursor, direction)
+    
+    if not messages:
+        return None
+    
+    response = "📩 <b>Новые сообщения менеджеру:</b>\n\n"
+    
+    for msg in messages:
+        date_str = format_ts(msg['created_at'], default="??.?? ??:??")
+        type_icon = "💬" if msg['message_type'] == 'text' else "📎" if msg['message_type'] == 'document' else "🖼"
+        
+        response += f"<b>#{msg['id']}</b> {type_icon}\n"
+        response += f"   👤 @{msg['username'] or 'без username'}\n"
+        response += f"   📝 {(msg['message_text'] or '')[:50]}...\n"
+        response += f"   ⏰ {date_str}\n\n"
+    
+    pager = get_pager_buttons("inbox", messages, ("created_at", "id"), has_prev, has_next)
+    return response, InlineKeyboardMarkup(inline_keyboard=[pager] if pager else [])
+
 @dp.message(F.text == "📩 Сообщения менеджеру")
 async def show_manager_messages(message: types.Message):
     """Показать сообщения менеджеру"""
@@ -3414,38 +5928,14 @@ async def show_manager_messages(message: types.Message):
         await message.answer("⛔ Доступ запрещен", parse_mode=ParseMode.HTML)
         return
     
-    conn = sqlite3.connect("tenders.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-    SELECT mm.*, u.username, u.first_name, u.last_name 
-    FROM manager_messages mm
-    JOIN users u ON mm.user_id = u.user_id
-    WHERE mm.processed = 0
-    ORDER BY mm.created_at DESC
-    LIMIT 10
-    ''')
-    
-    messages = cursor.fetchall()
-    conn.close()
+    page = await render_manager_messages_page()
     
-    if not messages:
+    if not page:
         await message.answer("📭 Новых сообщений менеджеру нет", parse_mode=ParseMode.HTML)
         return
     
-    response = f"📩 <b>Новые сообщения менеджеру ({len(messages)}):</b>\n\n"
-    
-    for i, msg in enumerate(messages, 1):
-        date_str = msg['created_at'][:16] if msg['created_at'] else "??.?? ??:??"
-        type_icon = "💬" if msg['message_type'] == 'text' else "📎" if msg['message_type'] == 'document' else "🖼"
-        
-        response += f"{i}. <b>#{msg['id']}</b> {type_icon}\n"
-        response += f"   👤 @{msg['username'] or 'без username'}\n"
-        response += f"   📝 {msg['message_text'][:50]}...\n"
-        response += f"   ⏰ {date_str}\n\n"
-    
-    await message.answer(response, parse_mode=ParseMode.HTML)
+    response, keyboard = page
+    await message.answer(response, reply_markup=keyboard, parse_mode=ParseMode.HTML)
 
 @dp.message(F.text == "⚙️ Настройки")
 async def show_settings(message: types.Message):
@@ -3454,7 +5944,7 @@ async def show_settings(message: types.Message):
         await message.answer("⛔ Доступ запрещен", parse_mode=ParseMode.HTML)
         return
     
-    stats = db.get_statistics(7)
+    stats = await db.get_statistics(7)
     
     await message.answer(
         "⚙️ <b>Настройки бота:</b>\n\n"
@@ -3541,7 +6031,7 @@ async def process_keywords(message: types.Message, state: FSMContext):
     username = message.from_user.username or "без username"
     
     # Сохраняем первую часть анкеты (только 1-4 вопросы)
-    questionnaire_id = db.save_questionnaire_partial(user_id, user_data)
+    questionnaire_id = await db.save_questionnaire_partial(user_id, user_data)
     
     # Отправляем админу уведомление о первой части анкеты
     await send_partial_questionnaire_to_admin(questionnaire_id, user_id, user_data, username)
@@ -3662,10 +6152,10 @@ async def process_export_email(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     
     # Сохраняем полную анкету (обновляем частичную)
-    db.update_partial_to_complete(user_id, data)
+    await db.update_partial_to_complete(user_id, data)
     
     # Получаем данные о выгрузке
-    export = db.get_export_by_id(export_id)
+    export = await db.get_export_by_id(export_id)
     
     if export:
         if export['file_path'] and os.path.exists(export['file_path']):
@@ -3700,28 +6190,22 @@ async def process_export_email(message: types.Message, state: FSMContext):
             )
             
             # Обновляем статус выгрузки
-            db.mark_export_completed(export_id, "Автоматическая отправка")
+            await complete_export(export_id, "Автоматическая отправка")
         
         # Отмечаем запрос контактов как выполненный
-        db.mark_contact_request_completed(export_id)
+        await db.mark_contact_request_completed(export_id)
         
         # Уведомляем админа
-        if ADMIN_ID:
-            try:
-                await bot.send_message(
-                    ADMIN_ID,
-                    f"✅ <b>Пользователь заполнил контакты и получил выгрузку</b>\n\n"
-                    f"👤 Пользователь ID: {user_id}\n"
-                    f"📱 Username: @{message.from_user.username or 'без username'}\n"
-                    f"🏢 Компания: {data.get('company_name')}\n"
-                    f"📞 Телефон: {data.get('phone')}\n"
-                    f"📧 Email: {data.get('email')}\n"
-                    f"📄 Выгрузка ID: {export_id}\n\n"
-                    f"<i>Выгрузка отправлена пользователю.</i>",
-                    parse_mode=ParseMode.HTML
-                )
-            except Exception as e:
-                logger.error(f"Не удалось уведомить админа: {e}")
+        await notify_admin(
+            f"✅ <b>Пользователь заполнил контакты и получил выгрузку</b>\n\n"
+            f"👤 Пользователь ID: {user_id}\n"
+            f"📱 Username: @{message.from_user.username or 'без username'}\n"
+            f"🏢 Компания: {data.get('company_name')}\n"
+            f"📞 Телефон: {data.get('phone')}\n"
+            f"📧 Email: {data.get('email')}\n"
+            f"📄 Выгрузка ID: {export_id}\n\n"
+            f"<i>Выгрузка отправлена пользователю.</i>"
+        )
     else:
         await message.answer(
             "✅ <b>Ваши контакты сохранены!</b>\n\n"
@@ -3757,6 +6241,14 @@ async def main():
     print("🚀 ЗАПУСК БОТА ТРИТИКА (ТЕНДЕРПОИСК)")
     print("="*60)
     
+    # Подключаемся к хранилищу (для PostgreSQL - пул соединений и схема)
+    try:
+        await db.open()
+    except Exception as e:
+        logger.error(f"❌ Ошибка подключения к хранилищу: {e}")
+        print(f"❌ Ошибка подключения к хранилищу: {e}")
+        return
+    
     # Создаем папку для экспортов если её нет
     os.makedirs(EXPORTS_DIR, exist_ok=True)
     print(f"✅ Папка для выгрузок создана: {EXPORTS_DIR}")
@@ -3796,9 +6288,45 @@ async def main():
         print("⚠️ Возможно, порт {PORT} уже занят")
         return
     
-    # Запускаем задачу для follow-up сообщений
-    asyncio.create_task(schedule_follow_ups())
-    print("✅ Follow-up система запущена")
+    # Очередь задач: уведомления администратору, follow-up и запросы контактов
+    # выполняются исполнителями с повторами; follow-up ставятся на срок выгрузки
+    try:
+        await load_follow_ups()
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки follow-up: {e}")
+    asyncio.create_task(job_queue.run())
+    print(f"✅ Очередь задач запущена ({JOB_WORKERS} исполнителей)")
+    
+    # Рассылка информации о компании и отчет эффективности по расписанию
+    if PERIODIC_TASKS_DAYS > 0:
+        try:
+            await schedule_periodic_tasks()
+            print(f"✅ Периодическая рассылка и отчет: раз в {PERIODIC_TASKS_DAYS} дн. в {PERIODIC_TASKS_HOUR}:00")
+        except Exception as e:
+            logger.error(f"❌ Ошибка планирования периодических задач: {e}")
+    
+    # События, оставшиеся без сводки (задача сводки исчерпала попытки)
+    try:
+        if await db.get_admin_events():
+            await schedule_admin_digest()
+    except Exception as e:
+        logger.error(f"❌ Ошибка планирования сводки администратору: {e}")
+    
+    # Продолжаем рассылки, прерванные перезапуском, и ставим таймеры отложенных
+    try:
+        await resume_mailing_jobs()
+        await load_scheduled_mailings()
+    except Exception as e:
+        logger.error(f"❌ Ошибка продолжения рассылок: {e}")
+    asyncio.create_task(timers.run())
+    print("✅ Отложенные рассылки активны")
+    
+    # Битовые карты сегментов строятся заранее: первый предпросмотр рассылки не ждет загрузки
+    try:
+        await segments.sync()
+        logger.info(f"🧩 Сегменты аудитории: {len(segments)} пользователей")
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки сегментов аудитории: {e}")
     
     # Очищаем вебхуки и добавляем небольшую задержку
     await bot.delete_webhook(drop_pending_updates=True)
@@ -3814,7 +6342,7 @@ async def main():
     print("🛠️ Админ-панель: /admin (если настроен ADMIN_ID)")
     print("\n🔄 Ожидание сообщений...")
     print(f"🌐 Health check активен на порту {PORT}\n")
-    print("⏰ Follow-up система активна (проверка каждые 5 минут)")
+    print("⏰ Follow-up система активна (задачи follow_up ставятся в очередь на срок отправки)")
     print("📨 Система запроса контактов для выгрузок активна")
     print("📱 Кнопка 'Поделиться телефоном' добавлена во вторую часть анкеты (при запросе контактов)")
     print("📱 Кнопка 'Поделиться телефоном' удалена из главного меню")
@@ -3831,6 +6359,8 @@ async def main():
         # Очищаем ресурсы
         await http_runner.cleanup()
         await bot.session.close()
+        await db.writes.flush()
+        await db.close()
         print("👋 Сессия бота закрыта")
 
 if __name__ == "__main__":
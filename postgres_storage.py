@@ -0,0 +1,1379 @@
+"""
+Хранилище бота на PostgreSQL (DB_BACKEND=postgres).
+
+Позволяет запускать несколько реплик бота над одной базой: схема
+применяется под advisory-блокировкой, соединения берутся из пула asyncpg.
+Метки времени, как и в SQLite, хранятся в секундах эпохи UTC (BIGINT),
+флаги - SMALLINT 0/1, поэтому общие фильтры аудитории работают без изменений.
+"""
+
+import itertools
+import json
+import logging
+import re
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+import asyncpg
+
+from storage import (StorageBackend, USER_FILTERS, USER_FILTER_COLUMNS, SEGMENT_FILTER_PREFIX, SEGMENT_COLUMNS,
+                     RECIPIENT_PAGE_SIZE, ADMIN_PAGE_SIZE, now_ts, period_bounds)
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки миграций схемы (одна реплика мигрирует, остальные ждут)
+SCHEMA_LOCK_ID = 0x7261737369
+
+# Соединение, привязанное к текущей задаче (вложенные вызовы работают в той же транзакции)
+_current_connection: ContextVar = ContextVar("postgres_connection", default=None)
+
+NOW_EPOCH = "EXTRACT(EPOCH FROM now())::BIGINT"
+
+
+def _numbered(query: str, start: int = 1) -> str:
+    """Замена параметров "?" на нумерованные $1, $2, ... (для общих фрагментов SQL)"""
+    counter = itertools.count(start)
+    return re.sub(r"\?", lambda match: f"${next(counter)}", query)
+
+
+def _rowcount(status: str) -> int:
+    """Число строк из статуса команды asyncpg ("UPDATE 3", "INSERT 0 5")"""
+    return int(status.split()[-1])
+
+
+class PostgresStorage(StorageBackend):
+    """PostgreSQL-бэкенд хранилища на пуле соединений asyncpg.
+    
+    Кэш пользователей не используется: записи других реплик его бы не
+    сбрасывали. Статистика считается диапазонными запросами по индексам *_at.
+    """
+    
+    name = "postgres"
+    
+    # Упорядоченные шаги миграции схемы: (версия, описание, SQL)
+    MIGRATIONS = [
+        (1, "Базовые таблицы", [
+            f'''
+            CREATE TABLE IF NOT EXISTS users (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT UNIQUE,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                phone TEXT,
+                email TEXT,
+                company TEXT,
+                activity TEXT,
+                region TEXT,
+                is_active SMALLINT DEFAULT 1,
+                has_filled_questionnaire SMALLINT DEFAULT 0,
+                mailing_subscribed SMALLINT DEFAULT 1,
+                created_at BIGINT DEFAULT {NOW_EPOCH},
+                last_mailing_date BIGINT
+            )''',
+            f'''
+            CREATE TABLE IF NOT EXISTS questionnaires (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT,
+                full_name TEXT,
+                company_name TEXT,
+                phone TEXT,
+                email TEXT,
+                activity TEXT,
+                region TEXT,
+                budget TEXT,
+                keywords TEXT,
+                filled_anketa_path TEXT,
+                status TEXT DEFAULT 'new',
+                created_at BIGINT DEFAULT {NOW_EPOCH}
+            )''',
+            f'''
+            CREATE TABLE IF NOT EXISTS tender_exports (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT,
+                file_path TEXT,
+                file_name TEXT,
+                sent_at BIGINT DEFAULT {NOW_EPOCH},
+                sent_by TEXT DEFAULT 'bot',
+                status TEXT DEFAULT 'pending',
+                admin_notified SMALLINT DEFAULT 0,
+                follow_up_sent SMALLINT DEFAULT 0,
+                follow_up_at BIGINT,
+                follow_up_response TEXT,
+                follow_up_scheduled SMALLINT DEFAULT 0
+            )''',
+            f'''
+            CREATE TABLE IF NOT EXISTS manual_mailings (
+                id BIGSERIAL PRIMARY KEY,
+                admin_id BIGINT,
+                mailing_text TEXT,
+                mailing_type TEXT,
+                filter_criteria TEXT,
+                sent_count INTEGER DEFAULT 0,
+                failed_count INTEGER DEFAULT 0,
+                feedback_count INTEGER DEFAULT 0,
+                created_at BIGINT DEFAULT {NOW_EPOCH},
+                sent_at BIGINT
+            )''',
+            f'''
+            CREATE TABLE IF NOT EXISTS sent_messages (
+                id BIGSERIAL PRIMARY KEY,
+                mailing_id BIGINT,
+                user_id BIGINT,
+                telegram_message_id BIGINT,
+                sent_at BIGINT DEFAULT {NOW_EPOCH},
+                feedback_received SMALLINT DEFAULT 0
+            )''',
+            f'''
+            CREATE TABLE IF NOT EXISTS mailing_feedback (
+                id BIGSERIAL PRIMARY KEY,
+                mailing_id BIGINT,
+                user_id BIGINT,
+                sent_message_id BIGINT,
+                feedback_type TEXT,
+                feedback_text TEXT,
+                created_at BIGINT DEFAULT {NOW_EPOCH}
+            )''',
+            f'''
+            CREATE TABLE IF NOT EXISTS manager_messages (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT,
+                message_type TEXT,
+                message_text TEXT,
+                file_id TEXT,
+                file_name TEXT,
+                admin_notified SMALLINT DEFAULT 0,
+                processed SMALLINT DEFAULT 0,
+                created_at BIGINT DEFAULT {NOW_EPOCH}
+            )''',
+            f'''
+            CREATE TABLE IF NOT EXISTS contact_requests (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT,
+                export_id BIGINT,
+                requested_at BIGINT DEFAULT {NOW_EPOCH},
+                completed SMALLINT DEFAULT 0,
+                completed_at BIGINT
+            )''',
+        ]),
+        (2, "Индексы для частых запросов", [
+            '''CREATE INDEX IF NOT EXISTS idx_tender_exports_followup
+               ON tender_exports (status, follow_up_sent, follow_up_scheduled, sent_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_tender_exports_user
+               ON tender_exports (user_id, sent_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_tender_exports_status_sent
+               ON tender_exports (status, sent_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_sent_messages_user_message
+               ON sent_messages (user_id, telegram_message_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_sent_messages_mailing
+               ON sent_messages (mailing_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_feedback_mailing
+               ON mailing_feedback (mailing_id, created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_feedback_user
+               ON mailing_feedback (user_id, created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_feedback_created
+               ON mailing_feedback (created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_feedback_type
+               ON mailing_feedback (feedback_type, created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_manager_messages_inbox
+               ON manager_messages (processed, created_at, id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_manager_messages_user
+               ON manager_messages (user_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_manager_messages_created
+               ON manager_messages (created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_questionnaires_user_status
+               ON questionnaires (user_id, status, created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_questionnaires_status
+               ON questionnaires (status, created_at, id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_questionnaires_created
+               ON questionnaires (created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_contact_requests_export
+               ON contact_requests (export_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_users_created
+               ON users (created_at)''',
+            '''CREATE INDEX IF NOT EXISTS idx_users_audience
+               ON users (is_active, mailing_subscribed, user_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_manual_mailings_created
+               ON manual_mailings (created_at, id)''',
+        ]),
+        (3, "Очередь получателей рассылок", [
+            "ALTER TABLE manual_mailings ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'done'",
+            '''
+            CREATE TABLE IF NOT EXISTS mailing_recipients (
+                mailing_id BIGINT NOT NULL,
+                user_id BIGINT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                telegram_message_id BIGINT,
+                sent_message_id BIGINT,
+                error TEXT,
+                updated_at BIGINT,
+                PRIMARY KEY (mailing_id, user_id)
+            )''',
+            '''CREATE INDEX IF NOT EXISTS idx_mailing_recipients_state
+               ON mailing_recipients (mailing_id, state, user_id)''',
+            '''CREATE INDEX IF NOT EXISTS idx_manual_mailings_status
+               ON manual_mailings (status)''',
+        ]),
+        (4, "Вложения рассылок", [
+            "ALTER TABLE manual_mailings ADD COLUMN IF NOT EXISTS media TEXT",
+        ]),
+        (5, "Отложенные рассылки", [
+            f'''
+            CREATE TABLE IF NOT EXISTS scheduled_mailings (
+                mailing_id BIGINT PRIMARY KEY,
+                run_at BIGINT NOT NULL,
+                working_hours_only SMALLINT DEFAULT 0,
+                created_at BIGINT DEFAULT {NOW_EPOCH}
+            )''',
+        ]),
+        (6, "Метка изменения пользователей", [
+            "ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at BIGINT",
+            "CREATE INDEX IF NOT EXISTS idx_users_updated ON users (updated_at)",
+            f'''
+            CREATE OR REPLACE FUNCTION users_touch() RETURNS trigger AS $$
+            BEGIN
+                NEW.updated_at := {NOW_EPOCH};
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql''',
+            "DROP TRIGGER IF EXISTS trg_users_touch ON users",
+            f'''CREATE TRIGGER trg_users_touch
+               BEFORE UPDATE OF {SEGMENT_COLUMNS}
+               ON users FOR EACH ROW EXECUTE FUNCTION users_touch()''',
+        ]),
+        (7, "Очередь задач", [
+            f'''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id BIGSERIAL PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL DEFAULT '{{}}',
+                job_key TEXT UNIQUE,
+                status TEXT NOT NULL DEFAULT 'queued',
+                run_at BIGINT NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                max_attempts INTEGER DEFAULT 8,
+                last_error TEXT,
+                created_at BIGINT DEFAULT {NOW_EPOCH},
+                updated_at BIGINT
+            )''',
+            "CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, run_at)",
+        ]),
+        (8, "События для сводок администратору", [
+            f'''
+            CREATE TABLE IF NOT EXISTS admin_events (
+                id BIGSERIAL PRIMARY KEY,
+                kind TEXT NOT NULL,
+                mailing_id BIGINT,
+                user_id BIGINT,
+                username TEXT,
+                details TEXT,
+                created_at BIGINT DEFAULT {NOW_EPOCH}
+            )''',
+        ]),
+    ]
+    
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+    
+    async def open(self):
+        """Создание пула соединений и применение недостающих миграций схемы"""
+        if not self.dsn:
+            raise RuntimeError("DATABASE_URL не задан для DB_BACKEND=postgres")
+        
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+        await self._migrate()
+    
+    async def close(self):
+        """Закрытие пула соединений"""
+        if self.pool is not None:
+            await self.pool.close()
+    
+    def status(self) -> dict:
+        """Сведения о хранилище для /status"""
+        if self.pool is None:
+            return {"backend": self.name, "pool": None}
+        return {
+            "backend": self.name,
+            "pool": {"size": self.pool.get_size(), "idle": self.pool.get_idle_size()}
+        }
+    
+    async def _migrate(self):
+        """Применение миграций под advisory-блокировкой (безопасно для нескольких реплик)"""
+        async with self._transaction() as conn:
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_ID)
+            await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at BIGINT DEFAULT {NOW_EPOCH}
+            )
+            ''')
+            current = await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            
+            for version, description, statements in self.MIGRATIONS:
+                if version <= current:
+                    continue
+                for statement in statements:
+                    await conn.execute(statement)
+                await conn.execute('''
+                INSERT INTO schema_version (version, description)
+                VALUES ($1, $2)
+                ''', version, description)
+                logger.info(f"✅ Миграция схемы PostgreSQL v{version}: {description}")
+        
+        logger.info(f"✅ База данных PostgreSQL инициализирована (схема v{self.MIGRATIONS[-1][0]})")
+    
+    # ---------- Соединения и транзакции ----------
+    @asynccontextmanager
+    async def _connection(self):
+        """Соединение текущей задачи или новое из пула"""
+        conn = _current_connection.get()
+        if conn is not None:
+            yield conn
+            return
+        
+        async with self.pool.acquire() as conn:
+            token = _current_connection.set(conn)
+            try:
+                yield conn
+            finally:
+                _current_connection.reset(token)
+    
+    @asynccontextmanager
+    async def _transaction(self):
+        """Транзакция записи; вложенная транзакция становится точкой сохранения"""
+        async with self._connection() as conn:
+            async with conn.transaction():
+                yield conn
+    
+    async def _fetch(self, query: str, *args):
+        async with self._connection() as conn:
+            return await conn.fetch(query, *args)
+    
+    async def _fetchrow(self, query: str, *args):
+        async with self._connection() as conn:
+            return await conn.fetchrow(query, *args)
+    
+    async def _fetchval(self, query: str, *args):
+        async with self._connection() as conn:
+            return await conn.fetchval(query, *args)
+    
+    async def _execute(self, query: str, *args):
+        async with self._transaction() as conn:
+            return await conn.execute(query, *args)
+    
+    async def apply_writes(self, batch: list) -> list:
+        """Пачка отложенных записей одной транзакцией, каждая в своей точке сохранения"""
+        results = []
+        
+        async with self._transaction():
+            for name, args, kwargs, _ in batch:
+                try:
+                    async with self._transaction():
+                        value = await getattr(self, name)(*args, **kwargs)
+                    results.append((True, value))
+                except Exception as e:
+                    logger.error(f"❌ Ошибка отложенной записи {name}: {e}")
+                    results.append((False, e))
+        
+        return results
+    
+    async def _keyset_page(self, query: str, params: tuple, keys: tuple, cursor: tuple = None,
+                           direction: str = "next", limit: int = ADMIN_PAGE_SIZE):
+        """Страница keyset-пагинации, новые сверху: (строки, есть_предыдущая, есть_следующая).
+        
+        query - SELECT с WHERE без сортировки (параметры "?"), keys - колонки
+        ключа сортировки, cursor - значения ключа крайней строки текущей страницы.
+        """
+        backwards = cursor is not None and direction == "prev"
+        if cursor is not None:
+            placeholders = ", ".join("?" * len(keys))
+            query += f" AND ({', '.join(keys)}) {'>' if backwards else '<'} ({placeholders})"
+            params = tuple(params) + tuple(cursor)
+        
+        order = "ASC" if backwards else "DESC"
+        query += " ORDER BY " + ", ".join(f"{key} {order}" for key in keys) + " LIMIT ?"
+        
+        rows = await self._fetch(_numbered(query), *params, limit + 1)
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            return rows[::-1], has_more, True
+        return rows, cursor is not None, has_more
+    
+    # ---------- Пользователи ----------
+    async def add_user(self, user_id: int, username: str, first_name: str, last_name: str = ""):
+        """Добавление пользователя"""
+        await self._execute('''
+        INSERT INTO users (user_id, username, first_name, last_name)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (user_id) DO NOTHING
+        ''', user_id, username, first_name, last_name)
+        return True
+    
+    async def update_user_phone(self, user_id: int, phone: str):
+        """Сохранение телефона пользователя"""
+        await self._execute('''
+        UPDATE users
+        SET phone = $1
+        WHERE user_id = $2
+        ''', phone, user_id)
+    
+    async def get_user_by_id(self, user_id: int):
+        """Получение пользователя по ID"""
+        return await self._fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
+    
+    async def toggle_user_mailing_subscription(self, user_id: int):
+        """Включение/выключение подписки на рассылку"""
+        result = await self._fetchval('''
+        UPDATE users
+        SET mailing_subscribed = 1 - mailing_subscribed
+        WHERE user_id = $1
+        RETURNING mailing_subscribed
+        ''', user_id)
+        return None if result is None else bool(result)
+    
+    async def get_user_mailing_status(self, user_id: int):
+        """Получение статуса подписки на рассылку"""
+        result = await self._fetchrow('''
+        SELECT mailing_subscribed, username, first_name, last_name
+        FROM users
+        WHERE user_id = $1
+        ''', user_id)
+        
+        if result:
+            return {
+                'subscribed': bool(result[0]),
+                'username': result[1],
+                'first_name': result[2],
+                'last_name': result[3]
+            }
+        return None
+    
+    async def deactivate_users(self, user_ids: list):
+        """Деактивация пользователей, которым нельзя доставить сообщение (одним UPDATE)"""
+        await self._execute('''
+        UPDATE users
+        SET is_active = 0
+        WHERE is_active = 1 AND user_id = ANY($1::BIGINT[])
+        ''', list(user_ids))
+        return len(user_ids)
+    
+    @staticmethod
+    def _user_filter(filter_type: str):
+        """Условие и параметры фильтра аудитории (None для неизвестного фильтра)"""
+        if filter_type not in USER_FILTERS:
+            return None
+        condition, params = USER_FILTERS[filter_type]
+        return condition, tuple(params()) if params else ()
+    
+    def _recipient_filter(self, filter_type: str, user_ids: Optional[list] = None):
+        """Фильтр очереди получателей: для сегмента - активные подписчики из списка user_ids"""
+        if filter_type.startswith(SEGMENT_FILTER_PREFIX):
+            return self._user_filter("all") if user_ids is not None else None
+        return self._user_filter(filter_type)
+    
+    async def get_users_by_filter(self, filter_type: str):
+        """Получение пользователей по фильтру с учетом подписки"""
+        user_filter = self._user_filter(filter_type)
+        if not user_filter:
+            return []
+        
+        condition, params = user_filter
+        return await self._fetch(_numbered(f'''
+        SELECT {USER_FILTER_COLUMNS}
+        FROM users
+        WHERE {condition}
+        ORDER BY user_id
+        '''), *params)
+    
+    async def count_users_by_filter(self, filter_type: str):
+        """Количество пользователей по фильтру (для предпросмотра рассылки)"""
+        user_filter = self._user_filter(filter_type)
+        if not user_filter:
+            return 0
+        
+        condition, params = user_filter
+        return await self._fetchval(_numbered(f'SELECT COUNT(*) FROM users WHERE {condition}'), *params)
+    
+    async def get_users_page(self, filter_type: str, after_user_id: int = 0, limit: int = RECIPIENT_PAGE_SIZE):
+        """Страница пользователей по фильтру: keyset по user_id"""
+        user_filter = self._user_filter(filter_type)
+        if not user_filter:
+            return []
+        
+        condition, params = user_filter
+        return await self._fetch(_numbered(f'''
+        SELECT {USER_FILTER_COLUMNS}
+        FROM users
+        WHERE {condition} AND user_id > ?
+        ORDER BY user_id
+        LIMIT ?
+        '''), *params, after_user_id, limit)
+    
+    async def get_user_segment_rows(self, after_id: int = 0, updated_since: int = 0):
+        """Строки пользователей для сегментов: новые (id > after_id) и измененные начиная с updated_since"""
+        return await self._fetch(f'''
+        SELECT id, user_id, created_at, {SEGMENT_COLUMNS}
+        FROM users
+        WHERE id > $1 OR updated_at >= $2
+        ''', after_id, updated_since)
+    
+    async def get_subscription_users_page(self, filter_type: str = "all", cursor: tuple = None,
+                                          direction: str = "next", limit: int = ADMIN_PAGE_SIZE):
+        """Страница пользователей для управления подписками (all / subscribed / unsubscribed)"""
+        condition = "is_active = 1"
+        if filter_type in ("subscribed", "unsubscribed"):
+            condition = USER_FILTERS[filter_type][0]
+        
+        return await self._keyset_page(f'''
+            SELECT id, user_id, username, first_name, last_name, company,
+                   mailing_subscribed, has_filled_questionnaire, created_at
+            FROM users
+            WHERE {condition}
+            ''', (), ("id",), cursor, direction, limit)
+    
+    async def get_all_users_with_subscription(self, limit: int = 50):
+        """Получение всех пользователей с информацией о подписке"""
+        return await self._fetch('''
+        SELECT user_id, username, first_name, last_name, company,
+               mailing_subscribed, has_filled_questionnaire, created_at
+        FROM users
+        WHERE is_active = 1
+        ORDER BY created_at DESC
+        LIMIT $1
+        ''', limit)
+    
+    async def get_user_activity_summary(self, user_id: int):
+        """Пользователь со сводкой активности (анкеты, выгрузки, сообщения, отзывы)"""
+        return await self._fetchrow('''
+        SELECT u.*,
+               (SELECT COUNT(*) FROM questionnaires q WHERE q.user_id = u.user_id) as questionnaire_count,
+               (SELECT COUNT(*) FROM tender_exports te WHERE te.user_id = u.user_id) as export_count,
+               (SELECT COUNT(*) FROM manager_messages mm WHERE mm.user_id = u.user_id) as message_count,
+               (SELECT COUNT(*) FROM mailing_feedback mf WHERE mf.user_id = u.user_id) as feedback_count
+        FROM users u
+        WHERE u.user_id = $1
+        ''', user_id)
+    
+    async def get_subscription_stats(self):
+        """Статистика подписок активных пользователей"""
+        stats = await self._fetchrow('''
+        SELECT
+            COUNT(*) as total_users,
+            COUNT(*) FILTER (WHERE mailing_subscribed = 1) as subscribed,
+            COUNT(*) FILTER (WHERE mailing_subscribed = 0) as unsubscribed,
+            COUNT(*) FILTER (WHERE has_filled_questionnaire = 1) as with_anketa,
+            COUNT(*) FILTER (WHERE has_filled_questionnaire = 0) as without_anketa
+        FROM users
+        WHERE is_active = 1
+        ''')
+        
+        recent_unsubscribes = await self._fetchval('''
+        SELECT COUNT(*)
+        FROM mailing_feedback
+        WHERE feedback_type = 'unsubscribe'
+        AND created_at >= $1 AND created_at < $2
+        ''', *period_bounds(30))
+        
+        return {
+            'total_users': stats['total_users'],
+            'subscribed': stats['subscribed'],
+            'unsubscribed': stats['unsubscribed'],
+            'with_anketa': stats['with_anketa'],
+            'without_anketa': stats['without_anketa'],
+            'recent_unsubscribes': recent_unsubscribes
+        }
+    
+    # ---------- Анкеты ----------
+    async def save_questionnaire_partial(self, user_id: int, data: dict):
+        """Сохранение частичной анкеты (только вопросы 1-4)"""
+        async with self._transaction() as conn:
+            last_id = await conn.fetchval('''
+            INSERT INTO questionnaires
+            (user_id, activity, region, budget, keywords, status)
+            VALUES ($1, $2, $3, $4, $5, 'partial')
+            RETURNING id
+            ''', user_id, data.get('activity'), data.get('region'), data.get('budget'), data.get('keywords'))
+            
+            await conn.execute('''
+            UPDATE users
+            SET activity = $1, region = $2, has_filled_questionnaire = 1
+            WHERE user_id = $3
+            ''', data.get('activity'), data.get('region'), user_id)
+        
+        return last_id
+    
+    async def save_questionnaire(self, user_id: int, data: dict, anketa_path: str = None):
+        """Сохранение полной анкеты (все 8 вопросов)"""
+        async with self._transaction() as conn:
+            last_id = await conn.fetchval('''
+            INSERT INTO questionnaires
+            (user_id, full_name, company_name, phone, email, activity, region, budget, keywords, filled_anketa_path, status)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, 'complete')
+            RETURNING id
+            ''', user_id, data.get('full_name'), data.get('company_name'), data.get('phone'),
+                data.get('email'), data.get('activity'), data.get('region'), data.get('budget'),
+                data.get('keywords'), anketa_path)
+            
+            await conn.execute('''
+            UPDATE users
+            SET phone = $1, email = $2, company = $3, activity = $4, region = $5, has_filled_questionnaire = 1
+            WHERE user_id = $6
+            ''', data.get('phone'), data.get('email'), data.get('company_name'),
+                data.get('activity'), data.get('region'), user_id)
+        
+        return last_id
+    
+    async def update_partial_to_complete(self, user_id: int, data: dict):
+        """Обновление частичной анкеты до полной (добавление контактов)"""
+        async with self._transaction() as conn:
+            await conn.execute('''
+            UPDATE questionnaires
+            SET company_name = $1, full_name = $2, phone = $3, email = $4, status = 'complete'
+            WHERE user_id = $5 AND status = 'partial'
+            ''', data.get('company_name'), data.get('full_name'), data.get('phone'), data.get('email'), user_id)
+            
+            await conn.execute('''
+            UPDATE users
+            SET phone = $1, email = $2, company = $3
+            WHERE user_id = $4
+            ''', data.get('phone'), data.get('email'), data.get('company_name'), user_id)
+        
+        return True
+    
+    async def get_partial_questionnaires(self):
+        """Получение частичных анкет (только 1-4 вопросы)"""
+        return await self._fetch('''
+        SELECT q.*, u.username
+        FROM questionnaires q
+        LEFT JOIN users u ON q.user_id = u.user_id
+        WHERE q.status = 'partial'
+        ORDER BY q.created_at DESC
+        LIMIT 20
+        ''')
+    
+    async def get_partial_questionnaires_page(self, cursor: tuple = None, direction: str = "next",
+                                              limit: int = ADMIN_PAGE_SIZE):
+        """Страница частичных анкет"""
+        return await self._keyset_page('''
+            SELECT q.*, u.username
+            FROM questionnaires q
+            LEFT JOIN users u ON q.user_id = u.user_id
+            WHERE q.status = 'partial'
+            ''', (), ("q.created_at", "q.id"), cursor, direction, limit)
+    
+    async def get_complete_questionnaires(self):
+        """Получение полных анкет"""
+        return await self._fetch('''
+        SELECT q.*, u.username
+        FROM questionnaires q
+        LEFT JOIN users u ON q.user_id = u.user_id
+        WHERE q.status = 'complete'
+        ORDER BY q.created_at DESC
+        LIMIT 20
+        ''')
+    
+    async def has_complete_questionnaire(self, user_id: int):
+        """Проверка, есть ли у пользователя полная анкета с контактами"""
+        return await self._fetchval('''
+        SELECT EXISTS (
+            SELECT 1
+            FROM questionnaires
+            WHERE user_id = $1 AND status = 'complete'
+            AND full_name IS NOT NULL
+            AND phone IS NOT NULL
+            AND email IS NOT NULL
+        )
+        ''', user_id)
+    
+    async def get_last_complete_questionnaire(self, user_id: int):
+        """Получение последней полной анкеты пользователя"""
+        return await self._fetchrow('''
+        SELECT *
+        FROM questionnaires
+        WHERE user_id = $1 AND status = 'complete'
+        ORDER BY created_at DESC
+        LIMIT 1
+        ''', user_id)
+    
+    # ---------- Выгрузки ----------
+    async def create_tender_export(self, user_id: int, file_path: str = None, file_name: str = None):
+        """Создание записи о выгрузке тендеров"""
+        return await self._fetchval('''
+        INSERT INTO tender_exports
+        (user_id, file_path, file_name, follow_up_scheduled)
+        VALUES ($1, $2, $3, 1)
+        RETURNING id
+        ''', user_id, file_path, file_name)
+    
+    async def create_tender_export_without_file(self, user_id: int):
+        """Создание записи о выгрузке без файла"""
+        return await self._fetchval('''
+        INSERT INTO tender_exports
+        (user_id, follow_up_scheduled, status)
+        VALUES ($1, 1, 'pending')
+        RETURNING id
+        ''', user_id)
+    
+    async def mark_export_completed(self, export_id: int, admin_name: str = "Олег"):
+        """Отметка выполнения выгрузки администратором (sent_at выгрузки - отсчет follow-up)"""
+        return await self._fetchval('''
+        UPDATE tender_exports
+        SET sent_by = $1, status = 'completed', admin_notified = 1
+        WHERE id = $2
+        RETURNING sent_at
+        ''', admin_name, export_id)
+    
+    async def cancel_export(self, export_id: int):
+        """Отмена выгрузки"""
+        await self._execute("UPDATE tender_exports SET status = 'cancelled' WHERE id = $1", export_id)
+    
+    async def save_export_file(self, export_id: int, file_path: str, file_name: str):
+        """Сохранение пути к файлу выгрузки"""
+        await self._execute('''
+        UPDATE tender_exports
+        SET file_path = $1, file_name = $2, status = 'pending'
+        WHERE id = $3
+        ''', file_path, file_name, export_id)
+    
+    async def get_pending_exports(self):
+        """Получение ожидающих выгрузок"""
+        return await self._fetch('''
+        SELECT te.*, u.username, u.first_name, u.last_name, u.email, u.phone
+        FROM tender_exports te
+        JOIN users u ON te.user_id = u.user_id
+        WHERE te.status = 'pending'
+        ORDER BY te.sent_at DESC
+        LIMIT 10
+        ''')
+    
+    async def get_export_by_id(self, export_id: int):
+        """Получение выгрузки по ID"""
+        return await self._fetchrow('''
+        SELECT te.*, u.username, u.first_name, u.last_name, u.email, u.phone
+        FROM tender_exports te
+        JOIN users u ON te.user_id = u.user_id
+        WHERE te.id = $1
+        ''', export_id)
+    
+    async def get_user_exports(self, user_id: int):
+        """Получение всех выгрузок пользователя"""
+        return await self._fetch('''
+        SELECT te.*
+        FROM tender_exports te
+        WHERE te.user_id = $1
+        ORDER BY te.sent_at DESC
+        LIMIT 20
+        ''', user_id)
+    
+    async def get_exports_for_followup(self, delay: int = 3600, limit: int = None, after_id: int = 0):
+        """Выгрузки, для которых нужно отправить follow-up (через delay сек после выгрузки):
+        пачка из limit штук по возрастанию ID после after_id"""
+        return await self._fetch('''
+        SELECT te.*, u.username, u.first_name, u.last_name
+        FROM tender_exports te
+        JOIN users u ON te.user_id = u.user_id
+        WHERE te.status = 'completed'
+        AND te.follow_up_scheduled = 1
+        AND te.follow_up_sent = 0
+        AND te.sent_at <= $1
+        AND te.id > $2
+        ORDER BY te.id
+        LIMIT $3
+        ''', now_ts() - delay, after_id, limit)
+    
+    async def get_pending_followups(self):
+        """Выгрузки, ожидающие follow-up: (id, sent_at) - для таймеров при запуске"""
+        return await self._fetch('''
+        SELECT id, sent_at
+        FROM tender_exports
+        WHERE status = 'completed'
+        AND follow_up_scheduled = 1
+        AND follow_up_sent = 0
+        ''')
+    
+    async def get_export_for_followup(self, export_id: int):
+        """Выгрузка с данными пользователя, если follow-up по ней еще не отправлен"""
+        return await self._fetchrow('''
+        SELECT te.*, u.username, u.first_name, u.last_name
+        FROM tender_exports te
+        JOIN users u ON te.user_id = u.user_id
+        WHERE te.id = $1
+        AND te.status = 'completed'
+        AND te.follow_up_scheduled = 1
+        AND te.follow_up_sent = 0
+        ''', export_id)
+    
+    async def mark_followups_sent(self, export_ids: list):
+        """Отметка, что follow-up по выгрузкам отправлен (одним UPDATE)"""
+        await self._execute('''
+        UPDATE tender_exports
+        SET follow_up_sent = 1, follow_up_at = $1
+        WHERE id = ANY($2::BIGINT[])
+        ''', now_ts(), list(export_ids))
+    
+    async def save_followup_response(self, export_id: int, response: str):
+        """Сохранение ответа на follow-up"""
+        await self._execute('UPDATE tender_exports SET follow_up_response = $1 WHERE id = $2', response, export_id)
+    
+    async def create_contact_request(self, user_id: int, export_id: int):
+        """Создание запроса контактов для выгрузки"""
+        return await self._fetchval('''
+        INSERT INTO contact_requests (user_id, export_id)
+        VALUES ($1, $2)
+        RETURNING id
+        ''', user_id, export_id)
+    
+    async def mark_contact_request_completed(self, export_id: int):
+        """Отметка запроса контактов как выполненного"""
+        await self._execute('''
+        UPDATE contact_requests
+        SET completed = 1, completed_at = $1
+        WHERE export_id = $2
+        ''', now_ts(), export_id)
+    
+    # ---------- Рассылки и обратная связь ----------
+    async def create_manual_mailing(self, admin_id: int, mailing_text: str, mailing_type: str, filter_criteria: str):
+        """Создание ручной рассылки"""
+        return await self._fetchval('''
+        INSERT INTO manual_mailings (admin_id, mailing_text, mailing_type, filter_criteria)
+        VALUES ($1, $2, $3, $4)
+        RETURNING id
+        ''', admin_id, mailing_text, mailing_type, filter_criteria)
+    
+    async def save_sent_message(self, mailing_id: int, user_id: int, telegram_message_id: int):
+        """Сохранение отправленного сообщения"""
+        return await self._fetchval('''
+        INSERT INTO sent_messages (mailing_id, user_id, telegram_message_id)
+        VALUES ($1, $2, $3)
+        RETURNING id
+        ''', mailing_id, user_id, telegram_message_id)
+    
+    async def get_sent_message(self, sent_message_id: int, user_id: int):
+        """Получение отправленного сообщения рассылки пользователя"""
+        return await self._fetchrow('''
+        SELECT sm.*, mm.mailing_text
+        FROM sent_messages sm
+        JOIN manual_mailings mm ON sm.mailing_id = mm.id
+        WHERE sm.id = $1 AND sm.user_id = $2
+        ''', sent_message_id, user_id)
+    
+    async def get_sent_message_by_telegram_id(self, user_id: int, telegram_message_id: int):
+        """Получение отправленного сообщения по ID Telegram"""
+        return await self._fetchrow('''
+        SELECT sm.*, mm.mailing_text
+        FROM sent_messages sm
+        JOIN manual_mailings mm ON sm.mailing_id = mm.id
+        WHERE sm.user_id = $1 AND sm.telegram_message_id = $2
+        ''', user_id, telegram_message_id)
+    
+    async def update_mailing_stats(self, mailing_id: int, sent_count: int, failed_count: int):
+        """Обновление статистики рассылки"""
+        await self._execute('''
+        UPDATE manual_mailings
+        SET sent_count = $1, failed_count = $2, sent_at = $3
+        WHERE id = $4
+        ''', sent_count, failed_count, now_ts(), mailing_id)
+    
+    async def save_mailing_feedback(self, mailing_id: int, user_id: int, sent_message_id: int,
+                                    feedback_type: str, feedback_text: str = ""):
+        """Сохранение обратной связи по рассылке"""
+        async with self._transaction() as conn:
+            feedback_id = await conn.fetchval('''
+            INSERT INTO mailing_feedback
+            (mailing_id, user_id, sent_message_id, feedback_type, feedback_text)
+            VALUES ($1, $2, $3, $4, $5)
+            RETURNING id
+            ''', mailing_id, user_id, sent_message_id, feedback_type, feedback_text)
+            
+            await conn.execute(
+                'UPDATE manual_mailings SET feedback_count = feedback_count + 1 WHERE id = $1', mailing_id)
+            await conn.execute(
+                'UPDATE sent_messages SET feedback_received = 1 WHERE id = $1', sent_message_id)
+        
+        return feedback_id
+    
+    async def get_mailing_feedback(self, mailing_id: int):
+        """Получение обратной связи по рассылке"""
+        return await self._fetch('''
+        SELECT mf.*, u.username, u.first_name, u.last_name
+        FROM mailing_feedback mf
+        JOIN users u ON mf.user_id = u.user_id
+        WHERE mf.mailing_id = $1
+        ORDER BY mf.created_at DESC
+        ''', mailing_id)
+    
+    async def get_mailing_feedback_for_user(self, user_id: int):
+        """Получение обратной связи по пользователю"""
+        return await self._fetch('''
+        SELECT mf.*, mm.mailing_text
+        FROM mailing_feedback mf
+        JOIN manual_mailings mm ON mf.mailing_id = mm.id
+        WHERE mf.user_id = $1
+        ORDER BY mf.created_at DESC
+        LIMIT 10
+        ''', user_id)
+    
+    async def get_mailings_with_feedback(self, limit: int = 10):
+        """Последние отправленные рассылки с числом отозвавшихся пользователей"""
+        return await self._fetch('''
+        SELECT mm.id, mm.mailing_text, mm.created_at,
+               mm.sent_count, mm.feedback_count,
+               (SELECT COUNT(DISTINCT mf.user_id)
+                FROM mailing_feedback mf
+                WHERE mf.mailing_id = mm.id) as feedback_users
+        FROM manual_mailings mm
+        WHERE mm.sent_count > 0
+        ORDER BY mm.created_at DESC
+        LIMIT $1
+        ''', limit)
+    
+    async def get_mailings_with_feedback_page(self, cursor: tuple = None, direction: str = "next",
+                                              limit: int = ADMIN_PAGE_SIZE):
+        """Страница отправленных рассылок с числом отозвавшихся пользователей"""
+        return await self._keyset_page('''
+            SELECT mm.id, mm.mailing_text, mm.created_at,
+                   mm.sent_count, mm.feedback_count,
+                   (SELECT COUNT(DISTINCT mf.user_id)
+                    FROM mailing_feedback mf
+                    WHERE mf.mailing_id = mm.id) as feedback_users
+            FROM manual_mailings mm
+            WHERE mm.sent_count > 0
+            ''', (), ("mm.created_at", "mm.id"), cursor, direction, limit)
+    
+    async def get_feedback_stats(self):
+        """Сводная статистика обратной связи по рассылкам"""
+        start, end = period_bounds(30)
+        
+        stats = await self._fetchrow('''
+        SELECT
+            COUNT(*) as total_feedback,
+            COUNT(*) FILTER (WHERE feedback_type = 'like') as likes,
+            COUNT(*) FILTER (WHERE feedback_type = 'dislike') as dislikes,
+            COUNT(*) FILTER (WHERE feedback_type = 'comment') as comments,
+            COUNT(*) FILTER (WHERE feedback_type = 'unsubscribe') as unsubscribes,
+            COUNT(*) FILTER (WHERE created_at >= $1 AND created_at < $2) as recent_feedback,
+            COUNT(*) FILTER (WHERE feedback_type = 'unsubscribe'
+                             AND created_at >= $1 AND created_at < $2) as recent_unsubscribes
+        FROM mailing_feedback
+        ''', start, end)
+        
+        popular = await self._fetch('''
+        SELECT mm.id, mm.mailing_text, COUNT(mf.id) as feedback_count
+        FROM manual_mailings mm
+        LEFT JOIN mailing_feedback mf ON mm.id = mf.mailing_id
+        GROUP BY mm.id
+        ORDER BY feedback_count DESC
+        LIMIT 5
+        ''')
+        
+        return {**dict(stats), 'popular': popular}
+    
+    # ---------- Задания рассылок ----------
+    async def create_mailing_job(self, admin_id: int, mailing_text: str, filter_type: str,
+                                 media: Optional[list] = None, user_ids: Optional[list] = None):
+        """Создание рассылки с очередью получателей по фильтру: (ID рассылки, число получателей).
+        
+        Для сегмента (SEGMENT_FILTER_PREFIX) получатели передаются в user_ids.
+        """
+        user_filter = self._recipient_filter(filter_type, user_ids)
+        if not user_filter:
+            return None, 0
+        
+        async with self._transaction() as conn:
+            mailing_id = await conn.fetchval('''
+            INSERT INTO manual_mailings (admin_id, mailing_text, mailing_type, filter_criteria, media, status)
+            VALUES ($1, $2, $3, '{}', $4, 'running')
+            RETURNING id
+            ''', admin_id, mailing_text, filter_type, json.dumps(media) if media else None)
+            
+            recipients = await self._enqueue_recipients(conn, mailing_id, user_filter, user_ids)
+        
+        return mailing_id, recipients
+    
+    @staticmethod
+    async def _enqueue_recipients(conn, mailing_id: int, user_filter: tuple, user_ids: Optional[list] = None) -> int:
+        """Заполнение очереди получателей рассылки по фильтру (число получателей)"""
+        condition, params = user_filter
+        if user_ids is None:
+            recipients = _rowcount(await conn.execute(_numbered(f'''
+            INSERT INTO mailing_recipients (mailing_id, user_id)
+            SELECT ?::BIGINT, user_id FROM users
+            WHERE {condition}
+            '''), mailing_id, *params))
+        else:
+            # Список сегмента сверяется с фильтром: пользователь мог отписаться после предпросмотра
+            recipients = _rowcount(await conn.execute(_numbered(f'''
+            INSERT INTO mailing_recipients (mailing_id, user_id)
+            SELECT ?::BIGINT, user_id FROM users
+            WHERE {condition} AND user_id = ANY(?::BIGINT[])
+            '''), mailing_id, *params, list(user_ids)))
+        
+        await conn.execute('UPDATE manual_mailings SET filter_criteria = $1 WHERE id = $2',
+                           json.dumps({"user_count": recipients}), mailing_id)
+        return recipients
+    
+    async def schedule_mailing(self, admin_id: int, mailing_text: str, filter_type: str, media: Optional[list],
+                               run_at: int, working_hours_only: bool = False):
+        """Отложенная рассылка: получатели выбираются по фильтру в момент отправки (ID рассылки)"""
+        if not filter_type.startswith(SEGMENT_FILTER_PREFIX) and not self._user_filter(filter_type):
+            return None
+        
+        async with self._transaction() as conn:
+            mailing_id = await conn.fetchval('''
+            INSERT INTO manual_mailings (admin_id, mailing_text, mailing_type, filter_criteria, media, status)
+            VALUES ($1, $2, $3, '{}', $4, 'scheduled')
+            RETURNING id
+            ''', admin_id, mailing_text, filter_type, json.dumps(media) if media else None)
+            
+            await conn.execute('''
+            INSERT INTO scheduled_mailings (mailing_id, run_at, working_hours_only)
+            VALUES ($1, $2, $3)
+            ''', mailing_id, run_at, int(working_hours_only))
+        
+        return mailing_id
+    
+    async def get_scheduled_mailings(self):
+        """Рассылки, ожидающие срока отправки"""
+        return await self._fetch('''
+        SELECT mm.id, mm.admin_id, sm.run_at, sm.working_hours_only
+        FROM scheduled_mailings sm
+        JOIN manual_mailings mm ON mm.id = sm.mailing_id
+        WHERE mm.status = 'scheduled'
+        ORDER BY sm.run_at
+        ''')
+    
+    async def reschedule_mailing(self, mailing_id: int, run_at: int):
+        """Перенос рассылки на run_at; идущая рассылка останавливается до срока (True, если перенесена)"""
+        async with self._transaction() as conn:
+            status = await conn.execute('''
+            UPDATE manual_mailings
+            SET status = 'scheduled'
+            WHERE id = $1 AND status IN ('scheduled', 'running')
+            ''', mailing_id)
+            if not _rowcount(status):
+                return False
+            
+            await conn.execute('UPDATE scheduled_mailings SET run_at = $1 WHERE mailing_id = $2', run_at, mailing_id)
+        
+        return True
+    
+    async def start_scheduled_mailing(self, mailing_id: int, user_ids: Optional[list] = None):
+        """Запуск отложенной рассылки: очередь получателей (при первом запуске) и статус running.
+        
+        Для сегмента получатели передаются в user_ids. Возвращает число получателей
+        в очереди или None, если рассылка уже не ждет запуска.
+        """
+        async with self._transaction() as conn:
+            # Смена статуса - захват: рассылку запускает только одна реплика
+            filter_type = await conn.fetchval('''
+            UPDATE manual_mailings
+            SET status = 'running'
+            WHERE id = $1 AND status = 'scheduled'
+            RETURNING mailing_type
+            ''', mailing_id)
+            if filter_type is None:
+                return None
+            
+            # Рассылка, продолженная в новом окне доставки, уже имеет очередь
+            if await conn.fetchval('SELECT 1 FROM mailing_recipients WHERE mailing_id = $1 LIMIT 1', mailing_id):
+                return await conn.fetchval('''
+                SELECT COUNT(*) FROM mailing_recipients
+                WHERE mailing_id = $1 AND state = 'queued'
+                ''', mailing_id)
+            
+            user_filter = self._recipient_filter(filter_type, user_ids)
+            return await self._enqueue_recipients(conn, mailing_id, user_filter, user_ids) if user_filter else 0
+    
+    async def get_mailing(self, mailing_id: int):
+        """Получение рассылки по ID (с расписанием, если она отложенная)"""
+        return await self._fetchrow('''
+        SELECT mm.*, sm.run_at, sm.working_hours_only
+        FROM manual_mailings mm
+        LEFT JOIN scheduled_mailings sm ON sm.mailing_id = mm.id
+        WHERE mm.id = $1
+        ''', mailing_id)
+    
+    async def get_active_mailing_jobs(self):
+        """Рассылки, которые идут или стоят на паузе"""
+        return await self._fetch('''
+        SELECT id, admin_id, status
+        FROM manual_mailings
+        WHERE status IN ('running', 'paused')
+        ORDER BY id
+        ''')
+    
+    async def set_mailing_status(self, mailing_id: int, status: str, from_statuses: tuple):
+        """Смена статуса рассылки, если текущий статус из from_statuses (True, если сменен)"""
+        return _rowcount(await self._execute('''
+        UPDATE manual_mailings
+        SET status = $1
+        WHERE id = $2 AND status = ANY($3::TEXT[])
+        ''', status, mailing_id, list(from_statuses))) > 0
+    
+    async def get_queued_recipients_page(self, mailing_id: int, after_user_id: int = 0,
+                                         limit: int = RECIPIENT_PAGE_SIZE, shard: int = 0, shards: int = 1):
+        """Страница получателей рассылки в очереди: keyset по user_id (доля воркера shard из shards)"""
+        return await self._fetch('''
+        SELECT user_id
+        FROM mailing_recipients
+        WHERE mailing_id = $1 AND state = 'queued' AND user_id > $2 AND user_id % $3 = $4
+        ORDER BY user_id
+        LIMIT $5
+        ''', mailing_id, after_user_id, shards, shard, limit)
+    
+    async def mark_recipient_sending(self, mailing_id: int, user_id: int):
+        """Захват получателя из очереди перед отправкой (False, если он уже не в очереди)"""
+        return _rowcount(await self._execute('''
+        UPDATE mailing_recipients
+        SET state = 'sending', updated_at = $1
+        WHERE mailing_id = $2 AND user_id = $3 AND state = 'queued'
+        ''', now_ts(), mailing_id, user_id)) > 0
+    
+    async def complete_mailing_recipient(self, mailing_id: int, user_id: int, telegram_message_id: int):
+        """Отметка доставки получателю и сохранение отправленного сообщения (ID sent_messages)"""
+        async with self._transaction() as conn:
+            sent_message_id = await self.save_sent_message(mailing_id, user_id, telegram_message_id)
+            await conn.execute('''
+            UPDATE mailing_recipients
+            SET state = 'sent', telegram_message_id = $1, sent_message_id = $2, updated_at = $3
+            WHERE mailing_id = $4 AND user_id = $5
+            ''', telegram_message_id, sent_message_id, now_ts(), mailing_id, user_id)
+        
+        return sent_message_id
+    
+    async def complete_mailing_recipients(self, mailing_id: int, deliveries: list):
+        """Отметка доставки пачке получателей [(user_id, telegram_message_id)] без строк sent_messages"""
+        await self._execute('''
+        UPDATE mailing_recipients AS mr
+        SET state = 'sent', telegram_message_id = d.message_id, updated_at = $2
+        FROM unnest($3::BIGINT[], $4::BIGINT[]) AS d(user_id, message_id)
+        WHERE mr.mailing_id = $1 AND mr.user_id = d.user_id
+        ''', mailing_id, now_ts(),
+            [user_id for user_id, _ in deliveries], [message_id for _, message_id in deliveries])
+    
+    async def get_or_create_sent_message(self, mailing_id: int, user_id: int, telegram_message_id: int):
+        """ID sent_messages для отклика на рассылку: строка создается при первом отклике.
+        
+        None, если пользователь не получатель рассылки.
+        """
+        async with self._transaction() as conn:
+            # Блокировка строки получателя: повторное нажатие ждет и находит созданную строку
+            recipient = await conn.fetchrow('''
+            SELECT sent_message_id FROM mailing_recipients
+            WHERE mailing_id = $1 AND user_id = $2
+            FOR UPDATE
+            ''', mailing_id, user_id)
+            if recipient is None:
+                return None
+            if recipient['sent_message_id']:
+                return recipient['sent_message_id']
+            
+            sent_message_id = await self.save_sent_message(mailing_id, user_id, telegram_message_id)
+            await conn.execute('''
+            UPDATE mailing_recipients
+            SET sent_message_id = $1
+            WHERE mailing_id = $2 AND user_id = $3
+            ''', sent_message_id, mailing_id, user_id)
+        
+        return sent_message_id
+    
+    async def fail_mailing_recipient(self, mailing_id: int, user_id: int, error: str):
+        """Отметка неудачной отправки получателю"""
+        await self._execute('''
+        UPDATE mailing_recipients
+        SET state = 'failed', error = $1, updated_at = $2
+        WHERE mailing_id = $3 AND user_id = $4
+        ''', error, now_ts(), mailing_id, user_id)
+    
+    async def get_mailing_job_progress(self, mailing_id: int):
+        """Число получателей рассылки по состояниям (queued / sending / sent / failed / total)"""
+        rows = await self._fetch('''
+        SELECT state, COUNT(*) as count
+        FROM mailing_recipients
+        WHERE mailing_id = $1
+        GROUP BY state
+        ''', mailing_id)
+        
+        counts = {row['state']: row['count'] for row in rows}
+        progress = {state: counts.get(state, 0) for state in ('queued', 'sending', 'sent', 'failed')}
+        progress['total'] = sum(progress.values())
+        return progress
+    
+    async def recover_interrupted_recipients(self, mailing_id: int = None):
+        """Получатели, застрявшие в 'sending' после перезапуска (или сбоя рассылки mailing_id), считаются неудачными"""
+        return _rowcount(await self._execute('''
+        UPDATE mailing_recipients
+        SET state = 'failed', error = 'interrupted', updated_at = $1
+        WHERE state = 'sending'
+        AND mailing_id IN (SELECT id FROM manual_mailings WHERE status IN ('running', 'paused'))
+        AND ($2::BIGINT IS NULL OR mailing_id = $2)
+        ''', now_ts(), mailing_id))
+    
+    # ---------- Сообщения менеджеру ----------
+    async def save_manager_message(self, user_id: int, message_type: str, message_text: str,
+                                   file_id: str = None, file_name: str = None):
+        """Сохранение сообщения менеджеру"""
+        return await self._fetchval('''
+        INSERT INTO manager_messages (user_id, message_type, message_text, file_id, file_name)
+        VALUES ($1, $2, $3, $4, $5)
+        RETURNING id
+        ''', user_id, message_type, message_text, file_id, file_name)
+    
+    async def get_manager_message(self, message_id: int):
+        """Получение сообщения менеджеру вместе с данными пользователя"""
+        return await self._fetchrow('''
+        SELECT mm.*, u.username, u.phone, u.first_name, u.last_name
+        FROM manager_messages mm
+        JOIN users u ON mm.user_id = u.user_id
+        WHERE mm.id = $1
+        ''', message_id)
+    
+    async def get_unprocessed_manager_messages(self, limit: int = 10):
+        """Необработанные сообщения менеджеру"""
+        return await self._fetch('''
+        SELECT mm.*, u.username, u.first_name, u.last_name
+        FROM manager_messages mm
+        JOIN users u ON mm.user_id = u.user_id
+        WHERE mm.processed = 0
+        ORDER BY mm.created_at DESC
+        LIMIT $1
+        ''', limit)
+    
+    async def get_unprocessed_manager_messages_page(self, cursor: tuple = None, direction: str = "next",
+                                                    limit: int = ADMIN_PAGE_SIZE):
+        """Страница необработанных сообщений менеджеру"""
+        return await self._keyset_page('''
+            SELECT mm.*, u.username, u.first_name, u.last_name
+            FROM manager_messages mm
+            JOIN users u ON mm.user_id = u.user_id
+            WHERE mm.processed = 0
+            ''', (), ("mm.created_at", "mm.id"), cursor, direction, limit)
+    
+    async def mark_manager_message_processed(self, message_id: int):
+        """Отметка сообщения менеджеру как обработанного"""
+        await self._execute('UPDATE manager_messages SET processed = 1 WHERE id = $1', message_id)
+    
+    # ---------- Очередь задач ----------
+    async def enqueue_job(self, kind: str, payload: dict, run_at: int, max_attempts: int, key: str = None):
+        """Постановка задачи в очередь (ID; None, если задача с тем же key уже есть)"""
+        return await self._fetchval('''
+        INSERT INTO jobs (kind, payload, run_at, max_attempts, job_key)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (job_key) DO NOTHING
+        RETURNING id
+        ''', kind, json.dumps(payload, ensure_ascii=False), run_at, max_attempts, key)
+    
+    async def claim_due_jobs(self, limit: int, lease: int):
+        """Захват наступивших задач на lease сек: список {id, kind, payload, attempts, max_attempts}"""
+        now = now_ts()
+        # SKIP LOCKED: реплики разбирают очередь, не дожидаясь друг друга
+        async with self._transaction() as conn:
+            rows = await conn.fetch('''
+            UPDATE jobs
+            SET status = 'running', attempts = attempts + 1, run_at = $2, updated_at = $3
+            WHERE id IN (
+                SELECT id FROM jobs
+                WHERE status IN ('queued', 'running') AND run_at <= $3
+                ORDER BY run_at, id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, payload, attempts, max_attempts
+            ''', limit, now + lease, now)
+        
+        return [{**dict(row), "payload": json.loads(row['payload'])} for row in rows]
+    
+    async def complete_job(self, job_id: int):
+        """Удаление выполненной задачи"""
+        await self._execute('DELETE FROM jobs WHERE id = $1', job_id)
+    
+    async def retry_job(self, job_id: int, run_at: int, error: str):
+        """Возврат задачи в очередь до run_at после ошибки"""
+        await self._execute('''
+        UPDATE jobs
+        SET status = 'queued', run_at = $2, last_error = $3, updated_at = $4
+        WHERE id = $1
+        ''', job_id, run_at, error, now_ts())
+    
+    async def fail_job(self, job_id: int, error: str):
+        """Отметка задачи как окончательно не выполненной"""
+        await self._execute('''
+        UPDATE jobs
+        SET status = 'failed', last_error = $2, updated_at = $3
+        WHERE id = $1
+        ''', job_id, error, now_ts())
+    
+    async def get_next_job_time(self) -> Optional[int]:
+        """Срок ближайшей задачи (или окончания аренды захваченной), None - очередь пуста"""
+        return await self._fetchval("SELECT MIN(run_at) FROM jobs WHERE status IN ('queued', 'running')")
+    
+    async def get_job_counts(self) -> dict:
+        """Число задач по статусам"""
+        rows = await self._fetch('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status')
+        return {row['status']: row['count'] for row in rows}
+    
+    # ---------- Сводки администратору ----------
+    async def add_admin_event(self, kind: str, mailing_id: int = None, user_id: int = None,
+                              username: str = None, details: str = None):
+        """Событие для сводки администратору"""
+        return await self._fetchval('''
+        INSERT INTO admin_events (kind, mailing_id, user_id, username, details)
+        VALUES ($1, $2, $3, $4, $5)
+        RETURNING id
+        ''', kind, mailing_id, user_id, username, details)
+    
+    async def get_admin_events(self):
+        """Накопленные события для сводки по порядку поступления"""
+        return await self._fetch('''
+        SELECT id, kind, mailing_id, user_id, username, details, created_at
+        FROM admin_events
+        ORDER BY id
+        ''')
+    
+    async def delete_admin_events(self, event_ids: list):
+        """Удаление событий, вошедших в отправленную сводку (ровно переданные ID).
+        
+        Не по диапазону id <= max: BIGSERIAL выдает номера не в порядке COMMIT, и
+        событие другой реплики с меньшим ID могло появиться уже после чтения сводки.
+        """
+        await self._execute('DELETE FROM admin_events WHERE id = ANY($1::BIGINT[])', list(event_ids))
+    
+    # ---------- Статистика ----------
+    async def get_statistics(self, days: int = 14):
+        """Получение статистики за указанный период (диапазонные запросы по *_at)"""
+        start, end = period_bounds(days)
+        
+        stats = await self._fetchrow('''
+        SELECT
+            (SELECT COUNT(*) FROM users
+             WHERE created_at >= $1 AND created_at < $2) as new_users,
+            (SELECT COUNT(*) FROM tender_exports
+             WHERE status = 'completed' AND sent_at >= $1 AND sent_at < $2) as exports_completed,
+            (SELECT COUNT(*) FROM manager_messages
+             WHERE created_at >= $1 AND created_at < $2) as manager_messages,
+            (SELECT COUNT(*) FROM questionnaires
+             WHERE created_at >= $1 AND created_at < $2) as new_questionnaires,
+            (SELECT COUNT(*) FROM users
+             WHERE is_active = 1 AND mailing_subscribed = 1) as subscribed_users,
+            (SELECT COUNT(*) FROM users
+             WHERE is_active = 1 AND mailing_subscribed = 0) as unsubscribed_users,
+            (SELECT COUNT(*) FROM questionnaires WHERE status = 'partial') as partial_questionnaires,
+            (SELECT COUNT(*) FROM questionnaires WHERE status = 'complete') as complete_questionnaires
+        ''', start, end)
+        
+        mailings = await self._fetchrow('''
+        SELECT COUNT(*) as mailings_count,
+               COALESCE(SUM(sent_count), 0) as mailings_sent,
+               COALESCE(SUM(feedback_count), 0) as mailings_feedback
+        FROM manual_mailings
+        WHERE created_at >= $1 AND created_at < $2
+        ''', start, end)
+        
+        return {**dict(stats), **dict(mailings)}
@@ -0,0 +1,274 @@
+"""
+Сегменты аудитории рассылок: битовые карты пользователей по признакам и
+булевы выражения над ними («анкета И месяц И НЕ отписан И регион=Владимир»)
+"""
+
+import asyncio
+import re
+from bisect import bisect_left, insort
+from datetime import datetime
+from typing import List
+
+from storage import now_ts, period_bounds
+
+# Признаки для выражений сегментов (для подсказки администратору)
+SEGMENT_HELP = (
+    "<code>все</code> - все активные пользователи\n"
+    "<code>подписан</code> / <code>отписан</code> - подписка на рассылки\n"
+    "<code>анкета</code> - заполнил анкету\n"
+    "<code>неделя</code> / <code>месяц</code> - зарегистрировался за 7 дней / в этом месяце\n"
+    "<code>с=ДД.ММ.ГГГГ</code>, <code>до=ДД.ММ.ГГГГ</code> - дата регистрации\n"
+    "<code>регион=Владимир</code>, <code>сфера=\"Строительство дорог\"</code> - значения из анкеты\n\n"
+    "Операторы: <code>И</code>, <code>ИЛИ</code>, <code>НЕ</code> (или AND, OR, NOT) и скобки"
+)
+
+# Признаки без значения
+ATOMS = {"все", "подписан", "отписан", "анкета", "неделя", "месяц"}
+
+OPERATORS = {"и": "and", "and": "and", "или": "or", "or": "or", "не": "not", "not": "not"}
+
+# Признаки со значением: имя в выражении -> колонка users
+VALUE_ATTRIBUTES = {"регион": "region", "сфера": "activity"}
+
+TOKEN_RE = re.compile(r'\s*(\(|\)|=|"[^"]*"|[^\s()="]+)')
+
+
+class SegmentError(ValueError):
+    """Ошибка в выражении сегмента (текст - для администратора)"""
+
+
+def normalize_value(value) -> str:
+    """Значение признака без учета регистра и пробелов по краям"""
+    return (value or "").strip().lower()
+
+
+def tokenize(expression: str) -> list:
+    """Разбор выражения на лексемы"""
+    tokens, position = [], 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_RE.match(expression, position)
+        if not match:
+            raise SegmentError(f"Не удалось разобрать выражение с позиции {position + 1}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+def parse_segment(expression: str):
+    """Дерево выражения сегмента: ("and"|"or", левое, правое), ("not", x) или ("atom", имя, значение)"""
+    tokens = tokenize(expression)
+    if not tokens:
+        raise SegmentError("Пустое выражение сегмента")
+    position = 0
+    
+    def peek():
+        return tokens[position] if position < len(tokens) else None
+    
+    def take():
+        nonlocal position
+        position += 1
+        return tokens[position - 1]
+    
+    def parse_or():
+        node = parse_and()
+        while OPERATORS.get((peek() or "").lower()) == "or":
+            take()
+            node = ("or", node, parse_and())
+        return node
+    
+    def parse_and():
+        node = parse_not()
+        while OPERATORS.get((peek() or "").lower()) == "and":
+            take()
+            node = ("and", node, parse_not())
+        return node
+    
+    def parse_not():
+        token = peek()
+        if token is None:
+            raise SegmentError("Выражение оборвано: ожидался признак")
+        if OPERATORS.get(token.lower()) == "not":
+            take()
+            return ("not", parse_not())
+        if token == "(":
+            take()
+            node = parse_or()
+            if take_if(")") is None:
+                raise SegmentError("Не хватает закрывающей скобки")
+            return node
+        return parse_atom()
+    
+    def take_if(expected):
+        return take() if peek() == expected else None
+    
+    def parse_atom():
+        name = take()
+        if name in ("(", ")", "=") or name.lower() in OPERATORS:
+            raise SegmentError(f"Ожидался признак, а не «{name}»")
+        name = name.lower()
+        
+        if take_if("=") is None:
+            if name not in ATOMS:
+                raise SegmentError(f"Неизвестный признак «{name}»")
+            return ("atom", name, None)
+        
+        value = peek()
+        if value is None or value in ("(", ")", "="):
+            raise SegmentError(f"Не указано значение для «{name}»")
+        value = take().strip('"')
+        if name in ("с", "до"):
+            try:
+                value = int(datetime.strptime(value, "%d.%m.%Y").timestamp())
+            except ValueError:
+                raise SegmentError(f"Дата для «{name}» нужна в формате ДД.ММ.ГГГГ")
+        elif name not in VALUE_ATTRIBUTES:
+            raise SegmentError(f"Признак «{name}» не принимает значение")
+        return ("atom", name, value)
+    
+    tree = parse_or()
+    if position < len(tokens):
+        raise SegmentError(f"Лишняя часть выражения: «{' '.join(tokens[position:])}»")
+    return tree
+
+
+def _set_bit(bitmap: bytearray, position: int, on: bool):
+    """Установка или сброс бита position (карта растет по мере надобности)"""
+    index = position >> 3
+    if index >= len(bitmap):
+        if not on:
+            return
+        bitmap.extend(bytes(index - len(bitmap) + 1))
+    if on:
+        bitmap[index] |= 1 << (position & 7)
+    else:
+        bitmap[index] &= ~(1 << (position & 7)) & 0xFF
+
+
+def _as_int(bitmap: bytearray) -> int:
+    """Битовая карта как целое для операций &, |, ~"""
+    return int.from_bytes(bitmap, "little")
+
+
+class SegmentIndex:
+    """Битовые карты пользователей по признакам.
+    
+    Номер бита - users.id (компактный автоинкремент), поэтому на 100 тыс.
+    пользователей одна карта занимает ~12 КБ, а пересечение, объединение и
+    дополнение сегментов - операции над целыми Python, выполняемые в C.
+    Перед каждым запросом индекс догружает из хранилища только новые и
+    измененные с прошлой синхронизации строки (users.updated_at).
+    """
+    
+    # Перечитываются строки, измененные за N секунд до прошлой синхронизации:
+    # транзакция могла получить метку времени раньше, чем закоммитилась
+    SYNC_SLACK = 60
+    
+    def __init__(self, storage):
+        self.storage = storage
+        self.flags = {"active": bytearray(), "subscribed": bytearray(), "questionnaire": bytearray()}
+        self.values = {column: {} for column in VALUE_ATTRIBUTES.values()}
+        self.user_ids = {}
+        self.max_id = 0
+        self.synced_at = 0
+        self._row_values = {}
+        self._created = []
+        self._lock = asyncio.Lock()
+    
+    def __len__(self):
+        return len(self.user_ids)
+    
+    async def sync(self):
+        """Догрузка новых и измененных пользователей"""
+        async with self._lock:
+            started = now_ts()
+            since = self.synced_at - self.SYNC_SLACK if self.synced_at else 0
+            for row in await self.storage.get_user_segment_rows(self.max_id, since):
+                self._apply(row)
+            self.synced_at = started
+    
+    def _apply(self, row):
+        """Обновление карт по строке пользователя"""
+        row_id = row['id']
+        if row_id not in self.user_ids:
+            self.user_ids[row_id] = row['user_id']
+            insort(self._created, (row['created_at'] or 0, row_id))
+            self.max_id = max(self.max_id, row_id)
+        
+        _set_bit(self.flags["active"], row_id, bool(row['is_active']))
+        _set_bit(self.flags["subscribed"], row_id, bool(row['mailing_subscribed']))
+        _set_bit(self.flags["questionnaire"], row_id, bool(row['has_filled_questionnaire']))
+        
+        previous = self._row_values.get(row_id, {})
+        current = {column: normalize_value(row[column]) for column in self.values}
+        for column, value in current.items():
+            if previous.get(column) == value:
+                continue
+            if previous.get(column):
+                _set_bit(self.values[column][previous[column]], row_id, False)
+            if value:
+                _set_bit(self.values[column].setdefault(value, bytearray()), row_id, True)
+        self._row_values[row_id] = current
+    
+    def _registered(self, start: int = None, end: int = None) -> int:
+        """Карта пользователей, зарегистрированных в [start, end)"""
+        low = bisect_left(self._created, (start, 0)) if start is not None else 0
+        high = bisect_left(self._created, (end, 0)) if end is not None else len(self._created)
+        bitmap = bytearray((self.max_id >> 3) + 1)
+        for _, row_id in self._created[low:high]:
+            bitmap[row_id >> 3] |= 1 << (row_id & 7)
+        return _as_int(bitmap)
+    
+    def _atom(self, name: str, value) -> int:
+        """Карта одного признака"""
+        if name == "все":
+            return _as_int(self.flags["active"])
+        if name == "подписан":
+            return _as_int(self.flags["subscribed"])
+        if name == "отписан":
+            return _as_int(self.flags["active"]) & ~_as_int(self.flags["subscribed"])
+        if name == "анкета":
+            return _as_int(self.flags["questionnaire"])
+        if name == "неделя":
+            return self._registered(*period_bounds(7))
+        if name == "месяц":
+            month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+            return self._registered(int(month_start.timestamp()))
+        if name == "с":
+            return self._registered(value)
+        if name == "до":
+            return self._registered(end=value)
+        return _as_int(self.values[VALUE_ATTRIBUTES[name]].get(normalize_value(value), bytearray()))
+    
+    def _evaluate(self, node) -> int:
+        """Вычисление дерева выражения"""
+        kind = node[0]
+        if kind == "atom":
+            return self._atom(node[1], node[2])
+        if kind == "not":
+            return ~self._evaluate(node[1])
+        left, right = self._evaluate(node[1]), self._evaluate(node[2])
+        return left & right if kind == "and" else left | right
+    
+    async def audience(self, expression: str) -> int:
+        """Карта получателей сегмента: только активные и подписанные на рассылки"""
+        tree = parse_segment(expression)
+        await self.sync()
+        # Дополнение (НЕ) бесконечно в старших битах: пересечение с активными его ограничивает
+        return self._evaluate(tree) & _as_int(self.flags["active"]) & _as_int(self.flags["subscribed"])
+    
+    async def count(self, expression: str) -> int:
+        """Размер сегмента"""
+        return (await self.audience(expression)).bit_count()
+    
+    async def select(self, expression: str) -> List[int]:
+        """Telegram ID получателей сегмента по возрастанию users.id"""
+        bitmap = await self.audience(expression)
+        data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+        user_ids = []
+        for index, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                user_ids.append(self.user_ids[(index << 3) + low.bit_length() - 1])
+                byte ^= low
+        return user_ids
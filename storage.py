@@ -0,0 +1,449 @@
+"""
+Интерфейс хранилища бота и общие для всех бэкендов соглашения
+(метки времени в секундах эпохи UTC, фильтры аудитории рассылок)
+"""
+
+import os
+import time
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timedelta
+from typing import Optional, Tuple
+
+# Размер страницы при потоковом обходе аудитории рассылки
+RECIPIENT_PAGE_SIZE = int(os.getenv("RECIPIENT_PAGE_SIZE", 1000))
+
+# Размер страницы списков в админ-панели
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", 10))
+
+
+def now_ts() -> int:
+    """Текущее время в секундах эпохи UTC"""
+    return int(time.time())
+
+
+def period_bounds(days: int) -> Tuple[int, int]:
+    """Полуинтервал [начало дня N дней назад, начало завтрашнего дня) в секундах эпохи"""
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = today - timedelta(days=days)
+    end = today + timedelta(days=1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def local_day(ts: int) -> int:
+    """Номер местных суток от 01.01.1970 для метки времени (сутки те же, что у period_bounds)"""
+    return (datetime.fromtimestamp(ts).date() - date(1970, 1, 1)).days
+
+
+# Фильтры аудитории: тип -> (условие WHERE с параметрами "?", функция параметров или None)
+USER_FILTERS = {
+    "all": ("is_active = 1 AND mailing_subscribed = 1", None),
+    "with_questionnaire": ("is_active = 1 AND has_filled_questionnaire = 1 AND mailing_subscribed = 1", None),
+    "without_questionnaire": ("is_active = 1 AND has_filled_questionnaire = 0 AND mailing_subscribed = 1", None),
+    "recent_week": ("is_active = 1 AND mailing_subscribed = 1 AND created_at >= ? AND created_at < ?",
+                    lambda: period_bounds(7)),
+    "subscribed": ("is_active = 1 AND mailing_subscribed = 1", None),
+    "unsubscribed": ("is_active = 1 AND mailing_subscribed = 0", None),
+}
+
+USER_FILTER_COLUMNS = "user_id, username, first_name, last_name, company, mailing_subscribed"
+
+# Рассылка по сегменту аудитории (segments.py): тип "segment:<выражение>",
+# получатели передаются списком и сверяются с фильтром "all" при постановке в очередь
+SEGMENT_FILTER_PREFIX = "segment:"
+
+# Колонки users, по которым строятся сегменты; их изменение обновляет users.updated_at
+SEGMENT_COLUMNS = "is_active, mailing_subscribed, has_filled_questionnaire, region, activity"
+
+
+class StorageBackend(ABC):
+    """Асинхронный интерфейс хранилища, которым пользуются обработчики бота.
+    
+    Строки результатов поддерживают доступ по имени колонки (row['user_id']).
+    Методы записи, возвращающие ID, отдают ID созданной строки.
+    """
+    
+    name = "base"
+    
+    # Буфер отложенной записи (WriteBehindQueue), подключается при создании хранилища
+    writes = None
+    
+    async def open(self):
+        """Подготовка хранилища (пул соединений, схема)"""
+    
+    @abstractmethod
+    async def close(self):
+        """Закрытие соединений"""
+    
+    def status(self) -> dict:
+        """Сведения о хранилище для /status"""
+        return {"backend": self.name}
+    
+    @abstractmethod
+    async def apply_writes(self, batch: list) -> list:
+        """Выполнение пачки отложенных записей одной транзакцией.
+        
+        batch - список (имя метода, args, kwargs, future); результат - список
+        (успех, значение или исключение) в том же порядке. Ошибка одной записи
+        не должна откатывать остальные.
+        """
+    
+    async def iter_users_by_filter(self, filter_type: str, page_size: int = RECIPIENT_PAGE_SIZE):
+        """Асинхронный потоковый обход пользователей по фильтру (страница за запрос)"""
+        after_user_id = 0
+        while True:
+            page = await self.get_users_page(filter_type, after_user_id, page_size)
+            for user in page:
+                yield user
+            if len(page) < page_size:
+                return
+            after_user_id = page[-1]['user_id']
+    
+    # ---------- Пользователи ----------
+    @abstractmethod
+    async def add_user(self, user_id: int, username: str, first_name: str, last_name: str = ""):
+        """Добавление пользователя"""
+    
+    @abstractmethod
+    async def update_user_phone(self, user_id: int, phone: str):
+        """Сохранение телефона пользователя"""
+    
+    @abstractmethod
+    async def get_user_by_id(self, user_id: int):
+        """Получение пользователя по ID"""
+    
+    @abstractmethod
+    async def toggle_user_mailing_subscription(self, user_id: int):
+        """Включение/выключение подписки на рассылку (новое состояние или None)"""
+    
+    @abstractmethod
+    async def get_user_mailing_status(self, user_id: int):
+        """Получение статуса подписки на рассылку (dict или None)"""
+    
+    @abstractmethod
+    async def deactivate_users(self, user_ids: list):
+        """Деактивация пользователей, которым нельзя доставить сообщение (пачкой UPDATE)"""
+    
+    @abstractmethod
+    async def get_users_by_filter(self, filter_type: str):
+        """Получение пользователей по фильтру с учетом подписки"""
+    
+    @abstractmethod
+    async def count_users_by_filter(self, filter_type: str):
+        """Количество пользователей по фильтру (для предпросмотра рассылки)"""
+    
+    @abstractmethod
+    async def get_users_page(self, filter_type: str, after_user_id: int = 0, limit: int = RECIPIENT_PAGE_SIZE):
+        """Страница пользователей по фильтру: keyset по user_id"""
+    
+    @abstractmethod
+    async def get_user_segment_rows(self, after_id: int = 0, updated_since: int = 0):
+        """Строки пользователей для сегментов: новые (id > after_id) и измененные начиная с updated_since"""
+    
+    @abstractmethod
+    async def get_subscription_users_page(self, filter_type: str = "all", cursor: tuple = None,
+                                          direction: str = "next", limit: int = ADMIN_PAGE_SIZE):
+        """Страница пользователей для управления подписками: (строки, есть_предыдущая, есть_следующая)"""
+    
+    @abstractmethod
+    async def get_all_users_with_subscription(self, limit: int = 50):
+        """Получение всех пользователей с информацией о подписке"""
+    
+    @abstractmethod
+    async def get_user_activity_summary(self, user_id: int):
+        """Пользователь со сводкой активности (анкеты, выгрузки, сообщения, отзывы)"""
+    
+    @abstractmethod
+    async def get_subscription_stats(self):
+        """Статистика подписок активных пользователей"""
+    
+    # ---------- Анкеты ----------
+    @abstractmethod
+    async def save_questionnaire_partial(self, user_id: int, data: dict):
+        """Сохранение частичной анкеты (только вопросы 1-4)"""
+    
+    @abstractmethod
+    async def save_questionnaire(self, user_id: int, data: dict, anketa_path: str = None):
+        """Сохранение полной анкеты (все 8 вопросов)"""
+    
+    @abstractmethod
+    async def update_partial_to_complete(self, user_id: int, data: dict):
+        """Обновление частичной анкеты до полной (добавление контактов)"""
+    
+    @abstractmethod
+    async def get_partial_questionnaires(self):
+        """Получение частичных анкет (только 1-4 вопросы)"""
+    
+    @abstractmethod
+    async def get_partial_questionnaires_page(self, cursor: tuple = None, direction: str = "next",
+                                              limit: int = ADMIN_PAGE_SIZE):
+        """Страница частичных анкет"""
+    
+    @abstractmethod
+    async def get_complete_questionnaires(self):
+        """Получение полных анкет"""
+    
+    @abstractmethod
+    async def has_complete_questionnaire(self, user_id: int):
+        """Проверка, есть ли у пользователя полная анкета с контактами"""
+    
+    @abstractmethod
+    async def get_last_complete_questionnaire(self, user_id: int):
+        """Получение последней полной анкеты пользователя"""
+    
+    # ---------- Выгрузки ----------
+    @abstractmethod
+    async def create_tender_export(self, user_id: int, file_path: str = None, file_name: str = None):
+        """Создание записи о выгрузке тендеров"""
+    
+    @abstractmethod
+    async def create_tender_export_without_file(self, user_id: int):
+        """Создание записи о выгрузке без файла"""
+    
+    @abstractmethod
+    async def mark_export_completed(self, export_id: int, admin_name: str = "Олег"):
+        """Отметка выполнения выгрузки администратором (sent_at выгрузки - отсчет follow-up)"""
+    
+    @abstractmethod
+    async def cancel_export(self, export_id: int):
+        """Отмена выгрузки"""
+    
+    @abstractmethod
+    async def save_export_file(self, export_id: int, file_path: str, file_name: str):
+        """Сохранение пути к файлу выгрузки"""
+    
+    @abstractmethod
+    async def get_pending_exports(self):
+        """Получение ожидающих выгрузок"""
+    
+    @abstractmethod
+    async def get_export_by_id(self, export_id: int):
+        """Получение выгрузки по ID"""
+    
+    @abstractmethod
+    async def get_user_exports(self, user_id: int):
+        """Получение всех выгрузок пользователя"""
+    
+    @abstractmethod
+    async def get_exports_for_followup(self, delay: int = 3600, limit: int = None, after_id: int = 0):
+        """Выгрузки, для которых нужно отправить follow-up (через delay сек после выгрузки):
+        пачка из limit штук по возрастанию ID после after_id"""
+    
+    @abstractmethod
+    async def get_pending_followups(self):
+        """Выгрузки, ожидающие follow-up: (id, sent_at) - для таймеров при запуске"""
+    
+    @abstractmethod
+    async def get_export_for_followup(self, export_id: int):
+        """Выгрузка с данными пользователя, если follow-up по ней еще не отправлен"""
+    
+    @abstractmethod
+    async def mark_followups_sent(self, export_ids: list):
+        """Отметка, что follow-up по выгрузкам отправлен (одна транзакция на пачку)"""
+    
+    @abstractmethod
+    async def save_followup_response(self, export_id: int, response: str):
+        """Сохранение ответа на follow-up"""
+    
+    @abstractmethod
+    async def create_contact_request(self, user_id: int, export_id: int):
+        """Создание запроса контактов для выгрузки"""
+    
+    @abstractmethod
+    async def mark_contact_request_completed(self, export_id: int):
+        """Отметка запроса контактов как выполненного"""
+    
+    # ---------- Рассылки и обратная связь ----------
+    @abstractmethod
+    async def create_manual_mailing(self, admin_id: int, mailing_text: str, mailing_type: str, filter_criteria: str):
+        """Создание ручной рассылки"""
+    
+    @abstractmethod
+    async def save_sent_message(self, mailing_id: int, user_id: int, telegram_message_id: int):
+        """Сохранение отправленного сообщения"""
+    
+    @abstractmethod
+    async def get_sent_message(self, sent_message_id: int, user_id: int):
+        """Получение отправленного сообщения рассылки пользователя"""
+    
+    @abstractmethod
+    async def get_sent_message_by_telegram_id(self, user_id: int, telegram_message_id: int):
+        """Получение отправленного сообщения по ID Telegram"""
+    
+    @abstractmethod
+    async def update_mailing_stats(self, mailing_id: int, sent_count: int, failed_count: int):
+        """Обновление статистики рассылки"""
+    
+    @abstractmethod
+    async def save_mailing_feedback(self, mailing_id: int, user_id: int, sent_message_id: int,
+                                    feedback_type: str, feedback_text: str = ""):
+        """Сохранение обратной связи по рассылке"""
+    
+    @abstractmethod
+    async def get_mailing_feedback(self, mailing_id: int):
+        """Получение обратной связи по рассылке"""
+    
+    @abstractmethod
+    async def get_mailing_feedback_for_user(self, user_id: int):
+        """Получение обратной связи по пользователю"""
+    
+    @abstractmethod
+    async def get_mailings_with_feedback(self, limit: int = 10):
+        """Последние отправленные рассылки с числом отозвавшихся пользователей"""
+    
+    @abstractmethod
+    async def get_mailings_with_feedback_page(self, cursor: tuple = None, direction: str = "next",
+                                              limit: int = ADMIN_PAGE_SIZE):
+        """Страница отправленных рассылок с числом отозвавшихся пользователей"""
+    
+    @abstractmethod
+    async def get_feedback_stats(self):
+        """Сводная статистика обратной связи по рассылкам"""
+    
+    # ---------- Задания рассылок ----------
+    @abstractmethod
+    async def create_mailing_job(self, admin_id: int, mailing_text: str, filter_type: str,
+                                 media: Optional[list] = None, user_ids: Optional[list] = None):
+        """Создание рассылки с очередью получателей по фильтру: (ID рассылки, число получателей).
+        
+        Для сегмента (SEGMENT_FILTER_PREFIX) получатели передаются в user_ids.
+        """
+    
+    @abstractmethod
+    async def schedule_mailing(self, admin_id: int, mailing_text: str, filter_type: str, media: Optional[list],
+                               run_at: int, working_hours_only: bool = False):
+        """Отложенная рассылка: получатели выбираются по фильтру в момент отправки (ID рассылки)"""
+    
+    @abstractmethod
+    async def get_scheduled_mailings(self):
+        """Рассылки, ожидающие срока отправки"""
+    
+    @abstractmethod
+    async def reschedule_mailing(self, mailing_id: int, run_at: int):
+        """Перенос рассылки на run_at; идущая рассылка останавливается до срока (True, если перенесена)"""
+    
+    @abstractmethod
+    async def start_scheduled_mailing(self, mailing_id: int, user_ids: Optional[list] = None):
+        """Запуск отложенной рассылки: очередь получателей (при первом запуске) и статус running.
+        
+        Для сегмента получатели передаются в user_ids. Возвращает число получателей
+        в очереди или None, если рассылка уже не ждет запуска.
+        """
+    
+    @abstractmethod
+    async def get_mailing(self, mailing_id: int):
+        """Получение рассылки по ID (с расписанием, если она отложенная)"""
+    
+    @abstractmethod
+    async def get_active_mailing_jobs(self):
+        """Рассылки, которые идут или стоят на паузе"""
+    
+    @abstractmethod
+    async def set_mailing_status(self, mailing_id: int, status: str, from_statuses: tuple):
+        """Смена статуса рассылки, если текущий статус из from_statuses (True, если сменен)"""
+    
+    @abstractmethod
+    async def get_queued_recipients_page(self, mailing_id: int, after_user_id: int = 0,
+                                         limit: int = RECIPIENT_PAGE_SIZE, shard: int = 0, shards: int = 1):
+        """Страница получателей рассылки в очереди: keyset по user_id (доля воркера shard из shards)"""
+    
+    @abstractmethod
+    async def mark_recipient_sending(self, mailing_id: int, user_id: int):
+        """Захват получателя из очереди перед отправкой (False, если он уже не в очереди)"""
+    
+    @abstractmethod
+    async def complete_mailing_recipient(self, mailing_id: int, user_id: int, telegram_message_id: int):
+        """Отметка доставки получателю и сохранение отправленного сообщения (ID sent_messages)"""
+    
+    @abstractmethod
+    async def complete_mailing_recipients(self, mailing_id: int, deliveries: list):
+        """Отметка доставки пачке получателей [(user_id, telegram_message_id)] без строк sent_messages"""
+    
+    @abstractmethod
+    async def get_or_create_sent_message(self, mailing_id: int, user_id: int, telegram_message_id: int):
+        """ID sent_messages для отклика на рассылку: строка создается при первом отклике.
+        
+        None, если пользователь не получатель рассылки.
+        """
+    
+    @abstractmethod
+    async def fail_mailing_recipient(self, mailing_id: int, user_id: int, error: str):
+        """Отметка неудачной отправки получателю"""
+    
+    @abstractmethod
+    async def get_mailing_job_progress(self, mailing_id: int):
+        """Число получателей рассылки по состояниям (queued / sending / sent / failed / total)"""
+    
+    @abstractmethod
+    async def recover_interrupted_recipients(self, mailing_id: int = None):
+        """Получатели, застрявшие в 'sending' после перезапуска (или сбоя рассылки mailing_id), считаются неудачными"""
+    
+    # ---------- Сообщения менеджеру ----------
+    @abstractmethod
+    async def save_manager_message(self, user_id: int, message_type: str, message_text: str,
+                                   file_id: str = None, file_name: str = None):
+        """Сохранение сообщения менеджеру"""
+    
+    @abstractmethod
+    async def get_manager_message(self, message_id: int):
+        """Получение сообщения менеджеру вместе с данными пользователя"""
+    
+    @abstractmethod
+    async def get_unprocessed_manager_messages(self, limit: int = 10):
+        """Необработанные сообщения менеджеру"""
+    
+    @abstractmethod
+    async def get_unprocessed_manager_messages_page(self, cursor: tuple = None, direction: str = "next",
+                                                    limit: int = ADMIN_PAGE_SIZE):
+        """Страница необработанных сообщений менеджеру"""
+    
+    @abstractmethod
+    async def mark_manager_message_processed(self, message_id: int):
+        """Отметка сообщения менеджеру как обработанного"""
+    
+    # ---------- Очередь задач ----------
+    @abstractmethod
+    async def enqueue_job(self, kind: str, payload: dict, run_at: int, max_attempts: int, key: str = None):
+        """Постановка задачи в очередь (ID; None, если задача с тем же key уже есть)"""
+    
+    @abstractmethod
+    async def claim_due_jobs(self, limit: int, lease: int):
+        """Захват наступивших задач на lease сек: список {id, kind, payload, attempts, max_attempts}"""
+    
+    @abstractmethod
+    async def complete_job(self, job_id: int):
+        """Удаление выполненной задачи"""
+    
+    @abstractmethod
+    async def retry_job(self, job_id: int, run_at: int, error: str):
+        """Возврат задачи в очередь до run_at после ошибки"""
+    
+    @abstractmethod
+    async def fail_job(self, job_id: int, error: str):
+        """Отметка задачи как окончательно не выполненной"""
+    
+    @abstractmethod
+    async def get_next_job_time(self) -> Optional[int]:
+        """Срок ближайшей задачи (или окончания аренды захваченной), None - очередь пуста"""
+    
+    @abstractmethod
+    async def get_job_counts(self) -> dict:
+        """Число задач по статусам"""
+    
+    # ---------- Сводки администратору ----------
+    @abstractmethod
+    async def add_admin_event(self, kind: str, mailing_id: int = None, user_id: int = None,
+                              username: str = None, details: str = None):
+        """Событие для сводки администратору"""
+    
+    @abstractmethod
+    async def get_admin_events(self):
+        """Накопленные события для сводки по порядку поступления"""
+    
+    @abstractmethod
+    async def delete_admin_events(self, event_ids: list):
+        """Удаление событий, вошедших в отправленную сводку (ровно переданные ID)"""
+    
+    # ---------- Статистика ----------
+    @abstractmethod
+    async def get_statistics(self, days: int = 14):
+        """Получение статистики за указанный период"""
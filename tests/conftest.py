@@ -0,0 +1,56 @@
+"""
+Общие настройки тестов: модули бота импортируются из корня репозитория,
+а база данных, создаваемая при импорте main, - во временной папке
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Настройки бота читаются при импорте main: окружение задается до него
+WORKDIR = tempfile.mkdtemp(prefix="rassilka_tests_")
+os.environ.update({
+    "BOT_TOKEN": "123456:TEST",
+    "DB_BACKEND": "sqlite",
+    "DB_PATH": os.path.join(WORKDIR, "tenders.db"),
+})
+
+
+def run(coro):
+    """Выполнение корутины в новом цикле событий (тесты без pytest-asyncio)"""
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def database(tmp_path):
+    """Database (SQLite) во временном файле со всеми миграциями"""
+    import main
+    
+    database = main.Database(str(tmp_path / "test.db"))
+    yield database
+    database.close()
+
+
+@pytest.fixture
+def timezone():
+    """Установка часового пояса процесса (TZ) на время теста"""
+    previous = os.environ.get("TZ")
+    
+    def set_timezone(name: str):
+        os.environ["TZ"] = name
+        time.tzset()
+    
+    yield set_timezone
+    
+    if previous is None:
+        os.environ.pop("TZ", None)
+    else:
+        os.environ["TZ"] = previous
+    time.tzset()
@@ -0,0 +1,48 @@
+"""Разбиение сводки событий администратору на сообщения"""
+
+import main
+
+
+def make_events(count: int, details: str):
+    return [{
+        "id": event_id,
+        "kind": "partial_questionnaire",
+        "mailing_id": None,
+        "user_id": event_id,
+        "username": f"user{event_id}",
+        "details": details,
+        "created_at": 1_700_000_000 + event_id
+    } for event_id in range(1, count + 1)]
+
+
+def test_parts_fit_limit_and_cover_events_in_order(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_DIGEST_DETAILS", 1000)
+    events = make_events(40, "Д" * 200)
+    
+    parts = main.split_admin_digest(events, limit=1500)
+    
+    assert len(parts) > 1
+    assert all(len(text) <= 1500 for _, text in parts)
+    # Части идут подряд без пропусков и повторов: каждое событие попадает ровно в одно сообщение
+    assert [event['id'] for part, _ in parts for event in part] == list(range(1, 41))
+    # Каждая часть максимальна: следующее событие в нее уже не влезает
+    for (part, _), (following, _) in zip(parts, parts[1:]):
+        assert len(main.build_admin_digest(part + following[:1])) > 1500
+
+
+def test_delete_removes_only_sent_events(database):
+    ids = [database.add_admin_event("like", mailing_id=1, user_id=user_id) for user_id in range(4)]
+    
+    # Событие ids[1] прочитано не было (запись другой реплики закоммичена позже)
+    database.delete_admin_events([ids[0], ids[2]])
+    
+    assert [event['id'] for event in database.get_admin_events()] == [ids[1], ids[3]]
+
+
+def test_small_digest_is_one_message():
+    events = make_events(3, "Стройка, Владимир")
+    
+    parts = main.split_admin_digest(events)
+    
+    assert len(parts) == 1
+    assert parts[0] == (events, main.build_admin_digest(events))
@@ -0,0 +1,179 @@
+"""Лимиты рассылки: token bucket с AIMD, интервал в один чат и пул отправителей"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import broadcast
+from broadcast import BroadcastEngine, ChatRateLimiter, TokenBucket, is_unreachable
+from conftest import run
+
+METHOD = SendMessage(chat_id=1, text="test")
+
+
+class FakeClock:
+    """Поддельное время: sleep мгновенно сдвигает monotonic"""
+    
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+    
+    def monotonic(self) -> float:
+        return self.now
+    
+    async def sleep(self, delay: float):
+        self.sleeps.append(delay)
+        # Наносекунда сверху: настоящие часы идут и во время пробуждения, а без
+        # нее ожидание доли токена может не сдвинуть время из-за округления
+        self.now += max(0.0, delay) + 1e-9
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Модуль broadcast на поддельных часах (цикл событий остается настоящим)"""
+    fake = FakeClock()
+    monkeypatch.setattr(broadcast, "time", SimpleNamespace(monotonic=fake.monotonic))
+    monkeypatch.setattr(broadcast, "asyncio", SimpleNamespace(
+        Lock=asyncio.Lock, Queue=asyncio.Queue, create_task=asyncio.create_task,
+        gather=asyncio.gather, sleep=fake.sleep
+    ))
+    return fake
+
+
+def retry_after(seconds: int) -> TelegramRetryAfter:
+    return TelegramRetryAfter(method=METHOD, message="Too Many Requests", retry_after=seconds)
+
+
+def test_bucket_burst_then_rate(clock):
+    bucket = TokenBucket(rate=10, burst=5)
+    
+    async def scenario():
+        for _ in range(5):
+            await bucket.acquire()
+        assert clock.now == 1000.0
+        for _ in range(20):
+            await bucket.acquire()
+    
+    run(scenario())
+    # После запаса из 5 токенов - 20 вызовов по 10 в секунду
+    assert clock.now - 1000.0 == pytest.approx(2.0)
+
+
+def test_bucket_refill_capped_by_burst(clock):
+    bucket = TokenBucket(rate=10, burst=3)
+    clock.now += 60
+    
+    async def scenario():
+        for _ in range(4):
+            await bucket.acquire()
+    
+    run(scenario())
+    assert clock.now - 1060.0 == pytest.approx(0.1)
+
+
+def test_slow_down_pauses_and_halves_once_per_pause(clock):
+    bucket = TokenBucket(rate=20, burst=5)
+    bucket.slow_down(3)
+    # Параллельные RetryAfter той же паузы не снижают скорость повторно
+    bucket.slow_down(3)
+    assert bucket.rate == 10
+    
+    run(bucket.acquire())
+    # Пауза 3 с и ожидание первого токена при новой скорости
+    assert clock.now - 1000.0 == pytest.approx(3.1)
+    
+    bucket.slow_down(1)
+    assert bucket.rate == 5
+
+
+def test_rate_floor_and_recovery(clock):
+    bucket = TokenBucket(rate=4, burst=1, min_rate=1.0, increase=0.5)
+    for _ in range(5):
+        clock.now = bucket.blocked_until
+        bucket.slow_down(1)
+    assert bucket.rate == 1.0
+    
+    for _ in range(5):
+        bucket.speed_up()
+    assert bucket.rate == pytest.approx(3.5)
+    for _ in range(5):
+        bucket.speed_up()
+    assert bucket.rate == 4
+
+
+def test_chat_interval(clock):
+    limiter = ChatRateLimiter(interval=1.0)
+    
+    async def scenario():
+        await limiter.wait(1)
+        limiter.mark(1)
+        await limiter.wait(2)
+        limiter.mark(2)
+        assert clock.now == 1000.0
+        await limiter.wait(1)
+    
+    run(scenario())
+    assert clock.now - 1000.0 == pytest.approx(1.0)
+
+
+def test_call_retries_after_flood_control(clock):
+    engine = BroadcastEngine(TokenBucket(rate=100, burst=10), ChatRateLimiter(0), concurrency=1, retries=2)
+    responses = [retry_after(2), retry_after(2), "ok"]
+    
+    async def request():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+    
+    assert run(engine.call(1, request)) == "ok"
+    # Две паузы: 100 -> 50 -> 25, затем успешный вызов прибавляет increase
+    assert engine.bucket.rate == pytest.approx(25.05)
+    assert clock.now - 1000.0 >= 4
+
+
+def test_call_gives_up_after_retries(clock):
+    engine = BroadcastEngine(TokenBucket(rate=100, burst=10), ChatRateLimiter(0), concurrency=1, retries=1)
+    
+    async def request():
+        raise retry_after(1)
+    
+    with pytest.raises(TelegramRetryAfter):
+        run(engine.call(1, request))
+
+
+def test_run_counts_results_with_bounded_concurrency(clock):
+    engine = BroadcastEngine(TokenBucket(rate=1000, burst=10), ChatRateLimiter(0), concurrency=3)
+    inflight = {"now": 0, "max": 0}
+    
+    async def recipients():
+        for user_id in range(20):
+            yield user_id
+    
+    async def send(user_id):
+        inflight["now"] += 1
+        inflight["max"] = max(inflight["max"], inflight["now"])
+        try:
+            await engine.call(user_id, lambda: clock.sleep(0.01))
+        finally:
+            inflight["now"] -= 1
+        if user_id % 5 == 0:
+            raise TelegramForbiddenError(method=METHOD, message="Forbidden: bot was blocked by the user")
+        if user_id % 5 == 1:
+            return False
+        if user_id % 5 == 2:
+            return None
+        return True
+    
+    # Исключение отправителя считается неудачей и не останавливает остальных
+    assert run(engine.run(recipients(), send)) == (8, 8)
+    assert inflight["max"] == 3
+
+
+def test_is_unreachable():
+    assert is_unreachable(TelegramForbiddenError(method=METHOD, message="Forbidden: bot was blocked by the user"))
+    assert not is_unreachable(retry_after(1))
@@ -0,0 +1,251 @@
+"""Очередь задач JobQueue поверх временной базы SQLite"""
+
+import asyncio
+import time
+
+import pytest
+
+from conftest import run
+from jobs import JobQueue
+
+NOW = 1_700_000_000
+
+
+class RetryAfter(Exception):
+    """Ответ Telegram с паузой retry_after (как TelegramRetryAfter)"""
+    
+    def __init__(self, retry_after: int):
+        super().__init__(f"retry after {retry_after}")
+        self.retry_after = retry_after
+
+
+class Blocked(Exception):
+    """Бот заблокирован пользователем"""
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемое время для now_ts (сроки задач и аренды)"""
+    state = {"now": NOW}
+    monkeypatch.setattr(time, "time", lambda: state["now"])
+    
+    def advance(seconds: int):
+        state["now"] += seconds
+    
+    return advance
+
+
+@pytest.fixture
+def storage(database):
+    """Асинхронный фасад над временной базой, как в боте"""
+    import main
+    
+    storage = main.AsyncDatabase(database, workers=1)
+    yield storage
+    storage._executor.shutdown(wait=True)
+
+
+def make_queue(storage, **kwargs) -> JobQueue:
+    kwargs.setdefault("backoff_base", 30)
+    kwargs.setdefault("permanent", lambda e: isinstance(e, Blocked))
+    return JobQueue(storage, **kwargs)
+
+
+def job_row(database, job_id: int):
+    with database.connection() as conn:
+        return conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+
+def test_job_key_deduplicates(storage, database, clock):
+    queue = make_queue(storage)
+    queue.register("notify", lambda payload: None)
+    
+    async def scenario():
+        first = await queue.enqueue("notify", {"n": 1}, key="digest:1")
+        second = await queue.enqueue("notify", {"n": 2}, key="digest:1")
+        other = await queue.enqueue("notify", {"n": 3}, key="digest:2")
+        return first, second, other
+    
+    first, second, other = run(scenario())
+    assert first is not None and other is not None
+    assert second is None
+    assert database.get_job_counts() == {"queued": 2}
+    
+    with pytest.raises(ValueError):
+        run(queue.enqueue("unknown"))
+
+
+def test_claim_lease_expires_and_job_is_reclaimed(storage, database, clock):
+    queue = make_queue(storage, lease=300)
+    queue.register("notify", lambda payload: None)
+    job_id = run(queue.enqueue("notify", {"user_id": 1}))
+    
+    jobs = database.claim_due_jobs(4, queue.lease)
+    assert [(job['id'], job['payload'], job['attempts']) for job in jobs] == [(job_id, {"user_id": 1}, 1)]
+    
+    # Пока аренда действует, задачу никто не заберет; срок - конец аренды
+    assert database.claim_due_jobs(4, queue.lease) == []
+    assert database.get_next_job_time() == NOW + 300
+    
+    # Процесс упал: по истечении аренды задача снова наступила
+    clock(300)
+    jobs = database.claim_due_jobs(4, queue.lease)
+    assert [(job['id'], job['attempts']) for job in jobs] == [(job_id, 2)]
+
+
+def test_future_job_is_not_claimed_early(storage, database, clock):
+    queue = make_queue(storage)
+    queue.register("notify", lambda payload: None)
+    run(queue.enqueue("notify", run_at=NOW + 60))
+    
+    assert database.claim_due_jobs(4, queue.lease) == []
+    assert database.get_next_job_time() == NOW + 60
+    clock(60)
+    assert len(database.claim_due_jobs(4, queue.lease)) == 1
+
+
+def test_backoff_is_exponential_and_capped(storage):
+    queue = make_queue(storage, backoff_base=30, backoff_max=100)
+    error = RuntimeError("network")
+    
+    assert [queue.backoff(attempts, error) for attempts in (1, 2, 3, 4)] == [30, 60, 100, 100]
+    # retry_after из ответа Telegram важнее экспоненты
+    assert queue.backoff(1, RetryAfter(7)) == 8
+    assert queue.backoff(4, RetryAfter(500)) == 501
+
+
+def execute_due(queue: JobQueue, database):
+    """Захват и выполнение наступивших задач без диспетчера"""
+    async def scenario():
+        for job in database.claim_due_jobs(queue.workers, queue.lease):
+            await queue._execute(job)
+    
+    run(scenario())
+
+
+def test_failed_attempt_is_retried_with_backoff(storage, database, clock):
+    queue = make_queue(storage)
+    calls = []
+    
+    async def handler(payload):
+        calls.append(payload)
+        if len(calls) == 1:
+            raise RuntimeError("network")
+    
+    queue.register("notify", handler)
+    job_id = run(queue.enqueue("notify", {"n": 1}))
+    
+    execute_due(queue, database)
+    row = job_row(database, job_id)
+    assert (row['status'], row['run_at'], row['attempts']) == ("queued", NOW + 30, 1)
+    assert row['last_error'] == "RuntimeError: network"
+    assert queue.retried == 1
+    
+    # До срока повтора задача ждет
+    clock(29)
+    execute_due(queue, database)
+    assert len(calls) == 1
+    
+    clock(1)
+    execute_due(queue, database)
+    assert len(calls) == 2
+    assert job_row(database, job_id) is None
+    assert queue.processed == 1
+
+
+def test_retry_after_sets_next_attempt(storage, database, clock):
+    queue = make_queue(storage)
+    
+    async def handler(payload):
+        raise RetryAfter(5)
+    
+    queue.register("notify", handler)
+    job_id = run(queue.enqueue("notify"))
+    
+    execute_due(queue, database)
+    row = job_row(database, job_id)
+    assert (row['status'], row['run_at']) == ("queued", NOW + 6)
+
+
+def test_permanent_error_fails_immediately(storage, database, clock):
+    queue = make_queue(storage)
+    
+    async def handler(payload):
+        raise Blocked("bot was blocked by the user")
+    
+    queue.register("notify", handler)
+    job_id = run(queue.enqueue("notify"))
+    
+    execute_due(queue, database)
+    row = job_row(database, job_id)
+    assert (row['status'], row['attempts']) == ("failed", 1)
+    assert row['last_error'] == "Blocked: bot was blocked by the user"
+    assert (queue.failed, queue.retried) == (1, 0)
+    assert database.get_next_job_time() is None
+
+
+def test_max_attempts_exhausted(storage, database, clock):
+    queue = make_queue(storage, max_attempts=3, backoff_base=10)
+    
+    async def handler(payload):
+        raise RuntimeError("network")
+    
+    queue.register("notify", handler)
+    job_id = run(queue.enqueue("notify"))
+    
+    for _ in range(3):
+        execute_due(queue, database)
+        clock(3600)
+    
+    row = job_row(database, job_id)
+    assert (row['status'], row['attempts'], row['max_attempts']) == ("failed", 3, 3)
+    assert (queue.retried, queue.failed) == (2, 1)
+    
+    # Окончательно не выполненная задача больше не захватывается
+    clock(3600)
+    assert database.claim_due_jobs(4, queue.lease) == []
+
+
+def test_job_without_handler_fails(storage, database, clock):
+    queue = make_queue(storage)
+    queue.register("notify", lambda payload: None)
+    job_id = run(queue.enqueue("notify"))
+    
+    # Тип задачи удален из кода после постановки
+    del queue.handlers["notify"]
+    execute_due(queue, database)
+    
+    row = job_row(database, job_id)
+    assert row['status'] == "failed"
+    assert "нет обработчика" in row['last_error']
+
+
+def test_dispatcher_without_poll_wakes_on_enqueue(storage, database):
+    # Реальное время: диспетчер без опроса спит, пока enqueue его не разбудит
+    queue = make_queue(storage, workers=2, poll_interval=None)
+    
+    async def scenario():
+        finished = asyncio.Event()
+        
+        async def handler(payload):
+            finished.set()
+        
+        queue.register("notify", handler)
+        dispatcher = asyncio.create_task(queue.run())
+        try:
+            await asyncio.sleep(0.05)
+            await queue.enqueue("notify")
+            await asyncio.wait_for(finished.wait(), timeout=5)
+            # Выполненная задача удаляется
+            for _ in range(100):
+                if not database.get_job_counts():
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            dispatcher.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await dispatcher
+    
+    run(scenario())
+    assert database.get_job_counts() == {}
+    assert queue.processed == 1
@@ -0,0 +1,308 @@
+"""PostgresStorage на живой базе PostgreSQL.
+
+Тесты с базой выполняются, только если задан TEST_DATABASE_URL (например,
+postgresql://postgres@localhost/rassilka_test). Каждый тест работает в своей
+временной схеме (search_path), которая удаляется после теста: таблицы бота
+в этой базе не затрагиваются.
+"""
+
+import asyncio
+import json
+import os
+import uuid
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import pytest
+
+asyncpg = pytest.importorskip("asyncpg")
+
+from conftest import run
+from jobs import JobQueue
+from postgres_storage import PostgresStorage, _numbered, _rowcount
+from storage import SEGMENT_FILTER_PREFIX, now_ts
+
+TEST_DSN = os.getenv("TEST_DATABASE_URL")
+
+
+class Blocked(Exception):
+    """Бот заблокирован пользователем"""
+
+
+def with_search_path(dsn: str, schema: str) -> str:
+    """DSN с search_path: asyncpg передает лишние параметры строки как настройки сервера"""
+    parts = urlsplit(dsn)
+    query = parse_qsl(parts.query) + [("search_path", schema)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+async def execute_admin(query: str):
+    conn = await asyncpg.connect(TEST_DSN)
+    try:
+        await conn.execute(query)
+    finally:
+        await conn.close()
+
+
+@pytest.fixture
+def pg_dsn():
+    """DSN временной схемы в тестовой базе"""
+    if not TEST_DSN:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    
+    schema = f"rassilka_test_{uuid.uuid4().hex[:12]}"
+    run(execute_admin(f"CREATE SCHEMA {schema}"))
+    yield with_search_path(TEST_DSN, schema)
+    run(execute_admin(f"DROP SCHEMA {schema} CASCADE"))
+
+
+def run_with_storage(dsn: str, scenario):
+    """Выполнение scenario(storage) на открытом хранилище (пул живет в одном цикле событий)"""
+    async def main():
+        storage = PostgresStorage(dsn, max_size=4)
+        await storage.open()
+        try:
+            return await scenario(storage)
+        finally:
+            await storage.close()
+    
+    return run(main())
+
+
+async def add_users(storage, user_ids):
+    for user_id in user_ids:
+        await storage.add_user(user_id, f"user{user_id}", "User")
+
+
+# ---------- Без базы ----------
+def test_numbered_placeholders():
+    assert _numbered("a = ? AND b IN (?, ?)") == "a = $1 AND b IN ($2, $3)"
+    assert _numbered("c > ?", start=4) == "c > $4"
+
+
+def test_rowcount_from_status():
+    assert _rowcount("UPDATE 3") == 3
+    assert _rowcount("INSERT 0 5") == 5
+    assert _rowcount("DELETE 0") == 0
+
+
+# ---------- Схема ----------
+def test_migrations_on_empty_database_and_rerun(pg_dsn):
+    async def versions(storage):
+        return [tuple(row) for row in await storage._fetch(
+            "SELECT version, applied_at FROM schema_version ORDER BY version")]
+    
+    applied = run_with_storage(pg_dsn, versions)
+    assert [version for version, _ in applied] == [version for version, _, _ in PostgresStorage.MIGRATIONS]
+    
+    # Повторный запуск (другая реплика): все шаги уже применены, ничего не меняется
+    assert run_with_storage(pg_dsn, versions) == applied
+    
+    async def tables(storage):
+        rows = await storage._fetch('''
+        SELECT table_name FROM information_schema.tables
+        WHERE table_schema = current_schema()
+        ''')
+        return {row['table_name'] for row in rows}
+    
+    assert {"users", "mailing_recipients", "scheduled_mailings", "jobs", "admin_events"} <= \
+        run_with_storage(pg_dsn, tables)
+
+
+# ---------- Keyset-пагинация ----------
+def test_keyset_page_flags(pg_dsn):
+    async def scenario(storage):
+        await add_users(storage, range(101, 106))
+        ids = [row['id'] for row in await storage._fetch("SELECT id FROM users ORDER BY id DESC")]
+        
+        async def page(cursor=None, direction="next"):
+            rows, has_prev, has_next = await storage.get_subscription_users_page(
+                "all", cursor, direction, limit=2)
+            return [row['id'] for row in rows], has_prev, has_next
+        
+        # Новые сверху: вперед по страницам и обратно
+        assert await page() == (ids[0:2], False, True)
+        assert await page((ids[1],)) == (ids[2:4], True, True)
+        assert await page((ids[3],)) == (ids[4:5], True, False)
+        assert await page((ids[4],), "prev") == (ids[2:4], True, True)
+        assert await page((ids[2],), "prev") == (ids[0:2], False, True)
+    
+    run_with_storage(pg_dsn, scenario)
+
+
+# ---------- Задания рассылок ----------
+async def prepare_audience(storage):
+    """Пять пользователей: 102 отписан, 103 недоступен"""
+    await add_users(storage, range(101, 106))
+    await storage.toggle_user_mailing_subscription(102)
+    await storage.deactivate_users([103])
+
+
+async def queued(storage, mailing_id: int, **kwargs):
+    return [row['user_id'] for row in await storage.get_queued_recipients_page(mailing_id, **kwargs)]
+
+
+def test_create_mailing_job_by_filter(pg_dsn):
+    async def scenario(storage):
+        await prepare_audience(storage)
+        
+        mailing_id, count = await storage.create_mailing_job(1, "Текст", "all")
+        assert count == 3
+        assert await queued(storage, mailing_id) == [101, 104, 105]
+        # Доля воркера: user_id % shards = shard
+        assert await queued(storage, mailing_id, shard=1, shards=2) == [101, 105]
+        
+        mailing = await storage.get_mailing(mailing_id)
+        assert mailing['status'] == "running"
+        assert json.loads(mailing['filter_criteria']) == {"user_count": 3}
+        
+        assert await storage.create_mailing_job(1, "Текст", "unknown") == (None, 0)
+    
+    run_with_storage(pg_dsn, scenario)
+
+
+def test_create_mailing_job_for_segment(pg_dsn):
+    async def scenario(storage):
+        await prepare_audience(storage)
+        segment = f"{SEGMENT_FILTER_PREFIX}region"
+        
+        # Список сегмента сверяется с фильтром "all": отписанный, недоступный и
+        # неизвестный пользователи в очередь не попадают
+        mailing_id, count = await storage.create_mailing_job(
+            1, "Текст", segment, media=[{"type": "photo", "file_id": "f"}], user_ids=[101, 102, 103, 105, 999])
+        assert count == 2
+        assert await queued(storage, mailing_id) == [101, 105]
+        assert json.loads((await storage.get_mailing(mailing_id))['media']) == [{"type": "photo", "file_id": "f"}]
+        
+        # Сегмент без списка получателей не создается
+        assert await storage.create_mailing_job(1, "Текст", segment) == (None, 0)
+    
+    run_with_storage(pg_dsn, scenario)
+
+
+def test_recipient_delivery_and_lazy_sent_message(pg_dsn):
+    async def scenario(storage):
+        await prepare_audience(storage)
+        mailing_id, _ = await storage.create_mailing_job(1, "Текст", "all")
+        
+        assert await storage.mark_recipient_sending(mailing_id, 101) is True
+        # Повторный захват (другой воркер) не проходит
+        assert await storage.mark_recipient_sending(mailing_id, 101) is False
+        
+        await storage.complete_mailing_recipients(mailing_id, [(101, 1001), (104, 1004)])
+        await storage.fail_mailing_recipient(mailing_id, 105, "blocked")
+        assert await storage.get_mailing_job_progress(mailing_id) == {
+            "queued": 0, "sending": 0, "sent": 2, "failed": 1, "total": 3}
+        
+        rows = await storage._fetch('''
+        SELECT user_id, telegram_message_id, sent_message_id FROM mailing_recipients
+        WHERE mailing_id = $1 AND state = 'sent' ORDER BY user_id
+        ''', mailing_id)
+        assert [tuple(row) for row in rows] == [(101, 1001, None), (104, 1004, None)]
+        
+        # Строка sent_messages создается при первом отклике и дальше переиспользуется
+        sent_message_id = await storage.get_or_create_sent_message(mailing_id, 101, 1001)
+        assert sent_message_id is not None
+        assert await storage.get_or_create_sent_message(mailing_id, 101, 1001) == sent_message_id
+        assert (await storage.get_sent_message(sent_message_id, 101))['mailing_id'] == mailing_id
+        
+        # Одновременные нажатия: блокировка строки получателя, одна строка sent_messages
+        first, second = await asyncio.gather(
+            storage.get_or_create_sent_message(mailing_id, 104, 1004),
+            storage.get_or_create_sent_message(mailing_id, 104, 1004))
+        assert first == second
+        assert await storage._fetchval(
+            "SELECT COUNT(*) FROM sent_messages WHERE mailing_id = $1", mailing_id) == 2
+        
+        # Не получатель рассылки
+        assert await storage.get_or_create_sent_message(mailing_id, 102, 1002) is None
+    
+    run_with_storage(pg_dsn, scenario)
+
+
+def test_apply_writes_isolates_failed_operation(pg_dsn):
+    async def scenario(storage):
+        results = await storage.apply_writes([
+            ("add_user", (201, "a", "A"), {}, None),
+            ("enqueue_job", ("notify", {}, "не число", 1), {}, None),
+            ("add_user", (202, "b", "B"), {}, None),
+        ])
+        assert [ok for ok, _ in results] == [True, False, True]
+        assert await storage.get_user_by_id(201) is not None
+        assert await storage.get_user_by_id(202) is not None
+        assert await storage.get_job_counts() == {}
+    
+    run_with_storage(pg_dsn, scenario)
+
+
+# ---------- Очередь задач ----------
+def test_claim_due_jobs_lease_reclaim(pg_dsn):
+    async def scenario(storage):
+        started = now_ts()
+        job_id = await storage.enqueue_job("notify", {"user_id": 1}, started, 8, "notify:1")
+        assert await storage.enqueue_job("notify", {"user_id": 1}, started, 8, "notify:1") is None
+        
+        jobs = await storage.claim_due_jobs(4, 300)
+        assert [(job['id'], job['payload'], job['attempts']) for job in jobs] == [(job_id, {"user_id": 1}, 1)]
+        
+        # Пока аренда действует, задачу никто не заберет; срок - конец аренды
+        assert await storage.claim_due_jobs(4, 300) == []
+        assert await storage.get_next_job_time() >= started + 300
+        
+        # Процесс упал: аренда истекла, задача снова наступила
+        await storage._execute("UPDATE jobs SET run_at = run_at - 301 WHERE id = $1", job_id)
+        jobs = await storage.claim_due_jobs(4, 300)
+        assert [(job['id'], job['attempts']) for job in jobs] == [(job_id, 2)]
+    
+    run_with_storage(pg_dsn, scenario)
+
+
+def test_concurrent_claims_skip_locked_jobs(pg_dsn):
+    async def scenario(storage):
+        ids = [await storage.enqueue_job("notify", {"n": n}, now_ts(), 8) for n in range(4)]
+        
+        # Реплики разбирают очередь одновременно: каждая задача достается одной
+        batches = await asyncio.gather(*(storage.claim_due_jobs(2, 300) for _ in range(3)))
+        claimed = [job['id'] for batch in batches for job in batch]
+        assert sorted(claimed) == sorted(ids)
+    
+    run_with_storage(pg_dsn, scenario)
+
+
+def test_job_queue_retry_and_permanent_failure(pg_dsn):
+    async def scenario(storage):
+        queue = JobQueue(storage, backoff_base=30, permanent=lambda e: isinstance(e, Blocked))
+        
+        async def flaky(payload):
+            raise RuntimeError("network")
+        
+        async def blocked(payload):
+            raise Blocked("bot was blocked by the user")
+        
+        queue.register("flaky", flaky)
+        queue.register("blocked", blocked)
+        flaky_id = await queue.enqueue("flaky")
+        blocked_id = await queue.enqueue("blocked")
+        
+        started = now_ts()
+        for job in await storage.claim_due_jobs(4, queue.lease):
+            await queue._execute(job)
+        
+        rows = {row['id']: row for row in await storage._fetch(
+            "SELECT id, status, run_at, attempts, last_error FROM jobs")}
+        assert rows[flaky_id]['status'] == "queued"
+        assert started + 30 <= rows[flaky_id]['run_at'] <= now_ts() + 30
+        assert rows[flaky_id]['last_error'] == "RuntimeError: network"
+        assert (rows[blocked_id]['status'], rows[blocked_id]['attempts']) == ("failed", 1)
+        assert await storage.get_job_counts() == {"queued": 1, "failed": 1}
+    
+    run_with_storage(pg_dsn, scenario)
+
+
+# ---------- Сводки администратору ----------
+def test_delete_admin_events_by_ids(pg_dsn):
+    async def scenario(storage):
+        ids = [await storage.add_admin_event("like", mailing_id=1, user_id=user_id) for user_id in range(4)]
+        await storage.delete_admin_events([ids[0], ids[2]])
+        assert [row['id'] for row in await storage.get_admin_events()] == [ids[1], ids[3]]
+    
+    run_with_storage(pg_dsn, scenario)
@@ -0,0 +1,148 @@
+"""Выражения сегментов и битовые карты SegmentIndex на поддельном хранилище"""
+
+from datetime import datetime
+
+import pytest
+
+from conftest import run
+from segments import SegmentError, SegmentIndex, parse_segment
+from storage import now_ts
+
+
+class FakeStorage:
+    """Хранилище с одним методом get_user_segment_rows над списком строк в памяти"""
+    
+    def __init__(self):
+        self.rows = {}
+    
+    def add(self, row_id: int, user_id: int = None, created_at: int = None, is_active: int = 1,
+            subscribed: int = 1, questionnaire: int = 0, region: str = None, activity: str = None):
+        self.rows[row_id] = {
+            "id": row_id, "user_id": user_id or 1000 + row_id, "created_at": created_at or now_ts(),
+            "is_active": is_active, "mailing_subscribed": subscribed,
+            "has_filled_questionnaire": questionnaire, "region": region, "activity": activity,
+            "updated_at": now_ts()
+        }
+    
+    def update(self, row_id: int, **values):
+        self.rows[row_id].update(values, updated_at=now_ts())
+    
+    async def get_user_segment_rows(self, after_id: int = 0, updated_since: int = 0):
+        return [dict(row) for row in self.rows.values()
+                if row["id"] > after_id or row["updated_at"] >= updated_since]
+
+
+def ts(day: str) -> int:
+    return int(datetime.strptime(day, "%d.%m.%Y").timestamp())
+
+
+@pytest.fixture
+def storage():
+    storage = FakeStorage()
+    storage.add(1, questionnaire=1, region="Владимир", activity="Строительство дорог", created_at=ts("10.01.2024"))
+    storage.add(2, questionnaire=1, region="Москва", created_at=ts("20.01.2024"))
+    storage.add(3, region=" владимир ", created_at=ts("05.02.2024"))
+    storage.add(4, subscribed=0, questionnaire=1, region="Владимир", created_at=ts("06.02.2024"))
+    storage.add(5, is_active=0, region="Владимир", created_at=ts("07.02.2024"))
+    storage.add(6, created_at=ts("01.03.2024"))
+    return storage
+
+
+def select(index: SegmentIndex, expression: str) -> list:
+    """Номера строк (users.id) сегмента"""
+    return sorted(user_id - 1000 for user_id in run(index.select(expression)))
+
+
+# ---------- Разбор выражений ----------
+def test_precedence_not_and_or():
+    assert parse_segment("анкета ИЛИ НЕ неделя И месяц") == (
+        "or",
+        ("atom", "анкета", None),
+        ("and", ("not", ("atom", "неделя", None)), ("atom", "месяц", None))
+    )
+
+
+def test_parentheses_and_english_operators():
+    assert parse_segment("(анкета or неделя) and not месяц") == (
+        "and",
+        ("or", ("atom", "анкета", None), ("atom", "неделя", None)),
+        ("not", ("atom", "месяц", None))
+    )
+
+
+def test_values_quotes_and_dates():
+    assert parse_segment('сфера="Строительство дорог" И с=01.02.2024') == (
+        "and",
+        ("atom", "сфера", "Строительство дорог"),
+        ("atom", "с", ts("01.02.2024"))
+    )
+
+
+@pytest.mark.parametrize("expression, message", [
+    ("", "Пустое"),
+    ("анкета И", "оборвано"),
+    ("(анкета", "закрывающей скобки"),
+    ("анкета месяц", "Лишняя часть"),
+    ("город=Москва", "не принимает значение"),
+    ("неизвестно", "Неизвестный признак"),
+    ("регион=", "Не указано значение"),
+    ("с=2024-01-01", "ДД.ММ.ГГГГ"),
+    ("И анкета", "Ожидался признак"),
+])
+def test_parse_errors(expression, message):
+    with pytest.raises(SegmentError, match=message):
+        parse_segment(expression)
+
+
+# ---------- Битовые карты ----------
+def test_audience_limited_to_active_subscribed(storage):
+    index = SegmentIndex(storage)
+    assert select(index, "все") == [1, 2, 3, 6]
+    # Дополнение не выходит за активных подписанных: 4 отписан, 5 неактивен
+    assert select(index, "НЕ анкета") == [3, 6]
+    assert select(index, "НЕ регион=Владимир") == [2, 6]
+    assert select(index, "отписан") == []
+    assert run(index.count("анкета ИЛИ регион=владимир")) == 3
+
+
+def test_value_attributes_ignore_case_and_spaces(storage):
+    index = SegmentIndex(storage)
+    assert select(index, "регион=ВЛАДИМИР") == [1, 3]
+    assert select(index, 'сфера="строительство дорог"') == [1]
+
+
+def test_apply_reindexes_changed_rows(storage):
+    index = SegmentIndex(storage)
+    assert select(index, "регион=Владимир") == [1, 3]
+    
+    storage.update(1, region="Москва", has_filled_questionnaire=0)
+    storage.update(4, mailing_subscribed=1)
+    storage.add(7, region="Владимир")
+    
+    assert select(index, "регион=Владимир") == [3, 4, 7]
+    assert select(index, "регион=Москва") == [1, 2]
+    assert select(index, "анкета") == [2, 4]
+    assert len(index) == 7
+
+
+def test_cleared_value_removed_from_index(storage):
+    index = SegmentIndex(storage)
+    assert select(index, "регион=Москва") == [2]
+    storage.update(2, region=None)
+    assert select(index, "регион=Москва") == []
+
+
+def test_registration_ranges(storage):
+    index = SegmentIndex(storage)
+    # с - включительно, до - не включая указанный день
+    assert select(index, "с=20.01.2024") == [2, 3, 6]
+    assert select(index, "до=20.01.2024") == [1]
+    assert select(index, "с=01.02.2024 И до=01.03.2024") == [3]
+    assert select(index, "НЕ с=01.02.2024") == [1, 2]
+
+
+def test_recent_registrations(storage):
+    storage.add(7)
+    index = SegmentIndex(storage)
+    assert select(index, "неделя") == [7]
+    assert select(index, "месяц") == [7]
@@ -0,0 +1,82 @@
+"""Дневные счетчики stats_counters против прямого подсчета строк за тот же период"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from storage import local_day, period_bounds
+
+
+def boundary_times(days: int) -> list:
+    """Метки времени у границ периода period_bounds(days) и внутри него"""
+    start, end = period_bounds(days)
+    return [start - 3600, start - 1, start, start + 1, start + 5 * 3600,
+            (start + end) // 2, end - 3600, end - 1, end, end + 3600]
+
+
+@pytest.mark.parametrize("tz", ["UTC", "Europe/Moscow", "Asia/Vladivostok", "America/New_York"])
+@pytest.mark.parametrize("days", [7, 14])
+def test_statistics_match_raw_counts(database, timezone, tz, days):
+    timezone(tz)
+    times = boundary_times(days)
+    
+    with database.transaction() as conn:
+        for i, ts in enumerate(times):
+            conn.execute("INSERT INTO users (user_id, first_name, created_at) VALUES (?, 'U', ?)", (i + 1, ts))
+            conn.execute("INSERT INTO manager_messages (user_id, message_text, created_at) VALUES (?, 'hi', ?)",
+                         (i + 1, ts))
+            conn.execute('''INSERT INTO tender_exports (user_id, file_name, status, sent_at)
+                            VALUES (?, 'f.xlsx', 'completed', ?)''', (i + 1, ts))
+    
+    stats = database.get_statistics(days)
+    start, end = period_bounds(days)
+    
+    with database.connection() as conn:
+        def raw(query):
+            return conn.execute(query, (start, end)).fetchone()[0]
+        
+        assert stats['new_users'] == raw("SELECT COUNT(*) FROM users WHERE created_at >= ? AND created_at < ?")
+        assert stats['manager_messages'] == raw(
+            "SELECT COUNT(*) FROM manager_messages WHERE created_at >= ? AND created_at < ?")
+        assert stats['exports_completed'] == raw(
+            "SELECT COUNT(*) FROM tender_exports WHERE status = 'completed' AND sent_at >= ? AND sent_at < ?")
+    
+    # Из десяти меток в период попадают шесть: от start до end - 1
+    assert stats['new_users'] == 6
+
+
+def test_counters_rebuilt_by_local_day(database, timezone):
+    timezone("Asia/Vladivostok")
+    noon = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+    # 00:30 по Владивостоку - еще предыдущие сутки по UTC
+    early = noon.replace(hour=0, minute=30) - timedelta(days=1)
+    
+    with database.transaction() as conn:
+        conn.execute("INSERT INTO users (user_id, first_name, created_at) VALUES (1, 'U', ?)",
+                     (int(early.timestamp()),))
+        conn.execute("DELETE FROM stats_counters")
+        database._migrate_local_day_counters(conn)
+        row = conn.execute("SELECT day, value FROM stats_counters WHERE metric = 'new_users'").fetchone()
+    
+    assert (row['day'], row['value']) == (local_day(int(early.timestamp())), 1)
+    assert row['day'] != int(early.timestamp()) // 86400
+
+
+def test_recompute_after_timezone_change(database, timezone):
+    timezone("America/New_York")
+    # События каждый час за 9 суток: границы суток Нью-Йорка и Владивостока различаются
+    start, _ = period_bounds(9)
+    times = range(start, start + 9 * 86400, 3600)
+    with database.transaction() as conn:
+        for i, ts in enumerate(times):
+            conn.execute("INSERT INTO users (user_id, first_name, created_at) VALUES (?, 'U', ?)", (i + 1, ts))
+    
+    # Сервер переехал: дни записанных событий посчитаны по старому поясу
+    timezone("Asia/Vladivostok")
+    database.recompute_stats_counters()
+    
+    start, end = period_bounds(7)
+    with database.connection() as conn:
+        raw = conn.execute("SELECT COUNT(*) FROM users WHERE created_at >= ? AND created_at < ?",
+                           (start, end)).fetchone()[0]
+    assert database.get_statistics(7)['new_users'] == raw
@@ -0,0 +1,108 @@
+"""TimerHeap: перенос и снятие таймеров, пробуждение на более ранний срок, изоляция ошибок"""
+
+import asyncio
+import time
+
+from conftest import run
+from timers import TimerHeap
+
+
+def recorder(fired: list, name: str, error: Exception = None):
+    """Корутинная функция таймера, записывающая свой вызов"""
+    async def callback():
+        fired.append(name)
+        if error:
+            raise error
+    
+    return callback
+
+
+async def run_for(timers: TimerHeap, seconds: float):
+    """Работа цикла таймеров seconds секунд"""
+    loop = asyncio.create_task(timers.run())
+    await asyncio.sleep(seconds)
+    loop.cancel()
+
+
+def test_reschedule_same_key_replaces_timer():
+    fired = []
+    
+    async def scenario():
+        timers = TimerHeap()
+        now = time.time()
+        timers.schedule(now + 0.05, "mailing", recorder(fired, "first"))
+        timers.schedule(now + 0.1, "mailing", recorder(fired, "second"))
+        assert len(timers) == 1
+        await run_for(timers, 0.3)
+        assert "mailing" not in timers
+    
+    run(scenario())
+    assert fired == ["second"]
+
+
+def test_cancel():
+    fired = []
+    
+    async def scenario():
+        timers = TimerHeap()
+        timers.schedule(time.time() + 0.05, "a", recorder(fired, "a"))
+        timers.schedule(time.time() + 0.05, "b", recorder(fired, "b"))
+        timers.cancel("a")
+        timers.cancel("missing")
+        assert "a" not in timers and len(timers) == 1
+        await run_for(timers, 0.2)
+    
+    run(scenario())
+    assert fired == ["b"]
+
+
+def test_wakes_for_earlier_deadline():
+    fired = []
+    
+    async def scenario():
+        timers = TimerHeap()
+        timers.schedule(time.time() + 60, "later", recorder(fired, "later"))
+        loop = asyncio.create_task(timers.run())
+        await asyncio.sleep(0.05)
+        
+        # Цикл спит до срока через минуту: новый ранний таймер должен его разбудить
+        started = time.monotonic()
+        timers.schedule(time.time() + 0.05, "sooner", recorder(fired, "sooner"))
+        while not fired and time.monotonic() - started < 2:
+            await asyncio.sleep(0.01)
+        loop.cancel()
+        return time.monotonic() - started
+    
+    elapsed = run(scenario())
+    assert fired == ["sooner"]
+    assert elapsed < 1
+
+
+def test_fires_in_deadline_order():
+    fired = []
+    
+    async def scenario():
+        timers = TimerHeap()
+        now = time.time()
+        for offset, name in ((0.15, "c"), (0.05, "a"), (0.1, "b")):
+            timers.schedule(now + offset, name, recorder(fired, name))
+        await run_for(timers, 0.4)
+    
+    run(scenario())
+    assert fired == ["a", "b", "c"]
+
+
+def test_callback_error_does_not_stop_others():
+    fired = []
+    
+    async def scenario():
+        timers = TimerHeap()
+        now = time.time()
+        timers.schedule(now + 0.05, "broken", recorder(fired, "broken", RuntimeError("сбой")))
+        timers.schedule(now + 0.05, "same_time", recorder(fired, "same_time"))
+        timers.schedule(now + 0.15, "after", recorder(fired, "after"))
+        await run_for(timers, 0.4)
+    
+    run(scenario())
+    assert sorted(fired) == ["after", "broken", "same_time"]
+    assert fired[-1] == "after"
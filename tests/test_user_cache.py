@@ -0,0 +1,58 @@
+"""Сброс кэша пользователя только после COMMIT внешней транзакции"""
+
+import threading
+
+
+def read_in_thread(database, user_id: int):
+    """Чтение пользователя из другого потока (свое соединение пула)"""
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(user=database.get_user_by_id(user_id)))
+    thread.start()
+    thread.join()
+    return result['user']
+
+
+def test_invalidation_waits_for_outer_commit(database):
+    database.add_user(1, "old", "User")
+    assert database.get_user_by_id(1)['username'] == "old"
+    
+    with database.transaction() as conn:
+        # Вложенная запись, как в пачке WriteBehindQueue
+        database.add_user(2, "other", "User")
+        conn.execute("UPDATE users SET username = 'new' WHERE user_id = 1")
+        database.deactivate_users([1])
+        
+        # Другой поток видит старую закоммиченную строку и кладет ее в кэш
+        assert read_in_thread(database, 1)['username'] == "old"
+        assert database.user_cache.get(1, "get_user_by_id")[0]
+    
+    # Сброс после COMMIT убрал устаревшее значение
+    assert database.user_cache.get(1, "get_user_by_id") == (False, None)
+    user = database.get_user_by_id(1)
+    assert (user['username'], user['is_active']) == ("new", 0)
+
+
+def test_invalidation_outside_transaction_is_immediate(database):
+    database.add_user(1, "old", "User")
+    database.get_user_by_id(1)
+    version = database.user_cache.version()
+    
+    database.deactivate_users([1])
+    
+    assert database.user_cache.version() > version
+    assert database.get_user_by_id(1)['is_active'] == 0
+
+
+def test_invalidation_after_rollback(database):
+    database.add_user(1, "old", "User")
+    database.get_user_by_id(1)
+    
+    try:
+        with database.transaction():
+            database.deactivate_users([1])
+            raise RuntimeError("откат")
+    except RuntimeError:
+        pass
+    
+    assert database.user_cache.get(1, "get_user_by_id") == (False, None)
+    assert database.get_user_by_id(1)['is_active'] == 1
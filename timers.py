@@ -0,0 +1,91 @@
+"""
+Таймеры бота на min-heap: одна фоновая задача спит ровно до ближайшего
+срока, а не опрашивает базу по расписанию
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class TimerHeap:
+    """Очередь отложенных вызовов по времени эпохи.
+    
+    schedule(when, key, callback) ставит корутинную функцию на момент when
+    (секунды эпохи); повторная постановка с тем же key переносит таймер,
+    cancel(key) снимает его. Снятые записи остаются в куче и пропускаются
+    при извлечении.
+    """
+    
+    # Сон не дольше часа: срок пересчитывается, даже если системные часы переведены
+    MAX_SLEEP = 3600
+    
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._changed = asyncio.Event()
+        self._running = set()
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+    
+    def schedule(self, when: float, key: Hashable, callback: Callable[[], Awaitable]):
+        """Постановка (или перенос) таймера key на момент when"""
+        self.cancel(key)
+        entry = [when, next(self._counter), key, callback]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        # Новый таймер раньше текущего ближайшего: будим цикл
+        if self._heap[0] is entry:
+            self._changed.set()
+    
+    def cancel(self, key: Hashable):
+        """Снятие таймера key (если он есть)"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[-1] = None
+    
+    def _pop_due(self, now: float) -> list:
+        """Извлечение всех наступивших таймеров"""
+        due = []
+        while self._heap and (self._heap[0][-1] is None or self._heap[0][0] <= now):
+            when, _, key, callback = heapq.heappop(self._heap)
+            if callback is None:
+                continue
+            del self._entries[key]
+            due.append((key, callback))
+        return due
+    
+    async def _fire(self, key: Hashable, callback: Callable[[], Awaitable]):
+        """Вызов таймера; ошибка не останавливает остальные таймеры"""
+        try:
+            await callback()
+        except Exception as e:
+            logger.error(f"❌ Ошибка таймера {key}: {e}")
+    
+    async def run(self):
+        """Фоновый цикл: сон до ближайшего срока и запуск наступивших таймеров"""
+        while True:
+            for key, callback in self._pop_due(time.time()):
+                task = asyncio.create_task(self._fire(key, callback))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            
+            delay = self.MAX_SLEEP
+            if self._heap:
+                delay = min(delay, max(0.0, self._heap[0][0] - time.time()))
+            
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass